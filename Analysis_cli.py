@@ -0,0 +1,164 @@
+"""
+Command-line entry point of the whole analysis suite (gating, figures and image
+analyses), e.g. python Analysis_cli.py gate /data/FACS/Day1 /data/FACS/Day2
+--output summary.xlsx. Each subcommand imports its analysis script only when it
+runs, and the plotting and statistics modules are only imported by the steps
+that draw, so compute-only runs start fast; figures are rendered headless
+(except the composites shown by fluor-merge --test)
+"""
+import os
+import sys
+import argparse
+
+root = os.path.dirname(os.path.abspath(__file__))
+
+# Make the scripts of a folder of the suite importable
+def script_folder (name):
+    folder = os.path.join(root, name)
+    if folder not in sys.path:
+        sys.path.append(folder)
+    return folder
+
+# Folders as absolute paths (the scripts join them to an empty dir)
+def absolute (folders):
+    return [os.path.abspath(folder) for folder in folders]
+
+def gate (args):
+    script_folder('FACS analysis')
+    import JLat_data_gating as jlat
+    from Result_table import export_table
+    pool = None
+    if args.threads:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=args.threads)
+    elif args.processes != 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=args.processes)
+    errors = []
+    output = os.path.abspath(args.output)
+    profile_log = os.path.abspath(args.profile_log) if args.profile_log else None
+    try:
+        metadata, metadata_means, df = jlat.multiple_folders(
+            '', absolute(args.folders), export=args.figures, hue=args.hue,
+            naming_convention=args.naming_convention, pool=pool, errors=errors,
+            cache_dir=args.cache_dir, chunk_size=args.chunk_size,
+            strategy_file=args.strategy_file, store=args.store,
+            profile_log=profile_log, summary_figures=args.figures)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    export_table(metadata_means, output)
+    for folder, file_name, error in errors:
+        print('Gating failed: ' + os.path.join(folder, file_name) + '\n' + error)
+    return 1 if errors else 0
+
+def figures (args):
+    script_folder('FACS analysis')
+    module = {'coculture': 'JLat_figures_coculture', 'induction': 'JLat_figures_induction'}[args.figure_set]
+    import importlib
+    outcomes = importlib.import_module(module).main(os.path.abspath(args.dir),
+                                                    os.path.abspath(args.output_dir), args.processes)
+    # The failed figures are reported by the rendering pool
+    return 1 if any(error is not None for result, error in outcomes) else 0
+
+def image_analysis (module, args):
+    script_folder('Image analysis')
+    import importlib
+    output = os.path.abspath(args.output)
+    os.makedirs(output, exist_ok=True)
+    importlib.import_module(module).main('', absolute(args.folders), output,
+                                         plots=args.plots, verbose=False, threads=args.threads)
+    return 0
+
+def redoil (args):
+    return image_analysis('RedOilO_Analysis', args)
+
+def trichrome (args):
+    return image_analysis('Trichrome_Analysis', args)
+
+def fluor_merge (args):
+    script_folder('Image analysis')
+    from FluorescentImageCompilation_v7 import bulk_analysis
+    output = os.path.abspath(args.output)
+    os.makedirs(output, exist_ok=True)
+    bulk_analysis('', absolute(args.folders), output, test=args.test,
+                  group_normalization=args.group_normalization, output_format=args.format)
+    return 0
+
+def adiposphere (args):
+    script_folder('Image analysis')
+    from Adiposphere_size_plots import main
+    os.makedirs(os.path.abspath(args.output), exist_ok=True)
+    main(os.path.abspath(args.input), os.path.abspath(args.output), verbose=False)
+    return 0
+
+def parser ():
+    parser = argparse.ArgumentParser(description='M2-Stage analysis suite')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+
+    command = subcommands.add_parser('gate', help='gate the .fcs files of folders (one per day)')
+    command.add_argument('folders', nargs='+', help='folders of .fcs files, in folder tag order')
+    command.add_argument('--output', default='Experiment Summary.xlsx',
+                         help='summary spreadsheet (a Parquet copy is written next to it)')
+    command.add_argument('--naming-convention', type=int, default=0,
+                         help='file name grammar (see Filename_grammar.py)')
+    command.add_argument('--hue', nargs=2, default=['Stimulation', ''], metavar=('X', 'LEGEND'),
+                         help='X-axis and legend labels of the summary plots')
+    command.add_argument('--processes', type=int, default=1, help='gating worker processes (0: all cores)')
+    command.add_argument('--threads', type=int,
+                         help='gate in a thread pool of this size instead (not with --figures)')
+    command.add_argument('--cache-dir', help='re-use the per-file results of previous runs')
+    command.add_argument('--chunk-size', type=int, help='stream the files, chunk-size events at a time')
+    command.add_argument('--strategy-file', help='gating strategies JSON')
+    command.add_argument('--store', action='store_true', help='write a gate store next to every file')
+    command.add_argument('--profile-log', help='per-stage timing/memory log (JSON lines)')
+    command.add_argument('--figures', action='store_true',
+                         help='export the per-file gating plots and the folder summary plots')
+    command.set_defaults(run=gate)
+
+    command = subcommands.add_parser('figures', help='render the J-Lat figures from the experiment summaries')
+    command.add_argument('figure_set', choices=['coculture', 'induction'])
+    command.add_argument('dir', help='folder of the Experiment Summary spreadsheets')
+    command.add_argument('--output-dir', default='.', help='where the figures are saved')
+    command.add_argument('--processes', type=int, help='rendering worker processes (default: all cores)')
+    command.set_defaults(run=figures)
+
+    for name, run, help in [('redoil', redoil, 'quantify Oil Red O stained photographs'),
+                            ('trichrome', trichrome, 'quantify trichrome stained photographs')]:
+        command = subcommands.add_parser(name, help=help)
+        command.add_argument('folders', nargs='+', help='photograph folders, one per donor, in donor order')
+        command.add_argument('--output', default='.', help='results folder')
+        command.add_argument('--plots', action='store_true', help='also draw the summary bar plots')
+        command.add_argument('--threads', type=int, default=1, help='photos analysed concurrently')
+        command.set_defaults(run=run)
+
+    command = subcommands.add_parser('fluor-merge', help='merge the three fluorescence channels of every field')
+    command.add_argument('folders', nargs='+', help='image folders, one per donor, in donor order')
+    command.add_argument('--output', default='.', help='merged images folder')
+    command.add_argument('--test', action='store_true', help='only the first folder, shown')
+    command.add_argument('--group-normalization', action='store_true',
+                         help='scale the replicates of a condition alike')
+    command.add_argument('--format', default='png', choices=['png', 'tif'], help='merged image format')
+    command.set_defaults(run=fluor_merge)
+
+    command = subcommands.add_parser('adiposphere', help='plot the adiposphere sizes')
+    command.add_argument('input', help='folder of the size measurements')
+    command.add_argument('output', help='plots folder')
+    command.set_defaults(run=adiposphere)
+    return parser
+
+def main (argv=None):
+    command_parser = parser()
+    args = command_parser.parse_args(argv)
+    if getattr(args, 'threads', None) and args.command == 'gate' and args.figures:
+        command_parser.error('--threads cannot export figures (pyplot is not thread-safe)')
+    if getattr(args, 'processes', None) == 0:
+        args.processes = None
+    # No display is needed but to show the fluor-merge test composites: set
+    # before matplotlib is (lazily) imported
+    if not (args.command == 'fluor-merge' and args.test):
+        os.environ.setdefault('MPLBACKEND', 'Agg')
+    return args.run(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+"""
+Offline benchmark of the gating pipeline on synthetic samples (Synthetic_FCS.py).
+FCS parsing, channel loading, hlog transform, every gate, statistics and figure
+export are timed separately for each sample size (each size in a fresh process,
+so that its peak RSS is its own), then appended to a CSV file together with the
+throughput, so runs before and after a change can be compared (compare_runs)
+"""
+import os
+import time
+import platform
+import tempfile
+import numpy as np
+import pandas as pd
+from Stage_timer import peak_rss
+
+sizes = [10**4, 10**5, 10**6, 10**7]
+results_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Benchmark results.csv')
+sample_dir = os.path.join(tempfile.gettempdir(), 'JLat benchmark')
+
+# Synthetic sample of n_events (written once, then re-used)
+def sample_file (n_events, seed=0, folder=sample_dir, name='J-LAT PMA-JQ1-1 LG P1 insert5'):
+    from Synthetic_FCS import write_synthetic_fcs
+    os.makedirs(folder, exist_ok=True)
+    file_name = os.path.join(folder, name + ' (' + str(n_events) + ').fcs')
+    if not os.path.exists(file_name):
+        write_synthetic_fcs(file_name, n_events, seed=seed)
+    return file_name
+
+# Best of repeats wall time of function(*args); returns (seconds, result)
+def best_time (function, args=(), repeats=3):
+    seconds = np.inf
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = min(seconds, time.perf_counter() - start)
+    return seconds, result
+
+# Time every stage of JLAT_gating on one file, then the whole function with
+# and without figure export (the difference is the figure export stage).
+# Returns ([(stage, seconds)], peak RSS in bytes)
+def benchmark_sample (file_name, repeats=3):
+    import matplotlib
+    matplotlib.use('Agg')
+    import JLat_data_gating as jlat
+    from FCS_reader import read_meta, load_channels, channel_range
+    from Hlog_transform import hlog_lookup
+    from Gate_engine import gate_order, gate_mask
+    gates, strategies = jlat.JLAT_gate_definitions()
+    timings = []
+    seconds, meta = best_time(read_meta, (file_name,), repeats)
+    timings.append(('parse', seconds))
+    seconds, (meta, data) = best_time(load_channels, (file_name, jlat.channel, meta), repeats)
+    timings.append(('load', seconds))
+    def transform ():
+        return {c: hlog_lookup(data[c], b=jlat.hlog_b, d=np.log10(channel_range(meta, c)))
+                for c in jlat.channel}
+    seconds, events = best_time(transform, (), repeats)
+    timings.append(('transform', seconds))
+    masks = {}
+    for gate in gate_order(gates):
+        def one_gate ():
+            mask = gate_mask(events, gate)
+            if gate.get('parent') is not None:
+                mask &= masks[gate['parent']]
+            return mask
+        seconds, masks[gate['name']] = best_time(one_gate, (), repeats)
+        timings.append(('gate: ' + gate['name'], seconds))
+    medians = [(median['channel'], median['population'])
+               for strategy in strategies for median in strategy.get('medians', [])]
+    def statistics ():
+        return [np.median(events[c][masks[population]]) for c, population in medians]
+    seconds, values = best_time(statistics, (), repeats)
+    timings.append(('statistics', seconds))
+    del data, events, masks
+    # Figures are written next to the file
+    compute, df = best_time(jlat.JLAT_gating, (file_name,), repeats)
+    export, df = best_time(lambda: jlat.JLAT_gating(file_name, export=True), (), repeats)
+    timings.append(('figure export', max(export - compute, 0.0)))
+    timings.append(('JLAT_gating', compute))
+    timings.append(('JLAT_gating (export)', export))
+    return timings, peak_rss()
+
+# Time multiple_folders on a folder of n_files synthetic samples named after
+# naming convention 2 (replicates 1-3 of CTL and PMA-JQ1), folder summary included
+def benchmark_batch (n_files=6, n_events=10**5):
+    import matplotlib
+    matplotlib.use('Agg')
+    import JLat_data_gating as jlat
+    folder = os.path.join(sample_dir, 'Batch ' + str(n_files) + ' x ' + str(n_events))
+    for i in range(n_files):
+        stimulus = ['CTL', 'PMA-JQ1'][i % 2]
+        name = 'J-LAT ' + stimulus + '-' + str(i//2 % 3 + 1) + ' LG P' + str(i//6 + 1) + ' insert5'
+        sample_file(n_events, seed=i, folder=folder, name=name)
+    seconds, result = best_time(jlat.multiple_folders, (folder, [''], False, False,
+                                                        ['Stimulation', 'Med+Fil'], 2), 1)
+    return [('multiple_folders', seconds)], peak_rss()
+
+# Git commit of the code being benchmarked ('' outside a repository)
+def code_version ():
+    import subprocess
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+# Run every benchmark (each in its own worker process) and append the results
+# to output: one row per run, sample size and stage
+def run_benchmarks (sizes=sizes, repeats=3, output=results_file, batch=(6, 10**5)):
+    from concurrent.futures import ProcessPoolExecutor
+    run = time.strftime('%Y-%m-%d %H:%M:%S')
+    commit = code_version()
+    cases = [(n_events, benchmark_sample, (sample_file(n_events), repeats)) for n_events in sizes]
+    if batch:
+        cases.append((batch[0]*batch[1], benchmark_batch, batch))
+    rows = []
+    for n_events, benchmark, args in cases:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            timings, rss = pool.submit(benchmark, *args).result()
+        for stage, seconds in timings:
+            rows.append({'Run': run, 'Commit': commit, 'Host': platform.node(),
+                         'Python': platform.python_version(), 'NumPy': np.__version__,
+                         'Events': n_events, 'Stage': stage, 'Seconds': seconds,
+                         'Events/s': n_events/seconds if seconds > 0 else np.nan,
+                         'Peak RSS (MB)': np.nan if rss is None else rss/2**20})
+        print(str(n_events) + ' events: ' + ', '.join(stage + ' ' + str(round(seconds, 4)) + ' s'
+                                                     for stage, seconds in timings))
+    results = pd.DataFrame(rows)
+    results.to_csv(output, mode='a', header=not os.path.exists(output), index=False)
+    return results
+
+# Compare two runs of the results file (default: the last two). Stages that got
+# slower by more than tolerance (relative) and min_seconds (absolute, below which
+# timings are mostly noise) are listed as regressions
+def compare_runs (output=results_file, baseline=None, current=None, tolerance=0.2,
+                  min_seconds=0.005):
+    results = pd.read_csv(output)
+    runs = list(pd.unique(results['Run']))
+    if len(runs) < 2 and (baseline is None or current is None):
+        print('Nothing to compare: a single run in ' + output)
+        return None
+    baseline = baseline or runs[-2]
+    current = current or runs[-1]
+    columns = ['Events', 'Stage']
+    before = results[results['Run'] == baseline].set_index(columns)
+    after = results[results['Run'] == current].set_index(columns)
+    comparison = pd.DataFrame({'Baseline (s)': before['Seconds'], 'Current (s)': after['Seconds'],
+                               'Baseline RSS (MB)': before['Peak RSS (MB)'],
+                               'Current RSS (MB)': after['Peak RSS (MB)']}).dropna()
+    comparison['Ratio'] = comparison['Current (s)']/comparison['Baseline (s)']
+    slower = comparison['Current (s)'] - comparison['Baseline (s)']
+    regressions = comparison[(comparison['Ratio'] > 1 + tolerance) & (slower > min_seconds)]
+    print(comparison.to_string())
+    for (n_events, stage), row in regressions.iterrows():
+        print('Regression: ' + stage + ' (' + str(n_events) + ' events) ' +
+              str(round(row['Ratio'], 2)) + 'x slower')
+    return comparison
+
+if __name__ == "__main__":
+    run_benchmarks()
+    compare_runs()
@@ -0,0 +1,203 @@
+"""
+Out-of-core gating: the DATA segment is streamed in fixed-size event chunks
+(hlog + gate cascade per chunk) and only counts, histograms and density
+rasters are kept, so peak memory does not depend on the size of the file.
+Medians stay exact: they are found by radix selection over a few passes
+"""
+import numpy as np
+from FCS_reader import read_meta, channel_range, iter_chunks, event_count
+from Gate_engine import gate_dag
+from Gate_plots import density_raster
+from Hlog_transform import hlog_lookup
+from Compensation import compensation_setup, compensate_channels
+from Gate_store import create_store, fill_store, close_store
+from Population_stats import (population_sums, percentile_ranks, needed_percentiles,
+                              finish_statistics)
+
+radix_bits = 16
+sign_bit = np.uint64(1 << 63)
+
+# float64 -> uint64 keys sorted in the same order as the values (and back)
+def ordered_keys (values):
+    bits = np.ascontiguousarray(values, dtype=np.float64).view(np.uint64)
+    return np.where(bits & sign_bit, ~bits, bits | sign_bit)
+
+def key_values (keys):
+    keys = np.asarray(keys, dtype=np.uint64)
+    bits = np.where(keys & sign_bit, keys & ~sign_bit, ~keys)
+    return bits.view(np.float64)
+
+# Histogram of the next radix_bits bits of the keys starting with prefix
+def radix_histogram (keys, prefix=0, known_bits=0):
+    if known_bits > 0:
+        keys = keys[(keys >> np.uint64(64 - known_bits)) == np.uint64(prefix)]
+    digits = (keys >> np.uint64(64 - known_bits - radix_bits)) & np.uint64(2**radix_bits - 1)
+    return np.bincount(digits.astype(np.int64), minlength=2**radix_bits)
+
+# Narrow a selection [prefix, known_bits, rank, count] down with a histogram
+def narrow_selection (selection, histogram):
+    prefix, known_bits, rank, count = selection
+    cumulative = np.cumsum(histogram)
+    digit = int(np.searchsorted(cumulative, rank, side='right'))
+    below = int(cumulative[digit - 1]) if digit > 0 else 0
+    return [(prefix << radix_bits) | digit, known_bits + radix_bits,
+            rank - below, int(histogram[digit])]
+
+# Exact values of ranks[s] (0-based) among the keys of every series s, starting
+# from the histograms of their first radix_bits bits. key_chunks() streams the
+# keys of all series again (one list of key arrays per chunk), once per pass.
+# Ranks of a series that fall in the same bin share their candidates: in a pass,
+# the smallest bins are collected (up to buffer_size keys in total) and the
+# others narrowed down by another radix_bits bits
+def stream_select_many (key_chunks, histograms, ranks, buffer_size=2**22):
+    selections = {}
+    for series in range(len(ranks)):
+        for rank in set(ranks[series]):
+            selections[(series, rank)] = narrow_selection([0, 0, rank, 0], histograms[series])
+    values = {}
+    while True:
+        for selection, (prefix, known_bits, rank_left, count) in selections.items():
+            if selection not in values and known_bits == 64: # All candidates are the same value
+                values[selection] = key_values([prefix])[0]
+        pending = [selection for selection in selections if selection not in values]
+        if len(pending) == 0:
+            break
+        groups = {}
+        for selection in pending:
+            prefix, known_bits, rank_left, count = selections[selection]
+            groups[(selection[0], prefix, known_bits)] = count
+        collect = set()
+        budget = buffer_size
+        for group in sorted(groups, key=groups.get):
+            if groups[group] <= budget:
+                collect.add(group)
+                budget = budget - groups[group]
+        collected = {group: [] for group in collect}
+        group_histograms = {group: 0 for group in groups if group not in collect}
+        for chunk_keys in key_chunks():
+            for group in groups:
+                series, prefix, known_bits = group
+                keys = chunk_keys[series]
+                if group in collect:
+                    collected[group].append(keys[(keys >> np.uint64(64 - known_bits)) == np.uint64(prefix)])
+                else:
+                    group_histograms[group] = group_histograms[group] + radix_histogram(keys, prefix, known_bits)
+        candidates = {group: np.concatenate(collected[group]) for group in collect}
+        for selection in pending:
+            prefix, known_bits, rank_left, count = selections[selection]
+            group = (selection[0], prefix, known_bits)
+            if group in collect:
+                values[selection] = key_values([np.partition(candidates[group], rank_left)[rank_left]])[0]
+            else:
+                selections[selection] = narrow_selection(selections[selection], group_histograms[group])
+    return [[values[(series, rank)] for rank in ranks[series]] for series in range(len(ranks))]
+
+# Same for a single series: key_chunks() yields key arrays
+def stream_select (key_chunks, histogram, ranks, buffer_size=2**22):
+    def series_chunks ():
+        for keys in key_chunks():
+            yield [keys]
+    return stream_select_many(series_chunks, [histogram], [ranks], buffer_size)[0]
+
+# hlog-transformed chunks of the requested channels (d = log10($PnR) per channel,
+# same lookup table as JLAT_gating), optionally compensated first (see Compensation.py).
+# raw: yield (transformed, linear) chunks, the linear ones with every loaded channel
+def transformed_chunks (file_name, channels, hlog_b, chunk_size, meta=None, compensation=None,
+                        raw=False):
+    if meta is None:
+        meta = read_meta(file_name)
+    decades = {c: np.log10(channel_range(meta, c)) for c in channels}
+    setup = compensation_setup(meta, compensation)
+    loaded = channels
+    if setup is not None:
+        loaded = channels + [c for c in setup[0] if c not in channels]
+    for chunk in iter_chunks(file_name, loaded, chunk_size, meta):
+        if setup is not None:
+            chunk.update(compensate_channels(chunk, setup[0], setup[1]))
+        events = {c: hlog_lookup(chunk[c], b=hlog_b, d=decades[c]) for c in channels}
+        yield (events, chunk) if raw else events
+
+# Values of every selection series (scale, channel, population) in a chunk
+def series_values (events, raw, masks, series):
+    values = []
+    for scale, channel, population in series:
+        data = events if scale == 'hlog' else raw
+        values.append(data[channel] if population is None else data[channel][masks[population]])
+    return values
+
+# Stream a file through a gate DAG (see Gate_engine.gate_dag). Returns the
+# counts ({gate name: count}, all events under None), the exact medians of
+# medians = [(channel, population gate name), ...] and, if asked, the density
+# rasters [parent gate name (None = all events), channel pair, xlim, ylim,
+# bins] accumulated over the chunks, and the population statistics of
+# statistics = {(channel, population): percentiles} on the linear scale (see
+# Population_stats.py). With store_file, the transformed channels and gate
+# bitsets are also written to a gate store (see Gate_store.py)
+def stream_gates (file_name, channels, gates, hlog_b, chunk_size=2**20, medians=(),
+                  rasters=(), buffer_size=2**22, compensation=None, store_file=None,
+                  store_info=None, statistics=None):
+    meta = read_meta(file_name)
+    counts = dict([(None, 0)] + [(gate['name'], 0) for gate in gates])
+    requests = list((statistics or {}).items())
+    # Every order statistic (hlog medians, linear percentiles) is a selection series
+    series = ([('hlog', c, population) for c, population in medians] +
+              [('linear', c, population) for (c, population), percentiles in requests])
+    histograms = [np.zeros(2**radix_bits, dtype=np.int64) for selection in series]
+    sums = [[0.0, 0, 0.0] for request in requests]
+    images = [0 for raster in rasters]
+    store = None
+    if store_file is not None:
+        chunk_size = (chunk_size + 7)//8*8 # Chunks start on a byte of the bitsets
+        store = create_store(store_file, event_count(meta), channels,
+                             [gate['name'] for gate in gates], store_info)
+    for events, raw in transformed_chunks(file_name, channels, hlog_b, chunk_size, meta,
+                                          compensation, raw=True):
+        masks, chunk_counts = gate_dag(events, gates)
+        if store is not None:
+            fill_store(store, counts[None], events, masks)
+        for name in chunk_counts:
+            counts[name] = counts.get(name, 0) + chunk_counts[name]
+        values = series_values(events, raw, masks, series)
+        for i in range(len(series)):
+            histograms[i] += radix_histogram(ordered_keys(values[i]))
+        for j in range(len(requests)):
+            chunk_sums = population_sums(values[len(medians) + j])
+            sums[j] = [total + chunk_sum for total, chunk_sum in zip(sums[j], chunk_sums)]
+        for i, (parent, channel_pair, xlim, ylim, bins) in enumerate(rasters):
+            x = events[channel_pair[0]]
+            y = events[channel_pair[1]]
+            if parent is not None:
+                x = x[masks[parent]]
+                y = y[masks[parent]]
+            images[i] = images[i] + density_raster(x, y, xlim, ylim, bins)
+    if store is not None:
+        close_store(store)
+    # Ranks of every series: medians as np.median (mean of the two middle values
+    # if the count is even), percentiles as np.percentile (see Population_stats.py)
+    sizes = [counts[population] for scale, c, population in series]
+    ranks = [[(n - 1)//2, n//2] if n > 0 else [] for n in sizes[:len(medians)]]
+    for j, ((c, population), percentiles) in enumerate(requests):
+        n = sizes[len(medians) + j]
+        positions, lower, upper = percentile_ranks(n, needed_percentiles(percentiles))
+        ranks.append(sorted(set(lower.tolist() + upper.tolist())) if n > 0 else [])
+    populations = [population for scale, c, population in series if population is not None]
+    def key_chunks ():
+        for events, raw in transformed_chunks(file_name, channels, hlog_b, chunk_size, meta,
+                                              compensation, raw=True):
+            masks, chunk_counts = gate_dag(events, gates, populations)
+            yield [ordered_keys(values) for values in series_values(events, raw, masks, series)]
+    selected = [[]]*len(series)
+    if any(ranks):
+        selected = stream_select_many(key_chunks, histograms, ranks, buffer_size)
+    median_values = {}
+    for i, (median_channel, population) in enumerate(medians):
+        median_values[(median_channel, population)] = np.nan
+        if sizes[i] > 0:
+            median_values[(median_channel, population)] = (selected[i][0] + selected[i][1])/2
+    statistic_values = {}
+    for j, ((c, population), percentiles) in enumerate(requests):
+        i = len(medians) + j
+        order_values = dict(zip(ranks[i], selected[i]))
+        statistic_values[(c, population)] = finish_statistics(sizes[i], order_values, *sums[j],
+                                                              percentiles)
+    return counts, median_values, images, statistic_values
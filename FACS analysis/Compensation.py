@@ -1,20 +1,174 @@
 """
-This section was not used - the .fcs are compensated already
+Spillover compensation. The J-LAT .fcs files are compensated already, so
+JLAT_gating only compensates on request (see its compensation argument)
 """
+import os
+import warnings
+import numpy as np
 
-def custom_compensate(original_sample, f1=0.15, f2=0.32):
-    # Copy the original sample
+# Spillover matrix stored in the file: $SPILLOVER (FCS 3.1), $SPILL or SPILL
+# (FCS 3.0 / BD) hold "n,channel 1,...,channel n,row 1...,row n" where row i is
+# the fraction of fluorochrome i detected in each channel. Returns
+# (channels, n x n matrix) or None if the file has no such keyword
+def spillover_matrix (meta):
+    for keyword in ('$SPILLOVER', '$SPILL', 'SPILL'):
+        if keyword in meta:
+            fields = [field.strip() for field in meta[keyword].split(',')]
+            n = int(fields[0])
+            if len(fields) != 1 + n + n*n:
+                raise ValueError('Incomplete ' + keyword + ' keyword: ' + str(n) + ' channels, '
+                                 + str(len(fields) - 1 - n) + ' values')
+            channels = fields[1:n+1]
+            matrix = np.array(fields[n+1:], dtype=np.float64).reshape(n, n)
+            return channels, matrix
+    return None
+
+# Compensation to apply: None (no compensation), 'file' (the spillover keyword
+# of the file) or a user (channels, spillover matrix). Returns None or
+# (channels, compensation matrix), the compensation matrix being the inverse
+# of the spillover matrix, as float32
+def compensation_setup (meta, compensation=None):
+    if compensation is None:
+        return None
+    if isinstance(compensation, str):
+        if compensation != 'file':
+            raise ValueError('Unknown compensation: ' + repr(compensation))
+        compensation = spillover_matrix(meta)
+        if compensation is None:
+            raise ValueError('No $SPILLOVER/$SPILL keyword in the file')
+    channels, spillover = compensation
+    spillover = np.asarray(spillover, dtype=np.float64)
+    if spillover.shape != (len(channels), len(channels)):
+        raise ValueError('The spillover matrix must be ' + str(len(channels)) + ' x ' + str(len(channels)))
+    return list(channels), np.linalg.inv(spillover).astype(np.float32)
+
+# Multiply the events (n events x k channels, float32, C order) by the k x k
+# compensation matrix in place: one sgemm per block of rows, so the only
+# temporary is one block
+def compensate_events (events, matrix, block_size=2**16):
+    matrix = np.ascontiguousarray(matrix, dtype=events.dtype)
+    for start in range(0, len(events), block_size):
+        block = events[start:start+block_size]
+        block[...] = block @ matrix
+    return events
+
+# Compensate the given channels of a {channel: values} mapping (a dictionary
+# of arrays or a DataFrame): every channel of the matrix is needed. Returns a
+# dictionary with the compensated channels as contiguous float32 arrays
+def compensate_channels (data, channels, matrix, block_size=2**16):
+    n_events = len(data[channels[0]])
+    events = np.empty((n_events, len(channels)), dtype=np.float32)
+    for j, channel in enumerate(channels):
+        events[:, j] = data[channel]
+    compensate_events(events, matrix, block_size)
+    return {channel: np.ascontiguousarray(events[:, j]) for j, channel in enumerate(channels)}
+
+# The two-channel correction used to tune f1/f2 by eye: both channels are
+# computed from the uncompensated values. Returns a compensated copy of the
+# sample (the original is left untouched), without the events with NaN
+def custom_compensate (original_sample, f1=0.15, f2=0.32):
+    channels = ['GFP-A', '7AAD-A']
+    matrix = np.array([[1, -f2], [-f1, 1]], dtype=np.float32) # Columns: new GFP-A, new 7AAD-A
+    compensated = compensate_channels(original_sample.data, channels, matrix)
     new_sample = original_sample.copy()
     new_data = new_sample.data
-    original_data = original_sample.data
-
-    # Our transformation goes here
-    new_data['GFP-A'] = original_data['GFP-A'] - f1 * original_data['7AAD-A']
-    new_data['7AAD-A'] = original_data['7AAD-A'] - f2 * original_data['GFP-A']
-    new_data = new_data.dropna()  # Removes all NaN entries
-    new_sample.data = new_data
+    for channel in channels:
+        new_data[channel] = compensated[channel]
+    new_sample.data = new_data.dropna() # Removes all NaN entries
     return new_sample
 
+# Robust straight line fit y = a + b*x: iteratively reweighted least squares
+# with Huber weights (residuals scaled by their MAD), all events at once.
+# Returns intercept, slope and the final weights
+def robust_line (x, y, tuning=1.345, iterations=50, tolerance=1e-9):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    weights = np.ones(len(x))
+    intercept, slope = 0.0, 0.0
+    for iteration in range(iterations):
+        sw = weights.sum()
+        x_mean = (weights*x).sum()/sw
+        y_mean = (weights*y).sum()/sw
+        new_slope = (weights*(x - x_mean)*(y - y_mean)).sum()/(weights*(x - x_mean)**2).sum()
+        new_intercept = y_mean - new_slope*x_mean
+        residuals = y - new_intercept - new_slope*x
+        scale = 1.4826*np.median(np.abs(residuals - np.median(residuals))) or 1.0
+        weights = np.minimum(1.0, tuning*scale/np.maximum(np.abs(residuals), 1e-300))
+        converged = abs(new_slope - slope) <= tolerance*max(1.0, abs(new_slope))
+        intercept, slope = new_intercept, new_slope
+        if converged:
+            break
+    return intercept, slope, weights
+
+# Percentile bootstrap interval of the slope: every resample is refitted with
+# the robust weights of the full fit, all resamples at once (n_boot x events
+# index matrix, on at most max_events events)
+def bootstrap_slope (x, y, weights, n_boot=200, level=0.95, max_events=10000, seed=0):
+    generator = np.random.default_rng(seed)
+    if len(x) > max_events:
+        keep = generator.choice(len(x), max_events, replace=False)
+        x, y, weights = x[keep], y[keep], weights[keep]
+    index = generator.integers(0, len(x), size=(n_boot, len(x)))
+    xb, yb, wb = x[index], y[index], weights[index]
+    sw = wb.sum(axis=1, keepdims=True)
+    x_mean = (wb*xb).sum(axis=1, keepdims=True)/sw
+    y_mean = (wb*yb).sum(axis=1, keepdims=True)/sw
+    slopes = (wb*(xb - x_mean)*(yb - y_mean)).sum(axis=1)/(wb*(xb - x_mean)**2).sum(axis=1)
+    return tuple(np.quantile(slopes, [(1 - level)/2, (1 + level)/2]))
+
+# Spillover coefficients from single-stain controls (raw, uncompensated values):
+# unstained = {channel: values}, stained = {fluorochrome channel: {channel: values}}.
+# Events brighter than the percentile of the unstained control in their own
+# channel form the positive population, on which every other channel is
+# regressed against the stained one: the slope is the spillover coefficient
+# (the intercept absorbs autofluorescence). A control with fewer than
+# min_events positive events (weak or mislabelled) is not fitted: its
+# coefficients stay 0 (identity) and its rows of the table have no estimate.
+# Returns the (channels, spillover matrix) pair taken by compensation_setup and
+# a table with confidence intervals
+def spillover_from_controls (unstained, stained, channels, percentile=99.5,
+                             n_boot=200, level=0.95, seed=0, min_events=10):
+    import pandas as pd
+    spillover = np.eye(len(channels))
+    rows = []
+    for i, source in enumerate(channels):
+        if source not in stained:
+            continue
+        control = stained[source]
+        threshold = np.percentile(unstained[source], percentile)
+        positive = np.asarray(control[source]) > threshold
+        x = np.asarray(control[source], dtype=np.float64)[positive]
+        n_positive = int(positive.sum())
+        if n_positive < min_events:
+            warnings.warn('Spillover of the ' + source + ' control not estimated: ' + str(n_positive) +
+                          ' events above the unstained ' + str(percentile) + ' percentile in ' + source)
+        for j, target in enumerate(channels):
+            if j == i:
+                continue
+            if n_positive < min_events:
+                rows.append([source, target, 0.0, np.nan, np.nan, np.nan, n_positive])
+                continue
+            y = np.asarray(control[target], dtype=np.float64)[positive]
+            intercept, slope, weights = robust_line(x, y)
+            low, high = bootstrap_slope(x, y, weights, n_boot, level, seed=seed)
+            spillover[i, j] = slope
+            rows.append([source, target, slope, low, high, intercept, n_positive])
+    table = pd.DataFrame(rows, columns=['Fluorochrome', 'Detected in', 'Spillover',
+                                        'CI low', 'CI high', 'Background', 'Positive events'])
+    return (list(channels), spillover), table
+
+# Same from the four control files of data_load (same file order): the 7AAD
+# stained control gives the 7AAD spillover, the PMA control without 7AAD the GFP
+# spillover and the control without stain the positivity thresholds. The
+# double-stained PMA + 7AAD file is not needed for the fit
+def estimate_spillover (files, channels=['GFP-A', '7AAD-A'], percentile=99.5,
+                        n_boot=200, level=0.95, seed=0):
+    from FCS_reader import load_channels
+    unstained = load_channels(files[1], channels)[1]
+    stained = {'7AAD-A': load_channels(files[0], channels)[1],
+               'GFP-A': load_channels(files[2], channels)[1]}
+    return spillover_from_controls(unstained, stained, channels, percentile, n_boot, level, seed)
+
 def data_load (files):
     import FlowCytometryTools
     # Read/import the four 'control' data sets
@@ -29,7 +183,7 @@ def data_load (files):
         sample = sample.transform('hlog') 
     return samples
 
-def plot_4 (sample, channel, celltype):
+def plot_4 (sample, channel, celltype, output_dir=''):
     import matplotlib.pyplot as plt
     # General plot parameters
     plt.rcParams["figure.figsize"] = (10,10)
@@ -53,16 +207,19 @@ def plot_4 (sample, channel, celltype):
     ax4 = plt.subplot(224)
     sample[3].plot(channel, color='green', alpha=0.7, bins=100)
     plt.ylabel("")
-    plt.savefig(celltype + ' - ' + channel +'.png') #Export the figure
+    plt.savefig(os.path.join(output_dir, celltype + ' - ' + channel +'.png')) #Export the figure
     
 
 if __name__ == "__main__":
-    import os
-    dir = os.getcwd() + r'\Compensation'
-    os.chdir(dir)   # Change the working directory
-    samples = data_load (os.listdir()) # Load all files in the directory
+    dir = os.path.join(os.getcwd(), 'Compensation')
+    files = [os.path.join(dir, file_name) for file_name in os.listdir(dir)]
+    samples = data_load (files) # Load all files in the directory
+    # Estimate the spillover from the controls: the result can be passed as is
+    # to JLAT_gating(compensation=...) or analyse_everything_thus_far_v1
+    compensation, table = estimate_spillover (files)
+    print(table.to_string(index=False))
     # Visualise GFP and 7AAD channel data across 4 relevant conditions 
-    # to tune the compensation factors (f1, f2) 
-    plot_4(samples, channel='GFP-A', celltype='J-LAT') 
-    plot_4(samples, channel='7AAD-A', celltype='J-LAT')
+    # to check the compensation factors (f1, f2) 
+    plot_4(samples, channel='GFP-A', celltype='J-LAT', output_dir=dir) 
+    plot_4(samples, channel='7AAD-A', celltype='J-LAT', output_dir=dir)
     
\ No newline at end of file
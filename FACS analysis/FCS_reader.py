@@ -0,0 +1,162 @@
+"""
+Lightweight FCS 3.0/3.1 reader: parses the TEXT segment and memory-maps the
+DATA segment, so only the channels that are actually gated get loaded
+"""
+import numpy as np
+
+# Byte order keywords (FCS 3.0 allows both 16 and 32 bit notations)
+byte_orders = {'1,2,3,4': '<', '1,2': '<', '1': '<',
+               '4,3,2,1': '>', '2,1': '>'}
+
+# Read the 58 byte HEADER segment and return the segment offsets
+def read_header (file_handle):
+    file_handle.seek(0)
+    header = file_handle.read(58).decode('ascii')
+    version = header[0:6]
+    if version not in ('FCS3.0', 'FCS3.1'):
+        raise ValueError('Unsupported FCS version: ' + repr(version))
+    # Offsets are right-justified ASCII integers, blank or 0 if they do not
+    # fit in 8 characters (i.e. files larger than 99,999,999 bytes)
+    offsets = []
+    for i in range(6):
+        field = header[10+8*i:18+8*i].strip()
+        offsets.append(int(field) if field else 0)
+    return version, offsets
+
+# Split a TEXT segment into keyword/value pairs
+def parse_text (raw_text):
+    text = raw_text.decode('utf-8', errors='replace')
+    delimiter = text[0]
+    # A doubled delimiter is an escaped delimiter character inside a value
+    placeholder = '\x00'
+    fields = text[1:].replace(delimiter*2, placeholder).split(delimiter)
+    fields = [field.replace(placeholder, delimiter) for field in fields]
+    if fields[-1] == '':
+        fields = fields[:-1]
+    meta = {}
+    for i in range(0, len(fields)-1, 2):
+        meta[fields[i].strip().upper()] = fields[i+1].strip()
+    return meta
+
+# Read the complete TEXT (+ supplemental TEXT) segment of a file
+def read_meta (file_name):
+    with open(file_name, 'rb') as file_handle:
+        version, offsets = read_header(file_handle)
+        file_handle.seek(offsets[0])
+        meta = parse_text(file_handle.read(offsets[1]-offsets[0]+1))
+        # Supplemental TEXT segment
+        begin = int(meta.get('$BEGINSTEXT', 0) or 0)
+        end = int(meta.get('$ENDSTEXT', 0) or 0)
+        if begin > 0 and end > begin:
+            file_handle.seek(begin)
+            supplemental = parse_text(file_handle.read(end-begin+1))
+            for key in supplemental:
+                meta.setdefault(key, supplemental[key])
+    # DATA offsets: the keywords are 64-bit safe, the HEADER ones are not
+    data_begin = int(meta.get('$BEGINDATA', 0) or 0)
+    data_end = int(meta.get('$ENDDATA', 0) or 0)
+    if data_begin == 0 or data_end == 0:
+        data_begin = offsets[2]
+        data_end = offsets[3]
+    meta['__version__'] = version
+    meta['__data_offsets__'] = (data_begin, data_end)
+    return meta
+
+# Names of all parameters, using either $PnN (short) or $PnS (stain) names
+def channel_names (meta, naming='$PnN'):
+    names = []
+    for i in range(1, int(meta['$PAR'])+1):
+        name = meta.get('$P' + str(i) + naming[3:], '')
+        if name == '':
+            name = meta['$P' + str(i) + 'N']
+        names.append(name)
+    return names
+
+# Position (1-based, as in $Pn keywords) of a channel, looked up by $PnN then $PnS
+def channel_index (meta, channel):
+    for naming in ('$PnN', '$PnS'):
+        names = channel_names(meta, naming)
+        if channel in names:
+            return names.index(channel) + 1
+    raise KeyError('Channel ' + repr(channel) + ' not found in the FCS file')
+
+# Value range ($PnR) of a channel, used to scale the hlog transform
+def channel_range (meta, channel):
+    return float(meta['$P' + str(channel_index(meta, channel)) + 'R'])
+
+# Build the structured dtype of one event (one row of the DATA segment)
+def event_dtype (meta):
+    if meta.get('$MODE', 'L') != 'L':
+        raise ValueError('Only list mode ($MODE = L) FCS files are supported')
+    byte_order = byte_orders.get(meta['$BYTEORD'].replace(' ', ''))
+    if byte_order is None:
+        raise ValueError('Unsupported $BYTEORD: ' + meta['$BYTEORD'])
+    data_type = meta['$DATATYPE'].upper()
+    formats = []
+    for i in range(1, int(meta['$PAR'])+1):
+        bits = int(meta['$P' + str(i) + 'B'])
+        if data_type == 'F':
+            formats.append(byte_order + 'f4')
+        elif data_type == 'D':
+            formats.append(byte_order + 'f8')
+        elif data_type == 'I' and bits in (8, 16, 32, 64):
+            formats.append(byte_order + 'u' + str(bits//8))
+        else:
+            raise ValueError('Unsupported $DATATYPE/$PnB combination: ' +
+                             data_type + '/' + str(bits))
+    names = ['P' + str(i) for i in range(1, len(formats)+1)]
+    return np.dtype({'names': names, 'formats': formats})
+
+# Number of events in the DATA segment. Some instruments write $ENDDATA one
+# byte off - trust $TOT if it fits
+def event_count (meta):
+    data_begin, data_end = meta['__data_offsets__']
+    return min(int(meta['$TOT']), (data_end - data_begin + 1) // event_dtype(meta).itemsize)
+
+# Memory-map the DATA segment as a structured array of events (no data is read)
+def memmap_events (file_name, meta=None):
+    if meta is None:
+        meta = read_meta(file_name)
+    dtype = event_dtype(meta)
+    data_begin, data_end = meta['__data_offsets__']
+    n_events = event_count(meta)
+    events = np.memmap(file_name, dtype=dtype, mode='r',
+                       offset=data_begin, shape=(n_events,))
+    return meta, events
+
+# Values of one channel (for all or a slice of the events) as float32
+def channel_values (meta, events, channel):
+    i = channel_index(meta, channel)
+    column = events['P' + str(i)]
+    # Integer data: bits above the $PnR range are not part of the value
+    if column.dtype.kind == 'u':
+        value_range = int(float(meta['$P' + str(i) + 'R']))
+        bits = column.dtype.itemsize*8
+        if 0 < value_range < 2**bits:
+            mask = 2**int(np.ceil(np.log2(value_range))) - 1
+            column = column & np.array(mask, dtype=column.dtype)
+    return np.ascontiguousarray(column, dtype=np.float32)
+
+# Load only the requested channels as contiguous float32 arrays
+def load_channels (file_name, channels, meta=None):
+    meta, events = memmap_events(file_name, meta)
+    data = {}
+    for channel in channels:
+        data[channel] = channel_values(meta, events, channel)
+    del events # Release the memory map
+    return meta, data
+
+# Same as load_channels, but chunk_size events at a time: the chunks are read
+# (not memory-mapped) so only one of them is in memory, whatever the file size
+def iter_chunks (file_name, channels, chunk_size=2**20, meta=None):
+    if meta is None:
+        meta = read_meta(file_name)
+    dtype = event_dtype(meta)
+    data_begin, data_end = meta['__data_offsets__']
+    n_events = event_count(meta)
+    with open(file_name, 'rb') as file_handle:
+        file_handle.seek(data_begin)
+        for start in range(0, n_events, chunk_size):
+            chunk = np.fromfile(file_handle, dtype=dtype, count=min(chunk_size, n_events - start))
+            yield {channel: channel_values(meta, chunk, channel) for channel in channels}
+
@@ -0,0 +1,64 @@
+"""
+Headless figure rendering pool: every figure job (a plotting function of the
+figure scripts, its data and its output folder) runs in a worker process on
+the Agg backend, from the default rcParams and inside its own rc_context, so
+that figure sizes or seaborn contexts set by one job never leak into another
+(nor into the caller when the jobs run in its process), and a full figure
+refresh uses every core
+"""
+import os
+import traceback
+
+# One figure job: function_name of module (e.g. 'JLat_figures_coculture') called
+# with args and kwargs. output_dir is passed on to the function (where it saves
+# its figures), rcparams are applied on top of the defaults for this job only
+def figure_job (module, function_name, args=(), kwargs=None, output_dir=None, rcparams=None):
+    return {'module': module, 'function': function_name, 'args': tuple(args),
+            'kwargs': dict(kwargs or {}), 'output_dir': output_dir, 'rcparams': dict(rcparams or {})}
+
+# Worker start-up: no display is ever opened (set before pyplot is imported)
+def headless ():
+    import matplotlib
+    matplotlib.use('Agg')
+
+# Run one job (on the backend of the process). Returns (result, None) or
+# (None, traceback) if the job failed
+def run_figure_job (job):
+    import importlib
+    import matplotlib
+    import matplotlib.pyplot as plt
+    figures = set(plt.get_fignums()) # Figures of the caller are left open
+    try:
+        function = getattr(importlib.import_module(job['module']), job['function'])
+        kwargs = dict(job['kwargs'])
+        if job['output_dir'] is not None:
+            os.makedirs(job['output_dir'], exist_ok=True)
+            kwargs['output_dir'] = job['output_dir']
+        # Defaults and the job rcparams, all restored on exit (even on errors)
+        with matplotlib.rc_context():
+            matplotlib.rcdefaults()
+            matplotlib.rcParams.update(job['rcparams'])
+            result = function(*job['args'], **kwargs)
+        return result, None
+    except Exception:
+        return None, traceback.format_exc()
+    finally:
+        for number in set(plt.get_fignums()) - figures:
+            plt.close(number)
+
+# Render every job, with processes worker processes (None: one per core, 1: in
+# this process, on its backend, one job after another). Returns the (result,
+# error) of every job, in order; failed jobs are reported and do not stop the
+# others
+def render_figures (jobs, processes=None):
+    if processes == 1:
+        outcomes = [run_figure_job(job) for job in jobs]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        processes = min(processes or os.cpu_count() or 1, max(len(jobs), 1))
+        with ProcessPoolExecutor(max_workers=processes, initializer=headless) as pool:
+            outcomes = list(pool.map(run_figure_job, jobs))
+    for job, (result, error) in zip(jobs, outcomes):
+        if error is not None:
+            print('Figure failed: ' + job['module'] + '.' + job['function'] + '\n' + error)
+    return outcomes
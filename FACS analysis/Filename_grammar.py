@@ -0,0 +1,143 @@
+"""
+Filename grammars: the metadata hidden in the .fcs file names (cell type,
+stimulus, 7AAD, timepoint, replicate, ...) written down once per naming
+convention (NC) as compiled regular expressions, and parsed for a whole
+directory listing at a time into one table
+"""
+import re
+import string
+import numpy as np
+import pandas as pd
+
+# Every field is (column, kind, rules, default, required):
+#   'first'/'last': rules = [(regex, value), ...]; the first/last matching rule
+#                   wins (i.e. 'last' mirrors a chain of overwriting ifs)
+#   'combo':        rules = (separator, [(regex, value), ...], labels); if the
+#                   first (lead) rule matches, every matching value is joined,
+#                   otherwise the last matching value is kept. Labels rename results
+#   'replicate':    rules = (column, suffix); highest digit 1-3 directly after
+#                   the value of that column + suffix
+#   'format':       rules = template filled with the previous columns
+# Required fields that fall back to their default flag the file name
+costimuli = [('Iono', 'Iono'), ('OXA', 'OXA'), ('JQ1', 'JQ1'), ('RVX', 'RVX')]
+timepoints = ['0h', '1h', '2h', '4h', '8h', '16h', '24h', '30h', '48h']
+cell_types = [('Jurkat', 'Jurkat'), ('J-LAT', 'J-LAT')]
+
+grammars = {
+    # NC0: induction experiments (stimuli joined with '+', optional timepoint)
+    0: [('Cell type', 'last', cell_types, 'N/A', True),
+        ('Stimulus', 'combo', ('+', [('PMA', 'PMA')] + costimuli,
+                               {'PMA+Iono': 'PMA Iono '}), 'CTL', False),
+        ('7AAD', 'first', [('sans', '-')], '+', False),
+        ('Timepoint', 'last', [(time, time) for time in timepoints], '', False),
+        ('Replicate', 'replicate', ('Stimulus', ''), 1, True),
+        ('iCasp', 'first', [('Caspi', 'iCasp')], 'no iCasp', False)],
+    # NC1: same as NC0 with stimuli joined with '-' and no timepoint
+    1: [('Cell type', 'last', cell_types, 'N/A', True),
+        ('Stimulus', 'combo', ('-', [('PMA', 'PMA')] + costimuli, {}), 'CTL', False),
+        ('7AAD', 'first', [('sans', '-')], '+', False),
+        ('Timepoint', 'first', [], '', False),
+        ('Replicate', 'replicate', ('Stimulus', '-'), 1, True),
+        ('iCasp', 'first', [('Caspi', 'iCasp')], 'no iCasp', False)],
+    # NC2: co-culture experiments
+    2: [('Cell type', 'last', cell_types, 'N/A', True),
+        ('Stimulus', 'first', [('PMA', 'PMA-JQ1'), ('CTL', 'CTL')], 'Error', True),
+        ('7AAD', 'first', [('sans', '-')], '+', False),
+        ('Timepoint', 'first', [], '', False),
+        ('Donor', 'first', [('P1', 'P1'), ('P2', 'P2'), ('P3', 'P3'), ('P4', 'P4')], '', False),
+        ('Replicate', 'replicate', ('Stimulus', '-'), 0, True),
+        ('Media', 'first', [('LG', 'LG'), ('HG', 'HG')], 'RPMI', False),
+        ('Insert type', 'first', [('insert5| 5', '5 um'), ('04 ', '0.4 um')], '', False),
+        ('Med+Fil', 'format', '{Media} {Donor}({Insert type})', '', False)],
+    # NC3: reinduction experiments
+    3: [('Cell type', 'last', cell_types, 'N/A', True),
+        ('Stimulus', 'first', [('CTL-PMA', 'CTL-PMA'), ('PMA-CTL', 'PMA-CTL'),
+                               ('PMA-PMA', 'PMA-PMA'), ('CTL', 'CTL'), ('PMA', 'PMA')],
+         'Error', True),
+        ('7AAD', 'first', [('sans', '-')], '+', False),
+        ('Timepoint', 'first', [], '', False),
+        ('Replicate', 'replicate', ('Stimulus', '-'), 1, True)]}
+
+# Compile every rule once (at import), not once per file
+def compile_rules (rules):
+    return [(re.compile(pattern), value) for pattern, value in rules]
+
+def compile_grammar (fields):
+    compiled = []
+    for column, kind, rules, default, required in fields:
+        if kind in ('first', 'last'):
+            rules = compile_rules(rules)
+        elif kind == 'combo':
+            rules = (rules[0], compile_rules(rules[1]), rules[2])
+        compiled.append((column, kind, rules, default, required))
+    return compiled
+
+compiled_grammars = {nc: compile_grammar(grammars[nc]) for nc in grammars}
+
+# Which names match each rule: one boolean array per rule
+def rule_hits (names, rules):
+    return [names.str.contains(pattern).to_numpy(dtype=bool) for pattern, value in rules]
+
+def pick (hits, values, default, n):
+    if len(hits) == 0:
+        return np.full(n, default, dtype=object)
+    return np.select(hits, np.array(values, dtype=object), default).astype(object)
+
+# Parse a list of file names with the grammar of one naming convention.
+# Returns the metadata table (one row per name, in order) and the flagged
+# names with the required fields that could not be read from them
+def parse_file_names (file_names, naming_convention):
+    names = pd.Series(list(file_names), dtype=object)
+    n = len(names)
+    columns = {}
+    missing = np.full(n, '', dtype=object)
+    for column, kind, rules, default, required in compiled_grammars[naming_convention]:
+        matched = np.ones(n, dtype=bool)
+        if kind in ('first', 'last'):
+            hits = rule_hits(names, rules)
+            values = [value for pattern, value in rules]
+            if kind == 'last':
+                hits, values = hits[::-1], values[::-1]
+            column_values = pick(hits, values, default, n)
+            matched = np.logical_or.reduce(hits) if hits else np.zeros(n, dtype=bool)
+        elif kind == 'combo':
+            separator, parts, labels = rules
+            hits = rule_hits(names, parts)
+            joined = np.full(n, parts[0][1], dtype=object)
+            for hit, (pattern, value) in zip(hits[1:], parts[1:]):
+                joined = np.where(hit, joined + separator + value, joined)
+            last = pick(hits[1:][::-1], [value for pattern, value in parts[1:]][::-1], default, n)
+            column_values = np.where(hits[0], joined, last)
+            column_values = pd.Series(column_values, dtype=object).replace(labels).to_numpy()
+            matched = np.logical_or.reduce(hits)
+        elif kind == 'replicate':
+            prefixes = columns[rules[0]] + rules[1]
+            column_values = np.full(n, default, dtype=np.int64)
+            matched = np.zeros(n, dtype=bool)
+            for prefix in pd.unique(prefixes):
+                rows = np.flatnonzero(prefixes == prefix)
+                subset = names.iloc[rows]
+                for replicate in (1, 2, 3):
+                    hit = subset.str.contains(re.escape(prefix + str(replicate))).to_numpy(dtype=bool)
+                    column_values[rows[hit]] = replicate
+                    matched[rows[hit]] = True
+        elif kind == 'format':
+            column_values = np.full(n, '', dtype=object)
+            for literal, field, spec, conversion in string.Formatter().parse(rules):
+                column_values = column_values + literal
+                if field is not None:
+                    column_values = column_values + columns[field]
+        if required:
+            missing = np.where(matched, missing, missing + column + ', ')
+        columns[column] = column_values
+    metadata = pd.DataFrame(columns)
+    flagged = missing != ''
+    unparsed = pd.Series([text[:-2] for text in missing[flagged]],
+                         index=names[flagged].to_numpy(), dtype=object)
+    return metadata, unparsed
+
+# Print the file names that did not fit the naming convention
+def report_unparsed (unparsed, naming_convention):
+    for file_name, fields in unparsed.items():
+        print('Unparseable file name (NC' + str(naming_convention) + '): '
+              + file_name + ' [missing: ' + fields + ']')
@@ -0,0 +1,174 @@
+"""
+Watch mode for acquisition days: the experiment folders are polled and only
+the .fcs files that are new or changed (mtime, size) since the last pass are
+gated. A manifest per folder keeps the result row of every processed file and
+the folder summary, so folder and experiment summaries are rebuilt without
+gating or plotting anything that did not change
+"""
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+import JLat_data_gating as jlat
+from Result_table import concat_frames, export_table
+from Filename_grammar import parse_file_names, report_unparsed
+
+manifest_name = 'Gating manifest.json'
+
+# Everything the result rows depend on (see JLat_data_gating.gating_settings):
+# rows gated with other settings are stale
+def settings_digest (gating_kwargs):
+    settings = json.dumps(jlat.gating_settings(gating_kwargs), sort_keys=True, default=str)
+    return hashlib.sha256(settings.encode('utf-8')).hexdigest()
+
+# numpy scalars in result rows -> JSON
+def json_value (value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Not JSON serialisable: ' + repr(value))
+
+# Manifest: {'settings': digest, 'files': {file name: {'stat': [mtime_ns, size],
+# 'row' or 'error'}}, 'summary': folder summary records}
+def load_manifest (folder_path, digest):
+    try:
+        with open(os.path.join(folder_path, manifest_name)) as file_handle:
+            manifest = json.load(file_handle)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+    if manifest.get('settings') != digest:
+        manifest = {'settings': digest, 'files': {}, 'summary': []}
+    return manifest
+
+def save_manifest (folder_path, manifest):
+    path = os.path.join(folder_path, manifest_name)
+    temporary = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temporary, 'w') as file_handle:
+        json.dump(manifest, file_handle, default=json_value)
+    os.replace(temporary, path)
+
+# New/changed files that have not been modified for settle seconds (i.e. are
+# no longer being written by the cytometer), and files that disappeared; a day
+# folder that has not been created yet is empty
+def scan_folder (folder_path, files, settle=10):
+    now = time.time()
+    listing = {}
+    try:
+        entries = list(os.scandir(folder_path))
+    except FileNotFoundError:
+        entries = []
+    for entry in entries:
+        if entry.is_file() and '.fcs' in entry.name:
+            status = entry.stat()
+            listing[entry.name] = [status.st_mtime_ns, status.st_size]
+    pending = [file_name for file_name in sorted(listing)
+               if (file_name not in files or files[file_name]['stat'] != listing[file_name])
+               and now - listing[file_name][0]/1e9 >= settle]
+    removed = [file_name for file_name in files if file_name not in listing]
+    return listing, pending, removed
+
+# Gate the pending files of one folder and refresh its summary (spreadsheet and
+# figures, see JLat_data_gating.folder_analysis) if anything changed.
+# Returns the folder summary (or None if nothing was gated yet) and whether it changed
+def update_folder (folder_path, folder, folder_tag, naming_convention, hue, gating_kwargs,
+                   pool=None, cache_dir=None, cache_size=2**30, settle=10, store=False):
+    gating_kwargs = dict(gating_kwargs, naming_convention=naming_convention)
+    manifest = load_manifest(folder_path, settings_digest(gating_kwargs))
+    files = manifest['files']
+    listing, pending, removed = scan_folder(folder_path, files, settle)
+    for file_name in removed:
+        del files[file_name]
+    if pending:
+        name_table, unparsed = parse_file_names(pending, naming_convention)
+        report_unparsed(unparsed, naming_convention)
+        tasks = []
+        for i in range(len(pending)):
+            file_kwargs = dict(gating_kwargs, metadata=name_table.iloc[[i]],
+                               store_file=jlat.store_name(pending[i]) if store else None)
+            if pool is None:
+                tasks.append(jlat.gate_file(folder_path, pending[i], file_kwargs,
+                                            cache_dir, cache_size))
+            else:
+                tasks.append(pool.submit(jlat.gate_file, folder_path, pending[i], file_kwargs,
+                                         cache_dir, cache_size))
+        for file_name, task in zip(pending, tasks):
+            df, error = task if pool is None else task.result()
+            # The stat from before gating: a file still growing is picked up again
+            entry = {'stat': listing[file_name]}
+            if error is None:
+                entry['row'] = df.iloc[0].to_dict()
+            else:
+                print('Gating failed: ' + folder + '\\' + file_name + '\n' + error)
+                entry['error'] = error
+            files[file_name] = entry
+    changed = len(pending) > 0 or len(removed) > 0
+    rows = [files[file_name]['row'] for file_name in sorted(files) if 'row' in files[file_name]]
+    if changed:
+        manifest['summary'] = []
+        if rows:
+            summary = jlat.folder_analysis(pd.DataFrame(rows), hue=hue, folder=folder,
+                                           output_dir=folder_path)
+            summary.insert(loc = 5, column = 'Folder tag', value = folder_tag)
+            manifest['summary'] = summary.to_dict('records')
+        if os.path.isdir(folder_path): # Not if the folder was removed
+            save_manifest(folder_path, manifest)
+    if not manifest['summary']:
+        return None, changed
+    return pd.DataFrame(manifest['summary']), changed
+
+# One pass over the folders of an experiment; the Experiment Summary is only
+# rewritten if one of its folders changed
+def update_experiment (dir, folders_subset, experiment, naming_convention, gating_kwargs,
+                       pool=None, cache_dir=None, cache_size=2**30, settle=10, store=False):
+    hue = jlat.experiment_hue(experiment)
+    summaries = []
+    changed = False
+    for k in range(len(folders_subset)):
+        summary, folder_changed = update_folder(dir + folders_subset[k], folders_subset[k], k,
+                                                naming_convention, hue, gating_kwargs,
+                                                pool, cache_dir, cache_size, settle, store)
+        changed = changed or folder_changed
+        if summary is not None:
+            summaries.append(summary)
+    if changed and summaries:
+        export_table(concat_frames(summaries),
+                     os.path.join(dir, jlat.summary_name(folders_subset, experiment)))
+    return changed
+
+# Poll the experiment folders every interval seconds (passes=None: until
+# interrupted). Same experiment/folder/skip lists and gating options as
+# JLat_data_gating.analyse_everything_thus_far_v1
+def watch_experiments (dir = r'C:\FACS folder directory', experiments=jlat.experiments,
+                       folders=jlat.folders, interval=30, settle=10, passes=None,
+                       export=True, processes=1, cache_dir=None, cache_size=2**30,
+                       chunk_size=None, compensation=None, strategy_file=None, store=False):
+    gating_kwargs = {'alpha': 0.5, 'point_size': 2, 'verbose': False, 'export': export,
+                     'chunk_size': chunk_size, 'compensation': compensation,
+                     'strategy_file': strategy_file}
+    pool = None
+    if processes != 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=processes)
+    try:
+        n_passes = 0
+        while passes is None or n_passes < passes:
+            naming_convention = None
+            for i in range(len(experiments)):
+                naming_convention = jlat.experiment_convention(i, naming_convention)
+                if i in jlat.skips:
+                    continue
+                if update_experiment(dir, folders[i], experiments[i], naming_convention,
+                                     gating_kwargs, pool, cache_dir, cache_size, settle, store):
+                    print('Updated: ' + experiments[i])
+            n_passes = n_passes + 1
+            if passes is None or n_passes < passes:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+if __name__ == "__main__":
+    watch_experiments()
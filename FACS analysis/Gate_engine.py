@@ -0,0 +1,160 @@
+"""
+Vectorised gate engine: gates are evaluated as NumPy boolean masks over the
+event arrays and combined with '&', so no gated copies of the events are made
+"""
+import numpy as np
+
+# Gate definitions are plain dictionaries so they can be stored/compared easily.
+# parent: name of the gate the events must pass first (None = all events)
+def poly_gate (name, channels, vertices, parent=None):
+    return {'name': name, 'type': 'poly', 'channels': list(channels),
+            'vert': [tuple(float(v) for v in vertex) for vertex in vertices],
+            'parent': parent}
+
+def threshold_gate (name, channel, threshold, region='above', parent=None):
+    return {'name': name, 'type': 'threshold', 'channels': [channel],
+            'vert': float(threshold), 'region': region, 'parent': parent}
+
+# Even-odd point-in-polygon test, vectorised over events (one loop per edge)
+def poly_mask (x, y, vertices):
+    vertices = np.asarray(vertices, dtype=float)
+    inside = np.zeros(len(x), dtype=bool)
+    # Events outside the bounding box can never be inside the polygon
+    box = ((x >= vertices[:, 0].min()) & (x <= vertices[:, 0].max()) &
+           (y >= vertices[:, 1].min()) & (y <= vertices[:, 1].max()))
+    index = np.flatnonzero(box)
+    x = x[index]
+    y = y[index]
+    hits = np.zeros(len(index), dtype=bool)
+    x0, y0 = vertices[-1]
+    for x1, y1 in vertices:
+        # Edges that straddle the horizontal line through each event
+        crosses = (y1 > y) != (y0 > y)
+        if y0 != y1:
+            x_cross = x1 + (y - y1)*(x0 - x1)/(y0 - y1)
+            hits ^= crosses & (x < x_cross)
+        x0, y0 = x1, y1
+    inside[index] = hits
+    return inside
+
+# Same conventions as FlowCytometryTools.ThresholdGate ('above' includes the threshold)
+def threshold_mask (x, threshold, region='above'):
+    above = x >= threshold
+    if region == 'below':
+        return ~above
+    return above
+
+# Evaluate a single gate on all events
+def gate_mask (events, gate):
+    channels = gate['channels']
+    if gate['type'] == 'poly':
+        return poly_mask(events[channels[0]], events[channels[1]], gate['vert'])
+    elif gate['type'] == 'threshold':
+        return threshold_mask(events[channels[0]], gate['vert'], gate['region'])
+    raise ValueError('Unknown gate type: ' + repr(gate['type']))
+
+# Gating strategies as a DAG: every gate names its parent, several gates can
+# share a parent, and a strategy is a path of gates plus the columns it reports.
+# Gates in parent-before-child order (raises ValueError for unknown parents,
+# duplicate names or cycles)
+def gate_order (gates):
+    by_name = {}
+    for gate in gates:
+        if gate['name'] in by_name:
+            raise ValueError('Duplicate gate name: ' + repr(gate['name']))
+        by_name[gate['name']] = gate
+    ordered = []
+    placed = set()
+    for gate in gates:
+        lineage = []
+        while gate is not None and gate['name'] not in placed:
+            if gate['name'] in [ancestor['name'] for ancestor in lineage]:
+                raise ValueError('Gate cycle through ' + repr(gate['name']))
+            lineage.append(gate)
+            parent = gate.get('parent')
+            if parent is not None and parent not in by_name:
+                raise ValueError('Unknown parent gate ' + repr(parent) + ' of ' + repr(gate['name']))
+            gate = by_name.get(parent)
+        for gate in reversed(lineage):
+            ordered.append(gate)
+            placed.add(gate['name'])
+    return ordered
+
+# Evaluate every gate (or only the named ones and their ancestors) once: a mask
+# is its parent mask & its own gate, so shared parents are computed a single time.
+# Returns {name: mask} and {name: count}, the count of all events under None.
+# profile: optional Stage_timer profile, one lap per gate
+def gate_dag (events, gates, names=None, profile=None):
+    by_name = {gate['name']: gate for gate in gates}
+    if names is not None:
+        needed = set()
+        for name in names:
+            while name is not None and name not in needed:
+                needed.add(name)
+                name = by_name[name].get('parent')
+        gates = [gate for gate in gates if gate['name'] in needed]
+    n_events = len(next(iter(events.values())))
+    masks = {}
+    counts = {None: n_events}
+    for gate in gate_order(gates):
+        mask = gate_mask(events, gate)
+        if gate.get('parent') is not None:
+            mask &= masks[gate['parent']]
+        masks[gate['name']] = mask
+        counts[gate['name']] = int(np.count_nonzero(mask))
+        if profile is not None:
+            from Stage_timer import lap
+            lap(profile, 'gate: ' + gate['name'])
+    return masks, counts
+
+# Read a strategy file (JSON): {"gates": [{"name", "parent", "type": "poly",
+# "channels", "vertices"} or {"name", "parent", "type": "threshold", "channel",
+# "threshold", "region"}, ...], "strategies": [{"name", "gates", "percent_columns",
+# "count_columns", "medians": [{"channel", "population", "column"}], "statistics":
+# {"channels", "populations", "percentiles"}}, ...]} (statistics: optional, see
+# Population_stats.py). Gates may also carry display settings (e.g. "label_xy"), which are kept
+def load_strategies (file_name):
+    import json
+    with open(file_name) as file_handle:
+        config = json.load(file_handle)
+    gates = []
+    for entry in config['gates']:
+        if entry['type'] == 'poly':
+            gate = poly_gate(entry['name'], entry['channels'], entry['vertices'], entry.get('parent'))
+        elif entry['type'] == 'threshold':
+            gate = threshold_gate(entry['name'], entry['channel'], entry['threshold'],
+                                  entry.get('region', 'above'), entry.get('parent'))
+        else:
+            raise ValueError('Unknown gate type: ' + repr(entry['type']))
+        for key in entry:
+            if key not in ('name', 'type', 'parent', 'channel', 'channels',
+                           'vertices', 'threshold', 'region'):
+                gate[key] = entry[key]
+        gates.append(gate)
+    gate_order(gates)
+    names = [gate['name'] for gate in gates]
+    for strategy in config['strategies']:
+        used = (strategy['gates'] + [median['population'] for median in strategy.get('medians', [])] +
+                strategy.get('statistics', {}).get('populations', []))
+        for name in used:
+            if name is not None and name not in names:
+                raise ValueError('Strategy ' + repr(strategy['name']) + ' uses unknown gate ' + repr(name))
+    return gates, config['strategies']
+
+# Result columns of one strategy: % of each gate relative to its parent,
+# event counts, medians ({(channel, population): value}) and population
+# statistics ({(channel, population): {statistic: value}})
+def strategy_results (strategy, gates, counts, medians, statistics=None):
+    by_name = {gate['name']: gate for gate in gates}
+    results = []
+    for name, column in zip(strategy['gates'], strategy['percent_columns']):
+        parent_count = counts[by_name[name].get('parent')]
+        results.append((column, round(counts[name]/parent_count*100, 2) if parent_count else np.nan))
+    for name, column in zip(strategy['gates'], strategy['count_columns']):
+        results.append((column, counts[name]))
+    for median in strategy.get('medians', []):
+        results.append((median['column'], medians[(median['channel'], median['population'])]))
+    if strategy.get('statistics'):
+        from Population_stats import statistic_results
+        results.extend(statistic_results(strategy['statistics'], statistics))
+    return results
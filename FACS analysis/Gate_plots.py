@@ -0,0 +1,54 @@
+"""
+Gate figures drawn from 2D histograms (density rasters) instead of one
+marker per event, so the drawing cost depends on the number of pixels only
+"""
+import numpy as np
+
+# Panel settings of a gate from the "panel" block of its strategy file entry:
+# channels drawn (x, y), axis limits, ticks ([first, last, step]), colour and
+# label, plus the gate's label_xy. Missing settings default to the gate
+# channels (vs. FSC-A for a threshold), the whole hlog scale, automatic ticks
+# and the gate name
+def gate_panel (gate, limits=(-500, 10000)):
+    panel = gate.get('panel', {})
+    channels = panel.get('channels')
+    if channels is None:
+        channels = gate['channels'] if len(gate['channels']) == 2 else [gate['channels'][0], 'FSC-A']
+    xlim = panel.get('xlim', list(limits))
+    ylim = panel.get('ylim', list(limits))
+    ticks = [None if panel.get(axis) is None else
+             np.arange(panel[axis][0], panel[axis][1] + 1, panel[axis][2]) for axis in ('xticks', 'yticks')]
+    label_xy = gate.get('label_xy', [xlim[0] + 0.05*(xlim[1] - xlim[0]), ylim[1] - 0.15*(ylim[1] - ylim[0])])
+    return {'channels': list(channels), 'xlim': xlim, 'ylim': ylim, 'xticks': ticks[0],
+            'yticks': ticks[1], 'color': panel.get('color', 'black'),
+            'label': panel.get('label', gate['name']), 'label_xy': label_xy}
+
+# Count events on a regular bins x bins grid spanning the axis limits
+def density_raster (x, y, xlim, ylim, bins=300):
+    ix = np.floor((x - xlim[0]) * (bins / (xlim[1] - xlim[0]))).astype(np.int64)
+    iy = np.floor((y - ylim[0]) * (bins / (ylim[1] - ylim[0]))).astype(np.int64)
+    # Events outside the plotted window are not drawn anyway
+    inside = (ix >= 0) & (ix < bins) & (iy >= 0) & (iy < bins)
+    counts = np.bincount(ix[inside]*bins + iy[inside], minlength=bins*bins)
+    return counts.reshape(bins, bins)
+
+# Draw a density raster: empty bins are transparent, the others are shaded
+# from a pale to the full colour on a log scale
+def plot_density (ax, raster, xlim, ylim, color='black'):
+    from matplotlib.colors import LinearSegmentedColormap
+    colormap = LinearSegmentedColormap.from_list('density', ['#e8e8e8', color])
+    colormap.set_bad(alpha=0)
+    image = np.ma.masked_equal(raster.T, 0)
+    ax.imshow(np.ma.log10(image), origin='lower', cmap=colormap,
+              extent=(xlim[0], xlim[1], ylim[0], ylim[1]),
+              aspect='auto', interpolation='nearest')
+
+# Overlay a gate (see Gate_engine) on a channel_x vs channel_y panel
+def plot_gate_outline (ax, gate, channel_pair, color='red'):
+    if gate['type'] == 'poly':
+        vertices = gate['vert'] + gate['vert'][0:1] # Close the polygon
+        ax.plot([v[0] for v in vertices], [v[1] for v in vertices], color=color)
+    elif gate['channels'][0] == channel_pair[0]:
+        ax.axvline(gate['vert'], color=color)
+    else:
+        ax.axhline(gate['vert'], color=color)
@@ -0,0 +1,141 @@
+"""
+Gate store: per-file gate membership as packed bitsets (one bit per event and
+gate) next to the hlog-transformed channels, in one memory-mappable file, so
+that new population statistics and back-gating overlays are computed without
+reading and gating the .fcs file again
+"""
+import os
+import json
+import numpy as np
+
+store_magic = b'GATESTORE1\n'
+alignment = 64
+
+# Header (JSON) + one block per column/bitset, each aligned to 64 bytes:
+# columns are dtype[n_events], bitsets uint8[ceil(n_events/8)] (little bit order)
+def store_layout (n_events, channels, gate_names, dtype=np.float32):
+    blocks = [('column', channel, np.dtype(dtype).str, n_events*np.dtype(dtype).itemsize)
+              for channel in channels]
+    blocks += [('bits', name, '|u1', (n_events + 7)//8) for name in gate_names]
+    return blocks
+
+def aligned (offset):
+    return (offset + alignment - 1)//alignment*alignment
+
+# Create the store file and return it opened for writing (see fill_store).
+# info: anything JSON-serialisable describing how the events were gated
+def create_store (path, n_events, channels, gate_names, info=None, dtype=np.float32):
+    blocks = store_layout(n_events, channels, gate_names, dtype)
+    # The header lists the block offsets, so its size is measured with
+    # placeholder offsets at least as long as the real ones
+    placeholder = [[kind, name, block_dtype, 10**18] for kind, name, block_dtype, size in blocks]
+    header = {'n_events': int(n_events), 'info': info or {}, 'blocks': placeholder}
+    offset = aligned(len(store_magic) + 8 + len(json.dumps(header).encode('utf-8')))
+    header['blocks'] = []
+    for kind, name, block_dtype, size in blocks:
+        header['blocks'].append([kind, name, block_dtype, offset])
+        offset = aligned(offset + size)
+    text = json.dumps(header).encode('utf-8')
+    temporary = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temporary, 'wb') as file_handle:
+        file_handle.write(store_magic + np.uint64(len(text)).tobytes() + text)
+        file_handle.truncate(offset)
+    store = map_store(temporary, 'r+')
+    store['path'] = path
+    store['temporary'] = temporary
+    return store
+
+# Write the events start:start+n of a chunk ({channel: values}, {gate: mask});
+# start must be a multiple of 8 so that the chunk begins on a byte of the bitsets
+def fill_store (store, start, events, masks):
+    if start % 8:
+        raise ValueError('Chunks must start at a multiple of 8 events')
+    for channel, column in store['columns'].items():
+        values = events[channel]
+        column[start:start + len(values)] = values
+    for name, bits in store['bits'].items():
+        packed = np.packbits(masks[name], bitorder='little')
+        bits[start//8:start//8 + len(packed)] = packed
+
+# Flush the written store and move it in place (readers never see a partial file)
+def close_store (store):
+    for array in list(store['columns'].values()) + list(store['bits'].values()):
+        array.flush()
+    temporary, path = store['temporary'], store['path']
+    store.clear()
+    os.replace(temporary, path)
+
+# Whole-file helper: events {channel: values} and masks {gate: mask} in memory
+def write_store (path, events, masks, info=None, dtype=np.float32):
+    channels = list(events)
+    gate_names = [name for name in masks if name is not None]
+    n_events = len(events[channels[0]])
+    store = create_store(path, n_events, channels, gate_names, info, dtype)
+    fill_store(store, 0, events, masks)
+    close_store(store)
+
+def map_store (path, mode='r'):
+    with open(path, 'rb') as file_handle:
+        if file_handle.read(len(store_magic)) != store_magic:
+            raise ValueError('Not a gate store: ' + path)
+        length = int(np.frombuffer(file_handle.read(8), dtype=np.uint64)[0])
+        header = json.loads(file_handle.read(length).decode('utf-8'))
+    n_events = header['n_events']
+    store = {'n_events': n_events, 'info': header['info'], 'columns': {}, 'bits': {}}
+    for kind, name, block_dtype, offset in header['blocks']:
+        if kind == 'column':
+            store['columns'][name] = np.memmap(path, dtype=block_dtype, mode=mode,
+                                               offset=offset, shape=(n_events,))
+        else:
+            store['bits'][name] = np.memmap(path, dtype=np.uint8, mode=mode,
+                                            offset=offset, shape=((n_events + 7)//8,))
+    return store
+
+# Open a store read-only: {'n_events', 'info', 'columns': {channel: memmap},
+# 'bits': {gate: memmap}}. Nothing is read until the arrays are used
+def open_store (path):
+    return map_store(path, 'r')
+
+# Packed bits of a population, or of several combined with & (e.g. a
+# population of one strategy within a gate of another)
+def population_bits (store, population):
+    names = [population] if isinstance(population, str) else list(population)
+    bits = np.array(store['bits'][names[0]])
+    for name in names[1:]:
+        bits &= store['bits'][name]
+    return bits
+
+# Boolean mask of a population (None = all events)
+def population_mask (store, population):
+    if population is None:
+        return np.ones(store['n_events'], dtype=bool)
+    return np.unpackbits(population_bits(store, population), count=store['n_events'],
+                         bitorder='little').view(bool)
+
+# Event count of a population, straight from the packed bits
+bit_counts = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.int64)
+def population_count (store, population):
+    if population is None:
+        return store['n_events']
+    return int(bit_counts[population_bits(store, population)].sum())
+
+# Values of a channel within a population (hlog scale)
+def population_values (store, channel, population):
+    return np.asarray(store['columns'][channel])[population_mask(store, population)]
+
+# Any statistic of a channel within a population, e.g. the GFP MFI of singlets:
+# population_statistic(store, 'GFP-A', 'Single cells [2]')
+def population_statistic (store, channel, population, statistic=np.median):
+    values = population_values(store, channel, population)
+    if len(values) == 0:
+        return np.nan
+    return float(statistic(values))
+
+# Back-gating overlay: density raster (see Gate_plots) of a population on any
+# channel pair, e.g. where the GFP+ cells sit on the FSC-A/SSC-A plot
+def backgate_raster (store, population, channel_pair, xlim, ylim, bins=300):
+    from Gate_plots import density_raster
+    mask = population_mask(store, population)
+    return density_raster(np.asarray(store['columns'][channel_pair[0]])[mask],
+                          np.asarray(store['columns'][channel_pair[1]])[mask],
+                          xlim, ylim, bins)
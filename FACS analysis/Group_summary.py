@@ -0,0 +1,98 @@
+"""
+Grouped summary of the result rows for the bar plots: mean, SD, SEM and
+confidence interval of every metric in every group, computed once (all the
+metrics and bootstrap resamples of a group at once) and cached, so that every
+panel of a figure and both Jurkat variants are drawn from the same table
+instead of seaborn re-aggregating and bootstrapping the rows for each bar
+"""
+import hashlib
+import numpy as np
+import pandas as pd
+
+summary_cache = {}
+cache_entries = 32
+
+# Mean confidence intervals: 'bootstrap' (percentile interval of n_boot resampled
+# means, as seaborn's default errorbar=('ci', 95)) or 'analytic' (Student t)
+def confidence_intervals (values, confidence=0.95, ci='bootstrap', n_boot=1000, seed=0):
+    present = ~np.isnan(values)
+    n = present.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(present, values, 0).sum(axis=0)/n
+        if ci == 'analytic':
+            from scipy import stats
+            sd = np.sqrt(np.nansum((values - mean)**2, axis=0)/(n - 1))
+            half = stats.t.ppf((1 + confidence)/2, n - 1)*sd/np.sqrt(n)
+            return mean - half, mean + half
+        if ci != 'bootstrap':
+            raise ValueError('Unknown confidence interval: ' + repr(ci))
+        # Every resample of every metric in one go: n_boot x rows index draws, and
+        # the missing values of a metric are left out of its resampled means
+        rng = np.random.default_rng(seed)
+        draws = rng.integers(0, len(values), (n_boot, len(values)))
+        sums = np.where(present, values, 0)[draws].sum(axis=1)
+        means = sums/present[draws].sum(axis=1)
+        tail = (1 - confidence)/2*100
+        low, high = np.nanpercentile(means, [tail, 100 - tail], axis=0)
+    return low, high
+
+# Digest of the rows a summary depends on (cache key)
+def table_digest (table, columns):
+    hashes = pd.util.hash_pandas_object(table[columns], index=False).to_numpy()
+    return hashlib.sha256(hashes.tobytes() + repr(columns).encode('utf-8')).hexdigest()
+
+# Summary of metrics per group of the by columns (groups in order of
+# appearance): one row per group, columns (metric, statistic) with statistic in
+# n, mean, sd, sem, ci_low, ci_high
+def group_summary (table, by, metrics, confidence=0.95, ci='bootstrap', n_boot=1000, seed=0):
+    by = list(by)
+    metrics = list(metrics)
+    key = (table_digest(table, by + metrics), confidence, ci, n_boot, seed)
+    if key in summary_cache:
+        return summary_cache[key]
+    values = table[metrics].to_numpy(dtype=float)
+    groups = table.groupby(by, sort=False, dropna=False).indices
+    statistics = ['n', 'mean', 'sd', 'sem', 'ci_low', 'ci_high']
+    rows = []
+    for group, index in groups.items():
+        group_values = values[index]
+        n = (~np.isnan(group_values)).sum(axis=0)
+        # Missing values (e.g. no event in a population) are left out per metric
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(group_values, axis=0)/n
+            sd = np.sqrt(np.nansum((group_values - mean)**2, axis=0)/(n - 1))
+            sem = sd/np.sqrt(n)
+        low, high = confidence_intervals(group_values, confidence, ci, n_boot, seed)
+        rows.append(np.column_stack([n, mean, sd, sem, low, high]).ravel())
+    index = pd.MultiIndex.from_tuples([group if isinstance(group, tuple) else (group,)
+                                       for group in groups], names=by)
+    columns = pd.MultiIndex.from_product([metrics, statistics], names=['Metric', 'Statistic'])
+    summary = pd.DataFrame(rows, index=index, columns=columns)
+    summary_cache[key] = summary
+    while len(summary_cache) > cache_entries: # Oldest first
+        del summary_cache[next(iter(summary_cache))]
+    return summary
+
+# Bar plot of one metric from a group summary (as seaborn's barplot: categories
+# in order of appearance, hue levels dodged within the 0.8 wide slot of each
+# category, error bars = confidence interval)
+def summary_barplot (ax, summary, metric, x, hue=None):
+    import matplotlib
+    frame = summary[metric].reset_index()
+    x_levels = list(pd.unique(frame[x]))
+    hue_levels = list(pd.unique(frame[hue])) if hue else [None]
+    width = 0.8/len(hue_levels)
+    for j, level in enumerate(hue_levels):
+        rows = frame if hue is None else frame[frame[hue] == level]
+        positions = np.array([x_levels.index(value) for value in rows[x]]) - 0.4 + width*(j + 0.5)
+        color = 'C' + str(j % 10)
+        ax.bar(positions, rows['mean'], width=width, color=color,
+               label=None if hue is None else str(level))
+        ax.vlines(positions, rows['ci_low'], rows['ci_high'], color='.26',
+                  linewidth=1.5*matplotlib.rcParams['lines.linewidth'])
+    ax.set_xticks(range(len(x_levels)))
+    ax.set_xticklabels(x_levels)
+    ax.set_xlim(-0.5, len(x_levels) - 0.5)
+    if hue is not None:
+        ax.legend(title=hue)
+    return ax
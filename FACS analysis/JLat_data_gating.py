@@ -1,379 +1,230 @@
 import os
 import numpy as np
 import pandas as pd
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Shared modules
+from Result_table import result_table, table_append, table_frame, export_table
+from FCS_reader import read_meta, load_channels, channel_range
+from Compensation import compensation_setup, compensate_channels
+from Hlog_transform import hlog_lookup
+from Gate_engine import load_strategies, gate_dag, strategy_results
+from Population_stats import statistic_requests, population_statistics
+from Result_cache import cache_key, cache_load, cache_store
+from Stage_timer import start_profile, lap, write_profile, read_profile_log, profile_summary
+from Filename_grammar import grammars, parse_file_names, report_unparsed
 
-# Several ways metadata was added to the file name (e.g. cell type or stimulus) 
-# The first two naming conventions (NC) are identical if there are no replicates
-# Separate NC3 and NC4 were made for co-culture and reinduction experiments 
+# Several ways metadata was added to the file name (e.g. cell type or stimulus):
+# one grammar per naming convention (NC), see Filename_grammar.py
 
-def metadata_read_NC0 (file_name):
-    # What cell type?
-    if 'Jurkat' in file_name:
-        cell_type = 'Jurkat'
-    if 'J-LAT' in file_name:
-        cell_type = 'J-LAT'
-    # 7-AAD or PBS?
-    if 'sans' in file_name:
-        AAD = '-'
-    else:
-        AAD = '+'
-    # What stimuli?
-    costimuli = ['Iono', 'OXA', 'JQ1', 'RVX']
-    stimulation = 'N/A'
-    if 'PMA' in file_name:
-        stimulation = 'PMA'
-        for costimulus in costimuli:
-            if costimulus in file_name:
-                stimulation = stimulation + '+' + costimulus
-    else:
-        for costimulus in costimuli:
-            if costimulus in file_name:
-                stimulation = costimulus
-    # What timepoint?
-    timepoints = ['0h', '1h', '2h', '4h', '8h', '16h', '24h', '30h', '48h']
-    timepoint = ''
-    for time in timepoints:
-        if time in file_name:
-            timepoint = time
-    # What replicate?
-    if stimulation == 'PMA+Iono': 
-        stimulation = 'PMA Iono '
-    if stimulation == 'N/A': 
-        stimulation = 'CTL'
-    replicates = [stimulation+'1', stimulation+'2', stimulation+'3']
-    replicate = 1
-    for i in range (3):
-        if replicates [i] in file_name:
-            replicate = i+1
-    # Restore the Stimulation title
-    if stimulation == 'PMA Iono': 
-        stimulation = 'PMA+Iono '
-    # Caspase inhibitor?
-    iCasp = 'no iCasp'
-    if 'Caspi' in file_name:
-        iCasp = 'iCasp'
-    # Collate and return the data
-    df = pd.DataFrame ([[cell_type, stimulation, AAD, timepoint, replicate, iCasp]],
-                       columns=('Cell type', 'Stimulus', '7AAD', 'Timepoint', 
-                                'Replicate', 'iCasp'))
-    return df
-
-def metadata_read_NC1 (file_name):
-    # What cell type?
-    if 'Jurkat' in file_name:
-        cell_type = 'Jurkat'
-    if 'J-LAT' in file_name:
-        cell_type = 'J-LAT'   
-    # 7-AAD or PBS?
-    if 'sans' in file_name:
-        AAD = '-'
-    else:
-        AAD = '+'      
-    # What stimuli?
-    costimuli = ['Iono', 'OXA', 'JQ1', 'RVX']
-    stimulation = 'N/A'
-    if 'PMA' in file_name:
-        stimulation = 'PMA'+ '-' 
-        for costimulus in costimuli:
-            if costimulus in file_name:
-                stimulation = stimulation + costimulus  + '-' 
-    else:
-        for costimulus in costimuli:
-            if costimulus in file_name:
-                stimulation = costimulus + '-' 
-    # What timepoint?
-    timepoint = ''
-    # What replicate?
-    if stimulation == 'N/A': 
-        stimulation = 'CTL-'
-    replicates = [stimulation+'1', stimulation+'2', stimulation+'3']
-    replicate = 1
-    for i in range (3):
-        if replicates [i] in file_name:
-            replicate = i+1
-    # Remove the tailing '-'
-    if  '-' in stimulation: 
-        stimulation = stimulation[0:len(stimulation)-1]
-    # Caspase inhibitor?
-    iCasp = 'no iCasp'
-    if 'Caspi' in file_name:
-        iCasp = 'iCasp'
-    # Collate and return the data
-    df = pd.DataFrame ([[cell_type, stimulation, AAD, timepoint, replicate, iCasp]],
-                       columns=('Cell type', 'Stimulus', '7AAD', 'Timepoint', 
-                                'Replicate', 'iCasp'))
-    return df
-
-def metadata_read_NC2 (file_name):
-    # Specifically for co-culture experiments
-    cell_type = 'N/A'
-    timepoint = ''
-    #  What cell type?
-    if 'Jurkat' in file_name:
-        cell_type = 'Jurkat'
-    if 'J-LAT' in file_name:
-        cell_type = 'J-LAT'   
-    # 7-AAD or PBS?
-    if 'sans' in file_name:
-        AAD = '-'
-    else:
-        AAD = '+'      
-    # What stimuli?
-    stimulation = 'Error'
-    if 'PMA' in file_name:
-        stimulation = 'PMA-JQ1-' 
-    elif 'CTL' in file_name:
-        stimulation = 'CTL-'
-    # What replicate?
-    replicates = [stimulation+'1', stimulation+'2', stimulation+'3']
-    replicate = 0
-    for i in range (3):
-        if replicates [i] in file_name:
-            replicate = i+1
-    # Remove the tailing '-'
-    if  '-' in stimulation: 
-        stimulation = stimulation[0:len(stimulation)-1]
-    # Filter size
-    filter_size = ''
-    if ('insert5' in file_name) or (' 5' in file_name):
-        filter_size = '5 um'
-    elif '04 ' in file_name:
-        filter_size = '0.4 um'
-    # Normogenic or adipogenic 
-    lipid = 'RPMI'
-    if 'LG' in file_name:
-        lipid = 'LG'
-    elif 'HG' in file_name:
-        lipid = 'HG'
-    # what patient? 
-    patient = ''
-    if 'P1' in file_name:
-        patient = 'P1'
-    elif 'P2' in file_name:
-        patient = 'P2'
-    elif 'P3' in file_name:
-         patient = 'P3'
-    elif 'P4' in file_name:
-          patient = 'P4'
-    # Some pooled metadata for graphing/
-    meta_pool = lipid + ' '+ patient +'(' + filter_size + ')'
-    # Collate and return the data
-    df = pd.DataFrame ([[cell_type, stimulation, AAD, timepoint, patient, replicate, 
-                         lipid, filter_size, meta_pool]],
-                       columns=('Cell type', 'Stimulus', '7AAD','Timepoint', 
-                                'Donor','Replicate', 'Media', 'Insert type', 'Med+Fil'))
-    return df
+# Channels read from each .fcs file and hlog parameter applied to all of them
+channel = ['FSC-A','FSC-H','SSC-A','7AAD-A','GFP-A']
+hlog_b = 500.0
 
-def metadata_read_NC3 (file_name):
-    # Specifically for reinduction experiments
-    cell_type = 'N/A'
-    timepoint = ''
-    #  What cell type?
-    if 'Jurkat' in file_name:
-        cell_type = 'Jurkat'
-    if 'J-LAT' in file_name:
-        cell_type = 'J-LAT'   
-    # 7-AAD or PBS?
-    if 'sans' in file_name:
-        AAD = '-'
-    else:
-        AAD = '+'      
-    # What stimuli?
-    stimulation = "Error"
-    if 'CTL-PMA' in file_name:
-        stimulation = 'CTL-PMA-'
-    elif 'PMA-CTL' in file_name:
-        stimulation = 'PMA-CTL-'
-    elif 'PMA-PMA' in file_name:
-        stimulation = 'PMA-PMA-'
-    else: 
-        if 'PMA' in file_name:
-            stimulation = 'PMA-'
-        if 'CTL' in file_name:
-            stimulation = 'CTL-'
-    # What replicate?
-    replicates = [stimulation+'1', stimulation+'2', stimulation+'3']
-    replicate = 1
-    for i in range (3):
-        if replicates [i] in file_name:
-            replicate = i+1
-    # Remove the tailing '-'
-    if  '-' in stimulation: 
-        stimulation = stimulation[0:len(stimulation)-1]
-    # Collate and return the data
-    df = pd.DataFrame ([[cell_type, stimulation, AAD, timepoint, replicate]],
-                       columns=('Cell type', 'Stimulus', '7AAD','Timepoint', 
-                                'Replicate'))
-    return df
+# JLat gating strategies (hlog scale): gate tree, figure panels, on-graph label
+# positions and result columns are read from a JSON file (see
+# Gate_engine.load_strategies and Gate_plots.gate_panel)
+strategy_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'JLat_gating_strategy.json')
+def JLAT_gate_definitions (file_name=None):
+    return load_strategies(file_name or strategy_file)
 
+# .fcs readers (any case): 'native' (FCS_reader.py) or 'flowcytometrytools',
+# also spelled 'fct'. Returns the reader name as JLAT_gating tests it
+readers = {'native': 'native', 'flowcytometrytools': 'flowcytometrytools',
+           'fct': 'flowcytometrytools'}
+def reader_name (reader):
+    if str(reader).lower() not in readers:
+        raise ValueError("Unknown reader: " + repr(reader) + " ('native', 'flowcytometrytools' or 'fct')")
+    return readers[str(reader).lower()]
 
 # Function that gates a single sample (.fcs file)
 def JLAT_gating (file_name, verbose=False, export=False, figure_size=5,
-                     point_size=1, alpha=0.2, iteration=0, naming_convention=2):
-    import FlowCytometryTools # https://eyurtsev.github.io/FlowCytometryTools/tutorial.html
-    import matplotlib.pyplot as plot
-    # Initialise 4 subplots and set figure size
-    plot.rcParams["figure.figsize"] = (4*figure_size,figure_size)
-    fig, (ax1, ax2, ax3, ax4) = plot.subplots(1, 4, constrained_layout = True)    
+                     point_size=1, alpha=0.2, iteration=0, naming_convention=2,
+                     reader='native', plot_kind='density', bins=300, metadata=None,
+                     chunk_size=None, compensation=None, strategy_file=None,
+                     store_file=None, profile_log=None):
+    # reader: 'native' (FCS_reader.py) or 'flowcytometrytools' (see reader_name)
+    # plot_kind: 'density' draws each gate panel from a bins x bins 2D histogram,
+    # 'scatter' draws every event. Nothing is plotted unless verbose or export
+    # metadata: the file name metadata row if already parsed (see multiple_folders)
+    # chunk_size: stream the file chunk_size events at a time (see Chunked_gating.py)
+    # for files larger than memory; the MFI stays exact, figures are density only
+    # compensation: None (files compensated at acquisition), 'file' (apply the
+    # $SPILLOVER/$SPILL matrix of the file) or (channels, spillover matrix)
+    # strategy_file: gating strategies (default JLat_gating_strategy.json); all of
+    # them are evaluated in one pass, the first one is drawn
+    # store_file: also write the transformed channels and one bitset per gate
+    # to this gate store, for later statistics without re-gating (see Gate_store.py)
+    # profile_log: append the wall/CPU time and memory of every stage to this
+    # log (see Stage_timer.py)
+    reader = reader_name(reader)
+    profile = start_profile(file_name) if profile_log is not None else None
     # Generate the major plot title 
-    if naming_convention==0:
-        df = metadata_read_NC0 (file_name)
-    elif naming_convention==1:
-        df = metadata_read_NC1 (file_name)
-    elif naming_convention==2:
-        df = metadata_read_NC2 (file_name)
-    elif naming_convention==3:
-        df = metadata_read_NC3 (file_name)
+    if metadata is None:
+        metadata, unparsed = parse_file_names([os.path.basename(file_name)], naming_convention)
+        report_unparsed(unparsed, naming_convention)
+    df = metadata.reset_index(drop=True)
     # Setup some plot aparameters 
     plot_title = df['Cell type'] + ' & ' + df['Stimulus']  + ' '
     plot_title = plot_title + df['Timepoint'] + ' (7AAD' + df['7AAD'] + ')'
     plot_title = plot_title.to_string (index=False)
-    plot.suptitle(plot_title, fontsize=30, fontweight='roman')
-    # On-graph text parameters
-    font_gates = {'family': 'sans-serif',
-        'color':  'darkred',
-        'weight': 'normal',
-        'size': 20}
-    # Plotting parameters
-    channel = ['FSC-A','FSC-H','SSC-A','7AAD-A','GFP-A']
-    channel_pairs = [['FSC-A','FSC-H'],['FSC-A','SSC-A'],
-                     ['GFP-A', '7AAD-A'],['GFP-A', 'FSC-A']]
-    # Load the sample datafile
-    sample = FlowCytometryTools.FCMeasurement(ID='Test Sample', datafile=file_name)
-    sample_0 = sample.transform('hlog', channels=channel, b=500.0)
-    # FSC-A vs. FSC-H: gating single cells pt. 1
-    x = 8190
-    dx = 1800
-    y = 8000-50
-    dy = 1750
-    ddy = 125
-    gate_xy = [(x, y),(x+dx, y+dy),(x+dx, y+dy+ddy),(x, y+ddy)]
-    single_cell_1 = FlowCytometryTools.PolyGate (vert = gate_xy,
-                                               channels=channel_pairs[0], 
-                                               name='Single cells')
-    # Gate the sample and record the % of gated events
-    sample_1 = sample_0.gate(single_cell_1)
-    fraction_1 = sample_1.counts/sample_0.counts*100
-    if verbose or export:
-        # Subplot index key: 1 roz, 4 columns, graph index = 1
-        ax1 = plot.subplot(141)
-        # Fix axis across all samples
-        ax1.set_xlim([7900,10000])
-        ax1.set_ylim([7900,10000])
-        # Plot the dataset
-        sample_0.plot(channel_pairs[0], kind='scatter',
-                      s=point_size, alpha=alpha, color='black')
-        # Plot the gate and add a description
-        single_cell_1.plot(color='red') 
-        plot.text(x-90, y+700,'Singlets\n'+str(round(fraction_1, 2))+ 
-                  '%', fontdict=font_gates)
-        # Visual parameter tweaking
-        plot.xticks(np.arange(8000, 10000+1, 500))
-        ax1.tick_params(axis="x", labelsize=14)
-        ax1.xaxis.label.set_size(20)
-        plot.yticks(np.arange(8000, 10000+1, 500))
-        ax1.tick_params(axis="y", labelsize=14)
-        ax1.yaxis.label.set_size(20)
-    
-    # FSC-A vs. SSC-A: gating single cells pt.2
-    import math
-    x = 9200
-    y = 8050
-    r = 600*1.3 # Radius of the pseudo-eliptic gate
-    f = 1.3 # "Elipsisity" factor (horizontal)
-    gate_xy = [(x+r/f, y),(x+r*math.sqrt(1/2)/f, y+r*math.sqrt(1/2)),
-               (x, y+r),(x-r*math.sqrt(1/2)/f, y+r*math.sqrt(1/2)),
-               (x-r/f, y),(x-r*math.sqrt(1/2)/f, y-r*math.sqrt(1/2)),
-               (x, y-r),(x+r*math.sqrt(1/2)/f, y-r*math.sqrt(1/2))]
-    single_cell_2 = FlowCytometryTools.PolyGate (vert = gate_xy,
-                                               channels=channel_pairs[1], 
-                                               name='Single cells')
-    sample_2 = sample_1.gate(single_cell_2)
-    fraction_2 = sample_2.counts/sample_1.counts*100
-    if verbose or export:
-        ax2 = plot.subplot(142)
-        ax2.set_xlim([7900,10000])
-        ax2.set_ylim([6350,10000])
-        sample_1.plot(channel_pairs[1], kind='scatter',
-                    s=point_size, alpha=alpha, color='orange')
-        single_cell_2.plot(color='red')
-        plot.text(x-200, y-1300,'Granularity\n'+str(round(fraction_2, 2))+ 
-                  '%', fontdict=font_gates)
-        # Visual parameter tweaking
-        plot.xticks(np.arange(8000, 10000+1, 500))
-        ax2.tick_params(axis="x", labelsize=14)
-        ax2.xaxis.label.set_size(20)
-        plot.yticks(np.arange(6500, 10000+1, 700))
-        ax2.tick_params(axis="y", labelsize=14)
-        ax2.yaxis.label.set_size(20)
-        
-    # GFP-A vs. 7AAD-A: gating live cells
-    x = 3500
-    y = 2000
-    live_cell = FlowCytometryTools.ThresholdGate(y, ['7AAD-A'], region='below')
-    sample_3 = sample_2.gate(live_cell)
-    fraction_3 = sample_3.counts/sample_2.counts*100
-    if verbose or export:
-        ax3 = plot.subplot(143)  
-        ax3.set_xlim([-500,10000])
-        ax3.set_ylim([-2300,10000])
-        sample_2.plot(channel_pairs[2], kind='scatter', gates=[live_cell],
-                    s=point_size, alpha=alpha, color='blue')
-        plot.text(x+2200, y+600,'Live cells\n'+str(round(fraction_3, 2))+ 
-                  '%', fontdict=font_gates)
-        # Visual parameter tweaking
-        plot.xticks(np.arange(0, 10000+1, 2000))
-        ax3.tick_params(axis="x", labelsize=14)
-        ax3.xaxis.label.set_size(20)
-        plot.yticks(np.arange(-2000, 10000+1, 2000))
-        ax3.tick_params(axis="y", labelsize=14)
-        ax3.yaxis.label.set_size(20)
+    gates, strategies = JLAT_gate_definitions(strategy_file)
+    by_name = {gate['name']: gate for gate in gates}
+    medians = [(median['channel'], median['population'])
+               for strategy in strategies for median in strategy.get('medians', [])]
+    requests = statistic_requests(strategies)
+    # The first strategy is drawn, one panel per gate (panel settings from the
+    # strategy file); nothing of it is prepared unless plotting
+    drawn = [by_name[name] for name in strategies[0]['gates']]
+    plotting = verbose or export
+    store_info = {'file_name': os.path.basename(file_name), 'hlog_b': hlog_b,
+                  'gates': gates, 'strategies': strategies,
+                  'compensation': compensation_settings(compensation)}
+    # Panel settings: channels, x & y axis limits (fixed across all samples), x & y
+    # ticks, colour, gate label (the population shown is the parent of the gate)
+    rasters = ()
+    if plotting:
+        from Gate_plots import gate_panel
+        panels = [gate_panel(gate) for gate in drawn]
+        rasters = [[gate.get('parent'), panel['channels'], panel['xlim'], panel['ylim'], bins]
+                   for gate, panel in zip(drawn, panels)]
+    lap(profile, 'setup')
+    if chunk_size is not None:
+        if plotting and plot_kind == 'scatter':
+            raise ValueError("Scatter figures need every event in memory: use plot_kind='density' with chunk_size")
+        from Chunked_gating import stream_gates
+        counts, median_values, images, statistics = stream_gates(file_name, channel, gates, hlog_b, chunk_size,
+                                                     medians=medians,
+                                                     rasters=rasters,
+                                                     compensation=compensation,
+                                                     store_file=store_file,
+                                                     store_info=store_info,
+                                                     statistics=requests)
+        lap(profile, 'chunked gating')
+    else:
+        # Load the sample datafile
+        if reader == 'native':
+            # Memory-map the file and load only the gated channels (float32),
+            # plus the other channels of the compensation matrix if any
+            meta = read_meta(file_name)
+            setup = compensation_setup(meta, compensation)
+            loaded = channel
+            if setup is not None:
+                loaded = channel + [c for c in setup[0] if c not in channel]
+            meta, data = load_channels(file_name, loaded, meta)
+            ranges = {c: channel_range(meta, c) for c in channel}
+        elif reader == 'flowcytometrytools':
+            # Only this reader needs FlowCytometryTools (which imports matplotlib)
+            import FlowCytometryTools # https://eyurtsev.github.io/FlowCytometryTools/tutorial.html
+            sample = FlowCytometryTools.FCMeasurement(ID='Test Sample', datafile=file_name)
+            setup = compensation_setup({str(key).upper(): value for key, value in sample.meta.items()},
+                                       compensation)
+            data = {c: sample.data[c].to_numpy() for c in sample.data.columns}
+            ranges = sample.meta['_channels_'].set_index('$PnN')['$PnR'].astype(float)
+        lap(profile, 'load')
+        # Spillover compensation: an in-place matrix product on float32 events
+        if setup is not None:
+            data.update(compensate_channels(data, setup[0], setup[1]))
+            lap(profile, 'compensation')
+        # hlog by table lookup (see Hlog_transform.py), d = log10($PnR) as in
+        # FlowCytometryTools' transform('hlog', auto_range=True)
+        events = {c: hlog_lookup(data[c], b=hlog_b, d=np.log10(ranges[c])) for c in channel}
+        lap(profile, 'transform')
+        # Gate the sample: each gate is a boolean mask combined with its parent's,
+        # and every gate of every strategy is evaluated once
+        masks, counts = gate_dag(events, gates, profile=profile)
+        median_values = {(c, population): np.median(events[c][masks[population]])
+                         for c, population in medians}
+        # Population statistics on the linear scale (one partial sort per population)
+        statistics = population_statistics(data, masks, requests)
+        lap(profile, 'statistics')
+        if store_file is not None:
+            from Gate_store import write_store
+            write_store(store_file, events, masks, store_info)
+            lap(profile, 'gate store')
+        if plotting and plot_kind != 'scatter':
+            from Gate_plots import density_raster
+            images = []
+            for parent, channel_pair, xlim, ylim, raster_bins in rasters:
+                x_data = events[channel_pair[0]]
+                y_data = events[channel_pair[1]]
+                if parent is not None:
+                    x_data = x_data[masks[parent]]
+                    y_data = y_data[masks[parent]]
+                images.append(density_raster(x_data, y_data, xlim, ylim, raster_bins))
+            lap(profile, 'density rasters')
 
-    # GFP-A vs. FSC-A: gating GFP+ cells
-    x = 1000
-    y = 9210
-    GFP_cell = FlowCytometryTools.ThresholdGate(1000.0, ['GFP-A'], region='above')
-    sample_4 = sample_3.gate(GFP_cell)
-    fraction_4 = sample_4.counts/sample_3.counts*100
-    if verbose or export:
-        ax4 = plot.subplot(144)
-        ax4.set_xlim([-500,10000])
-        ax4.set_ylim([7900,10000])
-        sample_3.plot(channel_pairs[3], kind='scatter', gates=[GFP_cell],
-                      s=point_size, alpha=alpha, color='green')
-        plot.text(x+700, y-1100,'GFP+ cells\n'+str(round(fraction_4, 2))+ 
-                  '%', fontdict=font_gates)
-        # Visual parameter tweaking
-        plot.xticks(np.arange(0, 10000+1, 2000))
-        ax4.tick_params(axis="x", labelsize=14)
-        ax4.xaxis.label.set_size(20)
-        plot.yticks(np.arange(8000, 10000+1, 500))
-        ax4.tick_params(axis="y", labelsize=14)
-        ax4.yaxis.label.set_size(20)
+    # Figures are optional: the compute-only path never touches matplotlib
+    if plotting:
+        import matplotlib.pyplot as plot
+        from Gate_plots import plot_density, plot_gate_outline
+        # Initialise one subplot per drawn gate and set figure size
+        plot.rcParams["figure.figsize"] = (len(panels)*figure_size,figure_size)
+        fig, axes = plot.subplots(1, len(panels), constrained_layout = True, squeeze = False)
+        axes = axes[0]
+        plot.suptitle(plot_title, fontsize=30, fontweight='roman')
+        # On-graph text parameters
+        font_gates = {'family': 'sans-serif',
+            'color':  'darkred',
+            'weight': 'normal',
+            'size': 20}
+        for i in range(len(panels)):
+            panel = panels[i]
+            xlim, ylim, color, label = panel['xlim'], panel['ylim'], panel['color'], panel['label']
+            channel_pair = panel['channels']
+            gate = drawn[i]
+            # Empty parent population: no fraction (as in strategy_results)
+            parent_count = counts[gate.get('parent')]
+            fraction = counts[gate['name']]/parent_count*100 if parent_count else np.nan
+            label_xy = panel['label_xy']
+            ax = axes[i]
+            # Plot the dataset
+            if plot_kind == 'scatter':
+                x_data = events[channel_pair[0]]
+                y_data = events[channel_pair[1]]
+                if gate.get('parent') is not None:
+                    x_data = x_data[masks[gate['parent']]]
+                    y_data = y_data[masks[gate['parent']]]
+                ax.scatter(x_data, y_data, s=point_size, alpha=alpha, color=color)
+            else:
+                plot_density(ax, images[i], xlim, ylim, color)
+            # Plot the gate and add a description
+            if gate['type'] == 'poly':
+                plot_gate_outline(ax, gate, channel_pair, color='red')
+            else:
+                plot_gate_outline(ax, gate, channel_pair, color='blue')
+            ax.text(label_xy[0], label_xy[1], label + '\n'+str(round(fraction, 2))+ 
+                    '%', fontdict=font_gates)
+            # Visual parameter tweaking
+            ax.set_xlim(xlim)
+            ax.set_ylim(ylim)
+            if panel['xticks'] is not None:
+                ax.set_xticks(panel['xticks'])
+            if panel['yticks'] is not None:
+                ax.set_yticks(panel['yticks'])
+            ax.tick_params(axis="both", labelsize=14)
+            ax.set_xlabel(channel_pair[0], fontsize=20)
+            ax.set_ylabel(channel_pair[1], fontsize=20)
+        lap(profile, 'figure')
     
-    # Export the analysis results
-    if export:
-        figure_name = file_name [0:(len(file_name)-4)]
-        plot.savefig(str(figure_name) + '.png') # Save the final figure
-    if verbose:
-        plot.show()
-    plot.close('all') #https://stackoverflow.com/questions/24500065/closing-matplotlib-figures
+        # Export the analysis results
+        if export:
+            figure_name = file_name [0:(len(file_name)-4)] # Next to the .fcs file
+            plot.savefig(str(figure_name) + '.png') # Save the final figure
+            lap(profile, 'savefig')
+        if verbose:
+            plot.show()
+        plot.close('all') #https://stackoverflow.com/questions/24500065/closing-matplotlib-figures
     
-    # Return metadata 
-    df.insert (df.shape[1], '% Single cells [1]', round(fraction_1, 2))
-    df.insert (df.shape[1], '% Single cells [2]', round (fraction_2, 2))
-    df.insert (df.shape[1], '% Live cells', round (fraction_3, 2))
-    df.insert (df.shape[1], '% GFP+ cells', round (fraction_4, 2))
-    # Absolute event numbers:
-    df.insert (df.shape[1], 'Total Single cells [1]', sample_1.counts)
-    df.insert (df.shape[1], 'Total Single cells [2]', sample_2.counts)
-    df.insert (df.shape[1], 'Total Live Cells', sample_3.counts)
-    df.insert (df.shape[1], 'Total GFP+ cells', sample_4.counts)
-    # MFI:
-    df.insert (df.shape[1], 'MFI GFP+', sample_3['GFP-A'].median())
+    # Return metadata: % gated, absolute event numbers and MFI of every strategy
+    for strategy in strategies:
+        for column, value in strategy_results(strategy, gates, counts, median_values, statistics):
+            df.insert (df.shape[1], column, value)
+    lap(profile, 'result row')
+    write_profile(profile, profile_log)
     return df
 
-def excel_export (metadata):
+def excel_export (metadata, output_dir=''):
     # Re-arrange the data to keep replicates near one another
     metadata = metadata.sort_values(by=['7AAD', 'Cell type', 'Stimulus', 'Timepoint', 'Replicate'])
     # Drop extra columns if empty
@@ -392,8 +243,7 @@ def excel_export (metadata):
     n = n[0]
     if n == 1:
         metadata = metadata.loc[:, metadata.columns!='Replicate']
-        metadata.to_excel(r'Analysis Results.xlsx')
-    metadata.to_excel(r'Analysis Results.xlsx')
+    export_table(metadata, os.path.join(output_dir, r'Analysis Results.xlsx'))
     return metadata
 
 # References to data that we need to plot
@@ -401,11 +251,13 @@ data_references = ['% Single cells [1]','% Single cells [2]','% Live cells',
                    '% GFP+ cells','Total Single cells [1]','Total Single cells [2]',
                    'Total Live Cells','Total GFP+ cells', 'MFI GFP+']
 
-def plot_export (metadata, figure_size=4, Jurkat=True, rotation=90, hue=['Stimulation',''], folder=''):
+def plot_export (metadata, figure_size=4, Jurkat=True, rotation=90, hue=['Stimulation',''], folder='',
+                 output_dir=''):
     # hue = [X-axis label, Legend labels]
+    # folder: folder label of the figure name, output_dir: where it is saved
     # Start by preparing the plot template etc.
-    import seaborn as sns
     import matplotlib.pyplot as plt
+    from Group_summary import group_summary, summary_barplot
     plt.close('all') # Close any open plots to avoid a mess
     plt.rcParams["figure.figsize"] = (figure_size*5,figure_size*2.21)
     # Prepare 4 subplot axes & appropriate subplo titles
@@ -437,13 +289,30 @@ def plot_export (metadata, figure_size=4, Jurkat=True, rotation=90, hue=['Stimul
     
     # Drop 7AAD(-) datapoints from the plot
     metadata = metadata [metadata['7AAD'] != "-"]
+    
+    # Mean and 95% CI of every metric per cell type, stimulus (and the other hue
+    # columns), in plot order: computed once and cached (see Group_summary.py),
+    # so both Jurkat variants of a folder are drawn from the same summary
+    keys = ['Cell type', 'Stimulus'] + [h for h in hue if h not in ('', 'Stimulation')]
+    summary = group_summary(metadata, keys, data_references)
+    groups = summary.index.to_frame(index=False)
+    groups ['Stimulation'] = groups ['Cell type'] + ' * ' + groups ['Stimulus']
     # Optionally exclude Jurkat
     if Jurkat != True:
-        metadata = metadata [metadata['Cell type'] != "Jurkat"]
-        metadata ['Stimulation'] = metadata.loc [:, "Stimulus"] # No need for 'J-Lat * ' if no Jurkat
+        kept = (groups['Cell type'] != "Jurkat").to_numpy()
+        summary = summary [kept]
+        groups = groups [kept]
+        groups ['Stimulation'] = groups ['Stimulus'] # No need for 'J-Lat * ' if no Jurkat
+    labels = [h for h in hue if h != '']
+    if groups.duplicated(labels).any(): # Several cell types per bar: summarise their rows together
+        metadata = metadata [metadata['Cell type'] != "Jurkat"].copy()
+        metadata ['Stimulation'] = metadata ['Stimulus']
+        summary = group_summary(metadata, labels, data_references)
+    else:
+        summary = summary.set_axis(pd.MultiIndex.from_frame(groups [labels])) # The cached summary is shared
     
     # Adjust rotation if there are few x ticks
-    n = len(pd.unique(metadata['Stimulation']))
+    n = len(pd.unique(summary.index.get_level_values('Stimulation')))
     if (n <= 6) and ('Timepoint' not in hue):
         rotation = 45
 
@@ -455,9 +324,9 @@ def plot_export (metadata, figure_size=4, Jurkat=True, rotation=90, hue=['Stimul
         
         # Refine the plot -> appropriate legends and plots 
         if len(hue[1]) != 0:
-            ax[i]= sns.barplot (x = hue[0], y=subplots[i],  hue=hue[1], data=metadata)
+            ax[i]= summary_barplot (ax[i], summary, subplots[i], x = hue[0], hue=hue[1])
         else:
-            ax[i]= sns.barplot (x = hue[0], y=subplots[i],  data=metadata)
+            ax[i]= summary_barplot (ax[i], summary, subplots[i], x = hue[0])
         ax[i].tick_params(axis='x', rotation=rotation)
         if i < 4:
             ax[i].set_ylim([0,105])
@@ -486,60 +355,190 @@ def plot_export (metadata, figure_size=4, Jurkat=True, rotation=90, hue=['Stimul
             plt.yscale('symlog')
 
     # Export the resulting p^lot
-    if '\\' not in folder[1:]:
+    if os.path.splitdrive(folder)[0] or folder.startswith('/'): # Full path: its last folder
+        fig_name = os.path.basename(folder.rstrip('\\/')) + ' Analysis Results '
+    elif '\\' not in folder[1:]:
         fig_name = folder[1:] + ' Analysis Results '
     else:
         fig_name = folder[24:] + ' Analysis Results '
     if Jurkat == True:
         fig_name = fig_name + '(with Jurkat).png'
-        plt.savefig(fig_name, bbox_inches='tight')
+        plt.savefig(os.path.join(output_dir, fig_name), bbox_inches='tight')
     else:
         fig_name = fig_name + '(without Jurkat).png'
-        plt.savefig(fig_name, bbox_inches='tight')
+        plt.savefig(os.path.join(output_dir, fig_name), bbox_inches='tight')
 
 
 
-def folder_analysis (metadata, hue=['Stimulation',''], folder = ''):
-    metadata_means = excel_export(metadata)
+def folder_analysis (metadata, hue=['Stimulation',''], folder = '', figures=True, output_dir=''):
+    # figures: draw the folder bar plots (False: summary only, matplotlib is never imported)
+    # output_dir: where the spreadsheet and the plots are written
+    metadata_means = excel_export(metadata, output_dir)
     metadata_means = metadata
-    plot_export (metadata, Jurkat=True, hue=hue, folder=folder)
-    plot_export (metadata, Jurkat=False, hue=hue, folder = folder)
+    if figures:
+        plot_export (metadata, Jurkat=True, hue=hue, folder=folder, output_dir=output_dir)
+        plot_export (metadata, Jurkat=False, hue=hue, folder = folder, output_dir=output_dir)
     return metadata_means 
     
+# Everything besides the file itself that the JLAT_gating result row depends on
+# (bump result_version whenever the columns of the result row change)
+result_version = 3
+def gating_settings (gating_kwargs):
+    gates, strategies = JLAT_gate_definitions(gating_kwargs.get('strategy_file'))
+    return {'version': result_version, 'gates': gates, 'strategies': strategies,
+            'channels': channel,
+            'hlog_b': hlog_b, 'reader': reader_name(gating_kwargs.get('reader', 'native')),
+            'chunk_size': gating_kwargs.get('chunk_size'),
+            'compensation': compensation_settings(gating_kwargs.get('compensation')),
+            'naming_convention': gating_kwargs.get('naming_convention', 2),
+            'grammar': grammars[gating_kwargs.get('naming_convention', 2)]}
+
+# Compensation argument of JLAT_gating in a comparable (JSON) form
+def compensation_settings (compensation):
+    if compensation is None or isinstance(compensation, str):
+        return compensation
+    channels, spillover = compensation
+    return [list(channels), np.asarray(spillover, dtype=float).tolist()]
+
+# Gate a single file inside a folder (also used as the process or thread pool
+# task: the file is addressed by its full path, the working directory is never
+# changed). Returns the result row, or the formatted exception if gating failed
+def gate_file (folder, file_name, gating_kwargs, cache_dir=None, cache_size=2**30):
+    import traceback
+    try:
+        file_name = os.path.join(folder, file_name)
+        store_file = gating_kwargs.get('store_file')
+        if store_file is not None:
+            gating_kwargs = dict(gating_kwargs, store_file=os.path.join(folder, store_file))
+        if cache_dir is None:
+            return JLAT_gating(file_name, **gating_kwargs), None
+        profile_log = gating_kwargs.get('profile_log')
+        profile = start_profile(file_name) if profile_log is not None else None
+        # Re-use the stored result if neither the file nor the gating changed
+        # (unless a figure or gate store is requested that has not been written yet)
+        key = cache_key(file_name, gating_settings(gating_kwargs))
+        figure_name = file_name [0:(len(file_name)-4)] + '.png'
+        store_file = gating_kwargs.get('store_file')
+        df = None
+        if (not (gating_kwargs.get('export') and not os.path.exists(figure_name))
+                and not (store_file is not None and not os.path.exists(store_file))):
+            df = cache_load(cache_dir, key)
+        lap(profile, 'cache lookup')
+        if df is None:
+            write_profile(profile, profile_log)
+            df = JLAT_gating(file_name, **gating_kwargs)
+            profile = start_profile(file_name) if profile_log is not None else None
+            cache_store(cache_dir, key, df, cache_size)
+            lap(profile, 'cache store')
+        write_profile(profile, profile_log)
+        return df, None
+    except Exception:
+        return None, traceback.format_exc()
+
+# Gate store of a file, written next to it (as the exported figures)
+def store_name (file_name):
+    return file_name [0:(len(file_name)-4)] + '.gates'
+
 # Analysing content within multiple input folders    
 def multiple_folders (dir='', folders=[''], verbose=False, export = True, 
-                      hue=['Stimulation',''], naming_convention = 0):
+                      hue=['Stimulation',''], naming_convention = 0,
+                      pool=None, errors=None, cache_dir=None, cache_size=2**30,
+                      chunk_size=None, compensation=None, strategy_file=None,
+                      store=False, profile_log=None, summary_figures=True):
+    # pool: optional concurrent.futures executor to gate the files in parallel
+    # (processes, or threads when export is off: pyplot figures are not thread-safe)
+    # errors: optional list collecting (folder, file, traceback) of failed files,
+    # which are then skipped instead of stopping the whole analysis
+    # cache_dir: optional result cache directory, limited to cache_size bytes
+    # chunk_size: gate the files out-of-core, chunk_size events at a time
+    # compensation: spillover compensation applied to every file (see JLAT_gating)
+    # strategy_file: gating strategies of every file (see JLAT_gating)
+    # store: write a gate store next to every file (name.gates, see Gate_store.py)
+    # profile_log: per-stage timing/memory log of every file and folder summary
+    # summary_figures: draw the bar plots of every folder summary (see folder_analysis)
     folder_tag = range(len(folders))
     
-    # Initiate several empty datasets for downstream manipulation 
-    metadata = pd.DataFrame ()
-    metadata_temp = pd.DataFrame ()
-    metadata_means = pd.DataFrame ()
+    # Initiate several empty datasets for downstream manipulation: columns
+    # are accumulated and only turned into DataFrames once (see Result_table.py)
+    metadata = result_table ()
+    metadata_means = result_table ()
     
+    # Submit every file of every folder up front so the pool never runs dry;
+    # results are still collected in listing order, i.e. deterministically
+    # The file name metadata of each folder is parsed in one go
+    file_lists = []
+    name_tables = []
+    futures = []
     for k in range(0, len(folders)):
-        os.chdir(dir + folders[k])   # Change the working directory
-        file_names = os.listdir() # Check the files in the directory
-        metadata_temp = pd.DataFrame ()
+        file_names = [file_name for file_name in os.listdir(dir + folders[k])
+                      if '.fcs' in file_name]
+        file_lists.append(file_names)
+        name_table, unparsed = parse_file_names(file_names, naming_convention)
+        report_unparsed(unparsed, naming_convention)
+        name_tables.append(name_table)
+        if pool is not None:
+            futures.append([])
+            for i in range(0, len(file_names)):
+                gating_kwargs = {'alpha': 0.5, 'point_size': 2, 'verbose': False,
+                                 'export': export, 'naming_convention': naming_convention,
+                                 'metadata': name_table.iloc[[i]], 'chunk_size': chunk_size,
+                                 'compensation': compensation, 'strategy_file': strategy_file,
+                                 'store_file': store_name(file_names [i]) if store else None,
+                                 'profile_log': profile_log}
+                futures[k].append(pool.submit(gate_file, dir + folders[k], file_names [i],
+                                              gating_kwargs, cache_dir, cache_size))
+    
+    df = None
+    for k in range(0, len(folders)):
+        file_names = file_lists[k]
+        metadata_temp = result_table ()
         for i in range(0, len(file_names)):
-            if '.fcs' in file_names [i]:
-                df = JLAT_gating(file_names [i], iteration=i, alpha=0.5, 
-                                 point_size=2, verbose=verbose, export=export,
-                                 naming_convention=naming_convention)
-                # The mess below to correctly insert the day tag
-                df.insert(loc = 5, column = 'Folder tag', value = folder_tag[k])
-                metadata_temp = metadata_temp.append(df, ignore_index=True)
+            if pool is None:
+                gating_kwargs = {'iteration': i, 'alpha': 0.5, 'point_size': 2, 
+                                 'verbose': verbose, 'export': export,
+                                 'naming_convention': naming_convention,
+                                 'metadata': name_tables[k].iloc[[i]], 'chunk_size': chunk_size,
+                                 'compensation': compensation, 'strategy_file': strategy_file,
+                                 'store_file': store_name(file_names [i]) if store else None,
+                                 'profile_log': profile_log}
+                df, error = gate_file(dir + folders[k], file_names [i], gating_kwargs,
+                                      cache_dir, cache_size)
+            else:
+                df, error = futures[k][i].result()
+            if error is not None:
+                if errors is None:
+                    raise RuntimeError('Gating failed for ' + file_names [i] + '\n' + error)
+                print('Skipping ' + file_names [i] + ' (gating failed)')
+                errors.append((folders[k], file_names [i], error))
+                continue
+            # The mess below to correctly insert the day tag
+            df.insert(loc = 5, column = 'Folder tag', value = folder_tag[k])
+            table_append(metadata_temp, df)
+        metadata_temp = table_frame(metadata_temp)
+        if len(metadata_temp) == 0:
+            # Nothing to summarise: the folder is reported as failed, the other
+            # folders are still analysed
+            if errors is None:
+                raise RuntimeError('No file could be gated in ' + folders[k])
+            print('Skipping the summary of ' + folders[k] + ' (no file gated)')
+            errors.append((folders[k], '', 'No file could be gated: folder summary skipped'))
+            continue
         
         # Collate raw metadata from each folder to return
-        metadata = metadata.append(metadata_temp, ignore_index=True)
+        table_append(metadata, metadata_temp)
         # Re-use metadata_temp to a treated data chunk (replicate means and STDs)
+        profile = start_profile(folders[k]) if profile_log is not None else None
         metadata_temp = folder_analysis (metadata_temp.loc[:, metadata_temp.columns!='Folder tag'], 
-                       hue=hue, folder = folders[k])
+                       hue=hue, folder = folders[k], figures = summary_figures,
+                       output_dir = dir + folders[k])
+        lap(profile, 'folder summary')
+        write_profile(profile, profile_log)
         # Folder tag gets lost along the way - bring it back!
         metadata_temp.insert(loc = 5, column = 'Folder tag', value = folder_tag[k])
         # Collate treated metadata from each folder to return
-        metadata_means=metadata_means.append(metadata_temp, ignore_index=True)
+        table_append(metadata_means, metadata_temp)
 
-    return metadata, metadata_means, df
+    return table_frame(metadata), table_frame(metadata_means), df
         
 # Metadata for experiments within multiple folders
 experiments = ['Experiment name #1', 
@@ -552,47 +551,97 @@ folders = [[r'\Folder directory #1',r'\Folder directory #2',r'\Folder directory
            [r'\Folder directory #7',r'\Folder directory #8',r'\Folder directory #9'],
            [r'\Folder directory #10',r'\Folder directory #11',r'\Folder directory #12']]
 
-naming_convnetion_0 =  [n for n in range(0, 1)]     # Relevant to metadata_read_NC0
-naming_convnetion_1 =  [n for n in range(1, 2)]     # Relevant to metadata_read_NC1
-naming_convnetion_2 =  [n for n in range(2, 3)]    # Relevant to metadata_read_NC2
+naming_convnetion_0 =  [n for n in range(0, 1)]     # Relevant to grammars[0] (Filename_grammar.py)
+naming_convnetion_1 =  [n for n in range(1, 2)]     # Relevant to grammars[1]
+naming_convnetion_2 =  [n for n in range(2, 3)]    # Relevant to grammars[2]
 naming_convnetion_3 = [4]
 
 skips = [n for n in range(0, 11)] 
 
+# Naming convention of the i-th experiment (unlisted: keep the previous one)
+def experiment_convention (i, naming_convention=None):
+    if i in naming_convnetion_0:
+        naming_convention = 0
+    elif i in naming_convnetion_1:
+        naming_convention = 1
+    elif i in naming_convnetion_2:
+        naming_convention = 2
+    elif i in naming_convnetion_3:
+        naming_convention = 3
+    return naming_convention
+
+# hue = [X-axis label, Legend labels] of the summary plots of an experiment
+def experiment_hue (experiment):
+    hue=['Stimulation','']
+    if 'PMA Kinetics' in experiment:
+        hue=['Timepoint','Stimulation']
+    if 'Q-VD-OPh' in experiment:
+        hue=['Stimulation','iCasp']
+    if 'Co-culture' in experiment:
+        hue=['Stimulation','Med+Fil']
+    if 'RPMIx2' in experiment:
+        hue=['Stimulation','Media']
+    return hue
+
+# Experiment summary spreadsheet name (written to the FACS directory)
+def summary_name (folders_subset, experiment):
+    if '\\' not in folders_subset[0][1:]:
+        spreadsheet_name = r'(' + folders_subset[0][1:] + r') '
+    else:
+        spreadsheet_name =  r'(' + folders_subset[0][24:] + r') '
+    return spreadsheet_name + experiment + ' Experiment Summary.xlsx'
+
 def analyse_everything_thus_far_v1 (dir = r'C:\FACS folder directory',
                                     experiments=experiments,folders=folders,
-                                    export = True, verbose=False):
+                                    export = True, verbose=False, processes=1,
+                                    cache_dir=None, cache_size=2**30, chunk_size=None,
+                                    compensation=None, strategy_file=None, store=False,
+                                    profile_log=None):
+    # processes: number of worker processes gating the files (None = all cores)
+    # cache_dir: re-use per-file results of previous runs (see Result_cache.py)
+    # chunk_size: stream files larger than memory (see Chunked_gating.py)
+    # compensation: spillover compensation (see Compensation.py and JLAT_gating)
+    # strategy_file: gating strategies JSON (see Gate_engine.load_strategies)
+    # store: keep a gate store per file for re-analysis (see Gate_store.py)
+    # profile_log: log the time/memory of every stage of every file (JSON lines,
+    # see Stage_timer.py) and print a per-stage summary at the end
+    pool = None
+    if profile_log is not None:
+        profile_log = os.path.abspath(profile_log) # Same log whatever the caller's directory
+        log_start = os.path.getsize(profile_log) if os.path.exists(profile_log) else 0
+    errors = []
+    if processes != 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=processes)
+    naming_convention = None
     for i in range(len(experiments)):
-        if i in naming_convnetion_0:
-            naming_convention = 0
-        elif i in naming_convnetion_1:
-            naming_convention = 1
-        elif i in naming_convnetion_2:
-            naming_convention = 2
-        elif i in naming_convnetion_3:
-            naming_convention = 3
+        naming_convention = experiment_convention(i, naming_convention)
         if i not in skips:
             folders_subset = folders[i]
-            hue=['Stimulation',''] # hue = [X-axis label, Legend labels]
-            if 'PMA Kinetics' in experiments[i]:
-                hue=['Timepoint','Stimulation']
-            if 'Q-VD-OPh' in experiments[i]:
-                hue=['Stimulation','iCasp']
-            if 'Co-culture' in experiments[i]:
-                hue=['Stimulation','Med+Fil']
-            if 'RPMIx2' in experiments[i]:
-                hue=['Stimulation','Media']
+            hue = experiment_hue(experiments[i])
             metadata, metadata_means, df = multiple_folders (dir, folders_subset, verbose=verbose, 
                                                          export = export, hue = hue,
-                                                         naming_convention = naming_convention)
-            os.chdir(dir)
+                                                         naming_convention = naming_convention,
+                                                         pool = pool, errors = errors,
+                                                         cache_dir = cache_dir,
+                                                         cache_size = cache_size,
+                                                         chunk_size = chunk_size,
+                                                         compensation = compensation,
+                                                         strategy_file = strategy_file,
+                                                         store = store,
+                                                         profile_log = profile_log)
             # Export the resulting p^lot
-            if '\\' not in folders[i][0][1:]:
-                spreadsheet_name = r'(' + folders[i][0][1:] + r') '
-            else:
-                spreadsheet_name =  r'(' + folders[i][0][24:] + r') '
-            filename = spreadsheet_name + experiments[i] + ' Experiment Summary.xlsx'
-            metadata_means.to_excel(filename)
+            export_table(metadata_means, os.path.join(dir, summary_name(folders[i], experiments[i])))
+    if pool is not None:
+        pool.shutdown()
+    # Report the files that could not be gated
+    for folder, file_name, error in errors:
+        print('Gating failed: ' + folder + '\\' + file_name + '\n' + error)
+    # Where the time went in this batch
+    if profile_log is not None:
+        summary = profile_summary(read_profile_log(profile_log, log_start))
+        print(summary.round(4).to_string())
+        export_table(summary, os.path.splitext(profile_log)[0] + ' summary.xlsx', parquet=False)
     return metadata
 
 if __name__ == "__main__":
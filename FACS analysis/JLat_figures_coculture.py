@@ -1,13 +1,18 @@
 import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Shared modules
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-from statannotations.Annotator import Annotator 
+from Pairwise_stats import annotate_pairs
+
+# Figures are saved there (see Figure_pool.py to render them in parallel)
+output_dir = r"C:\Output folder directory"
 
 # References to data that we need to plot - reduced compared to JLat gating script
 data_references = ['Total GFP+ cells','% Live cells','% GFP+ cells','Total Live Cells',]
 
-def plot_characteristics_detailed (metadata_coculture, figure_size=4, verbose=False, palette="cubehelix_r"):
+def plot_characteristics_detailed (metadata_coculture, figure_size=4, verbose=False, palette="cubehelix_r", output_dir=output_dir):
     metadata = metadata_coculture.copy ()
     metadata.loc[metadata['Donor'].ne('-'), 'Donor'] = "[co-culture]"
     metadata.loc[metadata['Donor'].eq('-'), 'Donor'] = "[control]"
@@ -16,7 +21,7 @@ def plot_characteristics_detailed (metadata_coculture, figure_size=4, verbose=Fa
     temp = metadata [metadata['Folder tag'] == 0]
     metadata = metadata [(metadata['Folder tag'] != 4) & (metadata['Media'] != 'RPMI')]
     metadata = metadata.sort_values(by=['Stimulus','Donor', 'Media']) 
-    metadata = temp.append (metadata)
+    metadata = pd.concat ([temp, metadata])
     # Make the plot !
     for i in range(len(data_references)):
         hue = ['Folder tag', data_references[i], 'Legend']
@@ -28,17 +33,15 @@ def plot_characteristics_detailed (metadata_coculture, figure_size=4, verbose=Fa
         # Optional log scale
         if i in [0,3]:
             plt.yscale('symlog')
-        # Change the working directory
-        os.chdir(r"C:\Output folder directory")
-        # Save the figure
-        plt.savefig("Co-culture_characteristicsDetailed_" + hue[1], bbox_inches='tight')
+        # Save the figure (in output_dir)
+        plt.savefig(os.path.join(output_dir, "Co-culture_characteristicsDetailed_" + hue[1]), bbox_inches='tight')
         # Optional visualisation
         if verbose:
             plt.show()
         ax.clear()
     return metadata
 
-def plot_characteristics_condensed (metadata_coculture, figure_size=5, verbose=False, palette="cubehelix_r"):
+def plot_characteristics_condensed (metadata_coculture, figure_size=5, verbose=False, palette="cubehelix_r", output_dir=output_dir):
     metadata = metadata_coculture.copy ()
     metadata.loc[metadata['Donor'].ne('-'), 'Donor'] = "Co-culture"
     metadata.loc[metadata['Donor'].eq('-'), 'Donor'] = "Monoculture"
@@ -78,15 +81,11 @@ def plot_characteristics_condensed (metadata_coculture, figure_size=5, verbose=F
                      [('Monoculture','PMA-JQ1 Obesogenic'),('Monoculture','PMA-JQ1 Normogenic')],
                      [('Co-culture','PMA-JQ1 Obesogenic'),('Co-culture','PMA-JQ1 Normogenic')]]
         if pairs != []:
-            annotator = Annotator(ax, pairs, data=metadata, x= hue[0], y=hue[1],  hue=hue[2])
-            annotator.configure(test='t-test_welch', text_format='star', comparisons_correction="bonferroni")
-            annotator.apply_and_annotate()
+            annotate_pairs(ax, pairs, metadata, x=hue[0], y=hue[1], hue=hue[2], test='t-test_welch')
         # Scale the plot
         sns.set_context("talk")
-        # Change the working directory
-        os.chdir(r"C:\Output folder directory")
-        # Save the figure
-        plt.savefig("Co-culture_characteristicsCondensed_" + hue[1], bbox_inches='tight')
+        # Save the figure (in output_dir)
+        plt.savefig(os.path.join(output_dir, "Co-culture_characteristicsCondensed_" + hue[1]), bbox_inches='tight')
         # Optional visualisation
         if verbose:
             plt.show()
@@ -96,7 +95,7 @@ def plot_characteristics_condensed (metadata_coculture, figure_size=5, verbose=F
 # Alternative visualisation as percent stacked barplot 
 # https://www.python-graph-gallery.com/stacked-and-percent-stacked-barplo
 # https://stackoverflow.com/questions/35692781/python-plotting-percentage-in-seaborn-bar-plot
-def plot_migration (metadata_coculture, figure_size=5, verbose=False, palette="cubehelix_r"):
+def plot_migration (metadata_coculture, figure_size=5, verbose=False, palette="cubehelix_r", output_dir=output_dir):
     metadata = metadata_coculture.copy ()
     # Add legend, remove out-of-scope datapoints and sort
     metadata = metadata [((metadata['Folder tag'] == 3)|(metadata['Folder tag'] == 4)) & (metadata['Media'] != 'RPMI')]
@@ -127,22 +126,18 @@ def plot_migration (metadata_coculture, figure_size=5, verbose=False, palette="c
                  [('Normogenic','PMA-JQ1 in Insert'),('Normogenic','PMA-JQ1 in Well')],
                  [('Obesogenic','CTL in Insert'),('Obesogenic','CTL in Well')],
                  [('Obesogenic','PMA-JQ1 in Insert'),('Obesogenic','PMA-JQ1 in Well')]]
-        annotator = Annotator(ax, pairs, data=metadata, x= hue[0], y=hue[1],  hue=hue[2])
-        annotator.configure(test='t-test_welch', text_format='star', comparisons_correction="bonferroni")
-        annotator.apply_and_annotate()
+        annotate_pairs(ax, pairs, metadata, x=hue[0], y=hue[1], hue=hue[2], test='t-test_welch')
         # Scale the plot & other corrections
         #sns.set_context("talk")
-        # Change the working directory
-        os.chdir(r"C:\Output folder directory")
-        # Save the figure
-        plt.savefig("Co-culture_migration_" + hue[1], bbox_inches='tight')
+        # Save the figure (in output_dir)
+        plt.savefig(os.path.join(output_dir, "Co-culture_migration_" + hue[1]), bbox_inches='tight')
         # Optional visualisation
         if verbose:
             plt.show()
         ax.clear()
     return metadata
 
-def plot_patientVariability (metadata_coculture, figure_size=5, verbose=False, palette="cubehelix_r"):
+def plot_patientVariability (metadata_coculture, figure_size=5, verbose=False, palette="cubehelix_r", output_dir=output_dir):
     metadata = metadata_coculture.copy ()
     # Add legend, remove out-of-scope datapoints and sort
     metadata = metadata [(metadata['Folder tag'] != 0) & (metadata['Donor'] != '-')]
@@ -181,27 +176,23 @@ def plot_patientVariability (metadata_coculture, figure_size=5, verbose=False, p
                  [(4,'PMA-JQ1 with hSVF#1'),(4,'PMA-JQ1 with hSVF#2')],
                  [(4,'PMA-JQ1 with hSVF#2'),(4,'PMA-JQ1 with hSVF#4')]
                  ]
-        annotator = Annotator(ax, pairs, data=metadata, x= hue[0], y=hue[1],  hue=hue[2])
-        annotator.configure(test='t-test_welch', text_format='star', comparisons_correction="bonferroni")
-        annotator.apply_and_annotate()
+        annotate_pairs(ax, pairs, metadata, x=hue[0], y=hue[1], hue=hue[2], test='t-test_welch')
         # Scale the plot
         #sns.set_context("talk")
-        # Change the working directory
-        os.chdir(r"C:\Output folder directory")
-        # Save the figure
-        plt.savefig("Co-culture_patientVariability_" + hue[1], bbox_inches='tight')
+        # Save the figure (in output_dir)
+        plt.savefig(os.path.join(output_dir, "Co-culture_patientVariability_" + hue[1]), bbox_inches='tight')
         # Optional visualisation
         if verbose:
             plt.show()
         ax.clear()
     return metadata
 
-def plot_LTculture (metadata_LTculture, metadata_coculture, figure_size=5, verbose=False, palette="dark:green_r"):
+def plot_LTculture (metadata_LTculture, metadata_coculture, figure_size=5, verbose=False, palette="dark:green_r", output_dir=output_dir):
     # Merge two datasets
     metadata = metadata_coculture.copy ()
     metadata = metadata [metadata['Media'] != "RPMI"]
     metadata = metadata [metadata['Folder tag'] != 4] # Keep insert data only
-    metadata = metadata.append(metadata_LTculture)
+    metadata = pd.concat([metadata, metadata_LTculture])
     metadata = metadata [metadata['Folder tag'] != 0] # remove day 0
     #Sort
     metadata = metadata.sort_values(by=['Donor']) 
@@ -232,20 +223,16 @@ def plot_LTculture (metadata_LTculture, metadata_coculture, figure_size=5, verbo
         pairs = [[(1,'PMA-JQ1 Co-culture'),(1,'PMA-JQ1 Monoculture')],
                  [(2,'PMA-JQ1 Co-culture'),(2,'PMA-JQ1 Monoculture')],
                  [(3,'PMA-JQ1 Co-culture'),(3,'PMA-JQ1 Monoculture')]]
-        annotator = Annotator(ax, pairs, data=metadata, x= hue[0], y=hue[1],  hue=hue[2])
-        annotator.configure(test='t-test_welch', text_format='star', comparisons_correction="bonferroni")
-        annotator.apply_and_annotate()
-        # Change the working directory
-        os.chdir(r"C:\Output folder directory")
-        # Save the figure
-        plt.savefig("LTculture_detailed_" + hue[1], bbox_inches='tight')
+        annotate_pairs(ax, pairs, metadata, x=hue[0], y=hue[1], hue=hue[2], test='t-test_welch')
+        # Save the figure (in output_dir)
+        plt.savefig(os.path.join(output_dir, "LTculture_detailed_" + hue[1]), bbox_inches='tight')
         # Optional visualisation
         if verbose:
             plt.show()
         ax.clear()
     return metadata
 
-def plot_restimulation (metadata_restimulation, figure_size=5, verbose=False, palette="dark:green"):
+def plot_restimulation (metadata_restimulation, figure_size=5, verbose=False, palette="dark:green", output_dir=output_dir):
     metadata = metadata_restimulation.copy ()
     # Correct some metadata
     metadata.loc[metadata['Stimulus'].eq('PMA'), 'Stimulus'] = 'PMA-JQ1'
@@ -271,48 +258,42 @@ def plot_restimulation (metadata_restimulation, figure_size=5, verbose=False, pa
                  [(17,'PMA-JQ1'),(17,'CTL restimulated')],
                  [(17,'PMA-JQ1 restimulated'),(17,'CTL restimulated')]
                  ]
-        annotator = Annotator(ax, pairs, data=metadata, x= hue[0], y=hue[1],  hue=hue[2])
-        annotator.configure(test='t-test_welch', text_format='star', comparisons_correction="bonferroni")
-        annotator.apply_and_annotate()
-        # Change the working directory
-        os.chdir(r"C:\Output folder directory")
-        # Save the figure
-        plt.savefig("Reinduction_" + hue[1], bbox_inches='tight')
+        annotate_pairs(ax, pairs, metadata, x=hue[0], y=hue[1], hue=hue[2], test='t-test_welch')
+        # Save the figure (in output_dir)
+        plt.savefig(os.path.join(output_dir, "Reinduction_" + hue[1]), bbox_inches='tight')
         # Optional visualisation
         if verbose:
             plt.show()
         ax.clear()
     return metadata
 
-if __name__ == "__main__":
-    # Pick working directory
-    dir = r'C:\Input folder directory'
-    os.chdir(dir)   # Change the working directory
-    # Import and pool Excel summaries 
-    metadata_coculture = pd.read_excel("Co-culture FACS Experiment Summary.xlsx", index_col=None)
-    metadata_coculture['Experiment tag'] = '0'
-    metadata_coculture_CTL = pd.read_excel("Co-culture FACS controls Experiment Summary.xlsx", index_col=None)
-    metadata_coculture_CTL['Experiment tag'] = '1'
-    metadata_coculture = metadata_coculture.append(metadata_coculture_CTL, ignore_index=True)
-    # Exclude Jurkat and 7AAD-
-    metadata_coculture = metadata_coculture [metadata_coculture['7AAD'] != "-"]
-    metadata_coculture = metadata_coculture [metadata_coculture['Cell type'] != "Jurkat"]
+# Every figure from the Experiment Summaries of dir (queried from its results
+# store), saved into output_dir by processes rendering workers (see Figure_pool.py).
+# Returns the (result, error) of every figure
+def main (dir, output_dir=output_dir, processes=None):
+    # Ingest the Excel summaries that changed into the results store, then
+    # query and pool them, without Jurkat and 7AAD- (see Results_store.py)
+    from Results_store import open_store, ingest_summaries, query_results
+    store = open_store(dir)
+    ingest_summaries(store, dir)
+    excluded = {'7AAD': '-', 'Cell type': 'Jurkat'}
+    metadata_coculture = query_results(store, ['Co-culture FACS', 'Co-culture FACS controls'],
+                                       exclude=excluded)
+    metadata_coculture['Experiment tag'] = (metadata_coculture['Experiment'] == 'Co-culture FACS controls').astype(int).astype(str)
     # Reduce some columns & fill nan's
-    metadata_coculture = metadata_coculture.drop(['Unnamed: 0','Timepoint', 'Med+Fil', 'Stimulation', '7AAD'], axis=1)
+    metadata_coculture = metadata_coculture.drop(['Timepoint', 'Med+Fil', 'Stimulation', '7AAD'], axis=1, errors='ignore')
     metadata_coculture = metadata_coculture.fillna("-")
-    # Plots! - careful with the plt.rcParams["figure.figsize"]
-    plot_patientVariability(metadata_coculture)
-    plot_characteristics_detailed(metadata_coculture)
-    plot_migration(metadata_coculture)
-    plot_characteristics_condensed(metadata_coculture)
+    # Plots! Every figure function is a job of the rendering pool, run in its
+    # own process with its own rcParams (see Figure_pool.py)
+    from Figure_pool import figure_job, render_figures
+    jobs = [figure_job('JLat_figures_coculture', 'plot_patientVariability', (metadata_coculture,), output_dir=output_dir),
+            figure_job('JLat_figures_coculture', 'plot_characteristics_detailed', (metadata_coculture,), output_dir=output_dir),
+            figure_job('JLat_figures_coculture', 'plot_migration', (metadata_coculture,), output_dir=output_dir),
+            figure_job('JLat_figures_coculture', 'plot_characteristics_condensed', (metadata_coculture,), output_dir=output_dir)]
     ## Long term culture X co-culture 
-    os.chdir(dir)   # Change the working directory
-    metadata_LTculture =pd.read_excel("Post-stimulation culture (RPMIx2) Experiment Summary.xlsx", index_col=None)
-    # Exclude Jurkat and 7AAD-
-    metadata_LTculture = metadata_LTculture [metadata_LTculture['7AAD'] != "-"]
-    metadata_LTculture = metadata_LTculture [metadata_LTculture['Cell type'] != "Jurkat"]
+    metadata_LTculture = query_results(store, 'Post-stimulation culture (RPMIx2)', exclude=excluded)
     # Reduce some columns & fill nan's
-    metadata_LTculture = metadata_LTculture.drop(['Unnamed: 0','Timepoint', 'Med+Fil', 'Stimulation', '7AAD', 'Insert type'], axis=1)
+    metadata_LTculture = metadata_LTculture.drop(['Timepoint', 'Med+Fil', 'Stimulation', '7AAD', 'Insert type'], axis=1, errors='ignore')
     metadata_LTculture = metadata_LTculture.fillna("-")
     # Fix the days and media data
     metadata_LTculture.loc[metadata_LTculture['Media'].eq('RPMI'), 'Media'] = "LG"
@@ -321,16 +302,18 @@ if __name__ == "__main__":
     metadata_LTculture.loc[metadata_LTculture['Folder tag'].eq(4), 'Folder tag'] = 14
     metadata_LTculture.loc[metadata_LTculture['Folder tag'].eq(5), 'Folder tag'] = 16
     metadata_LTculture.loc[metadata_LTculture['Folder tag'].eq(1), 'Folder tag'] = 4
-    # Plotting - careful with the plt.rcParams["figure.figsize"]
-    plot_LTculture(metadata_LTculture, metadata_coculture)
+    # Plotting
+    jobs.append(figure_job('JLat_figures_coculture', 'plot_LTculture',
+                           (metadata_LTculture, metadata_coculture), output_dir=output_dir))
     ## Restimulation data
-    os.chdir(dir)   # Change the working directory
-    metadata_restimulation =pd.read_excel("Reinduction Experiment Summary.xlsx", index_col=None)
-    # Exclude Jurkat and 7AAD-
-    metadata_restimulation = metadata_restimulation [metadata_restimulation['7AAD'] != "-"]
-    metadata_restimulation = metadata_restimulation [metadata_restimulation['Cell type'] != "Jurkat"]
+    metadata_restimulation = query_results(store, 'Reinduction', exclude=excluded)
     # Reduce some columns & fill nan's
-    metadata_restimulation = metadata_restimulation.drop(['Unnamed: 0','Timepoint', 'Stimulation', '7AAD'], axis=1)
+    metadata_restimulation = metadata_restimulation.drop(['Timepoint', 'Stimulation', '7AAD'], axis=1, errors='ignore')
     metadata_restimulation = metadata_restimulation.fillna("-")
-    # Plot! Careful with the plt.rcParams["figure.figsize"]
-    metadata = plot_restimulation (metadata_restimulation)
\ No newline at end of file
+    # Plot! All the figures at once
+    jobs.append(figure_job('JLat_figures_coculture', 'plot_restimulation', (metadata_restimulation,), output_dir=output_dir))
+    return render_figures(jobs, processes)
+
+if __name__ == "__main__":
+    # Pick working directory
+    main(r'C:\Input folder directory')
@@ -1,13 +1,18 @@
 import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Shared modules
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-from statannotations.Annotator import Annotator 
+from Pairwise_stats import annotate_pairs
+
+# Figures are saved there (see Figure_pool.py to render them in parallel)
+output_dir = r"C:\Output folder directory"
 
 # References to data that we need to plot - reduced compared to JLat gating script
 data_references = ['% Live cells','% GFP+ cells','MFI GFP+']
 
-def plot_export (metadata, pairs, hue, figure_size=8, rotation=45, name="x", verbose = False, palette = "viridis"):
+def plot_export (metadata, pairs, hue, figure_size=8, rotation=45, name="x", verbose = False, palette = "viridis", output_dir=output_dir):
     # hue = [X-axis label, Legend labels]
     # Start by preparing the plot template etc.
     plt.close('all') # Close any open plots to avoid a mess
@@ -55,56 +60,40 @@ def plot_export (metadata, pairs, hue, figure_size=8, rotation=45, name="x", ver
         else:
             plt.ylabel("Mean Fluorescence Intensity")
         if pairs != []:
-            annotator = Annotator(ax[i], pairs, data=metadata, x= hue[0], y=subplots[i], hue=hue[1])
-            annotator.configure(test='t-test_welch', text_format='star', comparisons_correction="bonferroni")
-            annotator.apply_and_annotate()
+            annotate_pairs(ax[i], pairs, metadata, x=hue[0], y=subplots[i], hue=hue[1], test='t-test_welch')
         # This has to come after data is plotted
         if i == 2:
             ax[i].set_ylim(200, None)
         # Scale the plot
         sns.set_context("talk", font_scale=2)
 
-    # Change the working directory
-    os.chdir(r"C:\Output folder directory")
-    # Save the figure
-    plt.savefig(name, bbox_inches='tight')
+    # Save the figure (in output_dir)
+    plt.savefig(os.path.join(output_dir, name), bbox_inches='tight')
     # Optional visualisation
     if verbose:
         plt.show()
     return metadata
 
 
-if __name__ == "__main__":
-    # Pick working directory
-    dir = r'C:\Input folder directory'
-    os.chdir(dir)   # Change the working directory
-    # Import the Excel summaries 
-    metadata_kinetics = pd.read_excel("PMA Kinetics Experiment Summary.xlsx", index_col=None)
-    metadata_qvdoph = pd.read_excel("Q-VD-OPh Experiment Summary.xlsx", index_col=None)
-    metadata_potentiators =  pd.read_excel("PMA Enhancers Experiment Summary.xlsx", index_col=None)
-    # Exclude Jurkat and 7AAD
-    metadata_kinetics = metadata_kinetics [metadata_kinetics['Cell type'] != "Jurkat"]
-    metadata_kinetics = metadata_kinetics [metadata_kinetics['7AAD'] != "-"]
-    metadata_qvdoph = metadata_qvdoph [metadata_qvdoph['Cell type'] != "Jurkat"]
-    metadata_qvdoph = metadata_qvdoph [metadata_qvdoph['7AAD'] != "-"]
-    metadata_potentiators = metadata_potentiators [metadata_potentiators['Cell type'] != "Jurkat"]
-    metadata_potentiators = metadata_potentiators [metadata_potentiators['7AAD'] != "-"]
-    # Split and reduce the datasets
-    metadata_kinetics_AS = metadata_kinetics[metadata_kinetics['Folder tag'] == 0].copy()
-    metadata_kinetics_D2 = metadata_kinetics[metadata_kinetics['Folder tag'] == 2].copy()
-    metadata_kinetics_mixed = metadata_kinetics[metadata_kinetics['Stimulus'] == 'PMA Iono '].copy()
-    metadata_qvdoph_D2 = metadata_qvdoph[metadata_qvdoph['Folder tag'] == 2]
-    metadata_potentiators_D3 = metadata_potentiators[metadata_potentiators['Folder tag'] == 2]
-    # More tailored edits
-    metadata_kinetics_AS = metadata_kinetics_AS[metadata_kinetics_AS['Timepoint'] != '1h']
-    metadata_kinetics_AS = metadata_kinetics_AS[metadata_kinetics_AS['Timepoint'] != '30h']
-    metadata_kinetics_AS = metadata_kinetics_AS[metadata_kinetics_AS['Timepoint'] != '48h']
-    metadata_kinetics_D2 = metadata_kinetics_D2[metadata_kinetics_D2['Timepoint'] != '1h']
-    metadata_kinetics_D2 = metadata_kinetics_D2[metadata_kinetics_D2['Timepoint'] != '30h']
-    metadata_kinetics_mixed = metadata_kinetics_mixed[metadata_kinetics_mixed['Timepoint'] != '1h']
-    metadata_kinetics_mixed = metadata_kinetics_mixed[metadata_kinetics_mixed['Timepoint'] != '30h']
-    metadata_kinetics_mixed = metadata_kinetics_mixed[metadata_kinetics_mixed['Timepoint'] != '48h']
-    metadata_kinetics_mixed = metadata_kinetics_mixed[metadata_kinetics_mixed['Folder tag'] != 3]
+# Every figure from the Experiment Summaries of dir (queried from its results
+# store), saved into output_dir by processes rendering workers (see Figure_pool.py).
+# Returns the (result, error) of every figure
+def main (dir, output_dir=output_dir, processes=None):
+    # Ingest the Excel summaries that changed into the results store, then query
+    # every dataset without Jurkat and 7AAD- (see Results_store.py)
+    from Results_store import open_store, ingest_summaries, query_results
+    store = open_store(dir)
+    ingest_summaries(store, dir)
+    excluded = {'Cell type': 'Jurkat', '7AAD': '-'}
+    metadata_kinetics_AS = query_results(store, 'PMA Kinetics', {'Folder tag': 0},
+                                         exclude=dict(excluded, Timepoint=['1h', '30h', '48h']))
+    metadata_kinetics_D2 = query_results(store, 'PMA Kinetics', {'Folder tag': 2},
+                                         exclude=dict(excluded, Timepoint=['1h', '30h']))
+    metadata_kinetics_mixed = query_results(store, 'PMA Kinetics', {'Stimulus': 'PMA Iono '},
+                                            exclude=dict(excluded, Timepoint=['1h', '30h', '48h'],
+                                                         **{'Folder tag': 3}))
+    metadata_qvdoph_D2 = query_results(store, 'Q-VD-OPh', {'Folder tag': 2}, exclude=excluded)
+    metadata_potentiators_D3 = query_results(store, 'PMA Enhancers', {'Folder tag': 2}, exclude=excluded)
     potentiator_categories = ["CTL", "Iono", "JQ1", "RVX", "OXA", "PMA", "PMA Iono ", "PMA+JQ1", "PMA+RVX", "PMA+OXA"]
     metadata_potentiators_D3["Stimulus"] = pd.Categorical(metadata_potentiators_D3["Stimulus"], categories = potentiator_categories)
     metadata_potentiators_D3.sort_values(by = "Stimulus")
@@ -129,9 +118,16 @@ if __name__ == "__main__":
                        [('PMA-Iono','iCasp'),('PMA-JQ1','iCasp')],
                        [('PMA','no iCasp'),('PMA-JQ1','no iCasp')],
                        ]
-    # Final plots
-    metadata_kinetics_AS = plot_export(metadata_kinetics_AS, pairs_kinetics_AS, hue=['Timepoint','Stimulus'], name = "JLat_kinetics_D0", palette = "magma", rotation = 0)
-    metadata_kinetics_D2 = plot_export(metadata_kinetics_D2, pairs_kinetics_D2, hue=['Timepoint','Stimulus'], name = "JLat_kinetics_D2", palette = "magma", rotation = 0)
-    metadata_qvdoph_D2 = plot_export(metadata_qvdoph_D2, pairs_qvdoph_D2, hue=['Stimulus','iCasp'], name = "JLat_qvdoph_D2",palette = "rocket_r")
-    metadata_potentiators_D3 = plot_export(metadata_potentiators_D3, [], hue=['Stimulus',''], name = "JLat_enhancers_D3", rotation = 90)
-    metadata_kinetics_mixed = plot_export(metadata_kinetics_mixed, [], hue=['Timepoint','Folder tag'], name = "JLat_kinetics_mixed", palette = "flare", rotation = 0)
+    # Final plots: one job of the rendering pool per figure (own process and
+    # rcParams, see Figure_pool.py)
+    from Figure_pool import figure_job, render_figures
+    jobs = [figure_job('JLat_figures_induction', 'plot_export', (metadata_kinetics_AS, pairs_kinetics_AS), dict(hue=['Timepoint','Stimulus'], name = "JLat_kinetics_D0", palette = "magma", rotation = 0), output_dir=output_dir),
+            figure_job('JLat_figures_induction', 'plot_export', (metadata_kinetics_D2, pairs_kinetics_D2), dict(hue=['Timepoint','Stimulus'], name = "JLat_kinetics_D2", palette = "magma", rotation = 0), output_dir=output_dir),
+            figure_job('JLat_figures_induction', 'plot_export', (metadata_qvdoph_D2, pairs_qvdoph_D2), dict(hue=['Stimulus','iCasp'], name = "JLat_qvdoph_D2",palette = "rocket_r"), output_dir=output_dir),
+            figure_job('JLat_figures_induction', 'plot_export', (metadata_potentiators_D3, []), dict(hue=['Stimulus',''], name = "JLat_enhancers_D3", rotation = 90), output_dir=output_dir),
+            figure_job('JLat_figures_induction', 'plot_export', (metadata_kinetics_mixed, []), dict(hue=['Timepoint','Folder tag'], name = "JLat_kinetics_mixed", palette = "flare", rotation = 0), output_dir=output_dir)]
+    return render_figures(jobs, processes)
+
+if __name__ == "__main__":
+    # Pick working directory
+    main(r'C:\Input folder directory')
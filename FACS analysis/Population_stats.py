@@ -0,0 +1,104 @@
+"""
+Population statistics engine: median, mean, geometric mean, robust CV and any
+percentiles of a channel within a population from a single partial sort
+(np.partition at all the ranks needed at once), instead of one full sort per
+statistic. Statistics are on the linear (compensated) scale, as in flow
+cytometry software; the streaming counterpart is in Chunked_gating.py
+"""
+import numpy as np
+
+# rCV = 100 * (P84.13 - P15.87)/2 / median: the standard deviation of a normal
+# distribution measured from its central 68.26% (insensitive to outliers)
+rcv_percentiles = (15.87, 84.13)
+statistic_names = ['Median', 'Mean', 'gMean', 'rCV']
+
+def percentile_name (percentile):
+    return 'P' + format(percentile, 'g')
+
+# Column of one statistic, e.g. 'Median GFP-A [Live cells]'
+def statistic_column (statistic, channel, population):
+    return statistic + ' ' + channel + ' [' + str(population) + ']'
+
+# Percentiles as np.percentile (linear): position p/100*(n-1) between the order
+# statistics at its floor and ceiling. Returns positions, lower and upper ranks
+def percentile_ranks (n, percentiles):
+    positions = np.asarray(percentiles, dtype=float)/100*(n - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, n - 1)
+    return positions, lower, upper
+
+# Every percentile needed for the statistics (median and rCV included)
+def needed_percentiles (percentiles=()):
+    return [50.0] + list(rcv_percentiles) + [float(p) for p in percentiles]
+
+# Statistics from the order statistics ({rank: value}) and the running sums
+# (n events, sum, positive events, sum of log of the positive values)
+def finish_statistics (n, order_values, total, n_positive, log_total, percentiles=()):
+    names = statistic_names + [percentile_name(p) for p in percentiles]
+    if n == 0:
+        return {name: np.nan for name in names}
+    wanted = needed_percentiles(percentiles)
+    positions, lower, upper = percentile_ranks(n, wanted)
+    values = [order_values[low] + (position - low)*(order_values[high] - order_values[low])
+              for position, low, high in zip(positions, lower, upper)]
+    median = values[0]
+    results = {'Median': median, 'Mean': total/n,
+               # Geometric mean of the positive events only (log undefined otherwise)
+               'gMean': np.exp(log_total/n_positive) if n_positive > 0 else np.nan,
+               'rCV': 100*(values[2] - values[1])/2/median if median != 0 else np.nan}
+    for percentile, value in zip(percentiles, values[3:]):
+        results[percentile_name(percentile)] = value
+    return results
+
+# Running sums of a (chunk of) population values
+def population_sums (values):
+    positive = values[values > 0]
+    return (float(np.sum(values, dtype=np.float64)), len(positive),
+            float(np.sum(np.log(positive.astype(np.float64)))))
+
+# All statistics of the values of one population, with one np.partition
+def summarize (values, percentiles=()):
+    n = len(values)
+    if n == 0:
+        return finish_statistics(0, {}, 0.0, 0, 0.0, percentiles)
+    positions, lower, upper = percentile_ranks(n, needed_percentiles(percentiles))
+    ranks = np.unique(np.concatenate([lower, upper]))
+    partitioned = np.partition(values, ranks)
+    order_values = {int(rank): float(partitioned[rank]) for rank in ranks}
+    return finish_statistics(n, order_values, *population_sums(values), percentiles)
+
+# Statistic requests of the strategies ("statistics": {"channels", "populations",
+# "percentiles"}): {(channel, population): percentiles}, each pair computed once
+def statistic_requests (strategies):
+    requests = {}
+    for strategy in strategies:
+        spec = strategy.get('statistics')
+        if not spec:
+            continue
+        for population in spec['populations']:
+            for channel in spec['channels']:
+                percentiles = requests.get((channel, population), ())
+                percentiles = percentiles + tuple(float(p) for p in spec.get('percentiles', [])
+                                                  if float(p) not in percentiles)
+                requests[(channel, population)] = percentiles
+    return requests
+
+# In-memory statistics: data = {channel: linear values}, masks = {gate: mask}
+# (population None = all events)
+def population_statistics (data, masks, requests):
+    statistics = {}
+    for (channel, population), percentiles in requests.items():
+        values = data[channel] if population is None else data[channel][masks[population]]
+        statistics[(channel, population)] = summarize(values, percentiles)
+    return statistics
+
+# Result columns of a strategy's statistics block
+def statistic_results (spec, statistics):
+    results = []
+    names = statistic_names + [percentile_name(float(p)) for p in spec.get('percentiles', [])]
+    for population in spec['populations']:
+        for channel in spec['channels']:
+            values = statistics[(channel, population)]
+            for name in names:
+                results.append((statistic_column(name, channel, population), values[name]))
+    return results
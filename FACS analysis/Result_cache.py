@@ -0,0 +1,72 @@
+"""
+Persistent on-disk cache of per-file gating results, keyed by the file content
+and by everything that changes the result (gates, hlog parameter, naming)
+"""
+import os
+import json
+import hashlib
+import pandas as pd
+
+# SHA-256 of the file content, read in 1 MB chunks
+def file_digest (file_name, chunk_size=2**20):
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as file_handle:
+        chunk = file_handle.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = file_handle.read(chunk_size)
+    return digest.hexdigest()
+
+# Cache key: the file name is part of it because metadata is read from the name
+def cache_key (file_name, settings):
+    key = [file_digest(file_name), os.path.basename(file_name), settings]
+    key = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+# Return the cached result row (or None). A hit refreshes the entry's mtime,
+# which is what the LRU eviction below is based on. An entry that cannot be
+# read (truncated, corrupt...) is a miss and is deleted, so it gets rewritten
+def cache_load (cache_dir, key):
+    path = os.path.join(cache_dir, key + '.pkl')
+    try:
+        df = pd.read_pickle(path)
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        try:
+            os.remove(path)
+        except FileNotFoundError: # Removed by another worker
+            pass
+        return None
+    return df
+
+# Store a result row, then evict the least recently used entries beyond max_size
+def cache_store (cache_dir, key, df, max_size=2**30):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + '.pkl')
+    # Write + rename, so parallel workers never read a half-written entry
+    temporary = path + '.' + str(os.getpid()) + '.tmp'
+    df.to_pickle(temporary)
+    os.replace(temporary, path)
+    cache_evict(cache_dir, max_size)
+
+def cache_evict (cache_dir, max_size):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.pkl'):
+            try:
+                status = entry.stat()
+            except FileNotFoundError: # Evicted by another worker
+                continue
+            entries.append((status.st_mtime, status.st_size, entry.path))
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total = total - size
@@ -0,0 +1,132 @@
+"""
+Local results store for the figure scripts: every Experiment Summary workbook
+of a folder is ingested once (again only when it changes) into a SQLite
+database, every value keeping its own type, with indexes on the experiment and
+the usual conditions (day, donor, media, stimulus...), so preparing a figure is
+a query instead of parsing the workbooks and filtering the frames by hand
+"""
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+store_name = 'Experiment results.sqlite'
+# Layout of the tables: a store of another version is emptied and re-ingested
+store_version = 2
+summary_suffix = ' Experiment Summary.xlsx'
+# Columns indexed for queries (when present)
+index_columns = ['Experiment', 'Folder tag', 'Donor', 'Media', 'Stimulus', 'Cell type',
+                 '7AAD', 'Timepoint']
+
+def quote (name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+# Open (or create) the store of a folder
+def open_store (folder, file_name=store_name):
+    connection = sqlite3.connect(os.path.join(folder, file_name))
+    if connection.execute('PRAGMA user_version').fetchone()[0] != store_version:
+        with connection:
+            for table in ['sources', 'result_columns', 'results']:
+                connection.execute('DROP TABLE IF EXISTS ' + table)
+            connection.execute('PRAGMA user_version = ' + str(store_version))
+    connection.execute('CREATE TABLE IF NOT EXISTS sources (experiment TEXT PRIMARY KEY, '
+                       'file TEXT, mtime_ns INTEGER, size INTEGER)')
+    # The columns of every experiment (the results table has those of them all)
+    connection.execute('CREATE TABLE IF NOT EXISTS result_columns (experiment TEXT, name TEXT)')
+    connection.execute('CREATE TABLE IF NOT EXISTS results ("Experiment" TEXT)')
+    return connection
+
+# Replace the rows of one experiment by summary (a DataFrame); columns the
+# results table does not have yet are added, without a type affinity (the
+# first workbook with a column does not decide how the others are stored)
+def store_summary (connection, experiment, summary):
+    summary = summary.loc[:, [c for c in summary.columns if not str(c).startswith('Unnamed:')]]
+    summary = summary.drop(columns=['Experiment'], errors='ignore')
+    summary.insert(0, 'Experiment', experiment)
+    existing = [row[1] for row in connection.execute('PRAGMA table_info(results)')]
+    for column in summary.columns:
+        if column not in existing:
+            connection.execute('ALTER TABLE results ADD COLUMN ' + quote(column))
+    connection.execute('DELETE FROM results WHERE "Experiment" = ?', (experiment,))
+    connection.execute('DELETE FROM result_columns WHERE experiment = ?', (experiment,))
+    connection.executemany('INSERT INTO result_columns VALUES (?, ?)',
+                           [(experiment, str(column)) for column in summary.columns])
+    columns = ', '.join(quote(column) for column in summary.columns)
+    marks = ', '.join('?'*len(summary.columns))
+    rows = summary.astype(object).where(summary.notna(), None).itertuples(index=False, name=None)
+    connection.executemany('INSERT INTO results (' + columns + ') VALUES (' + marks + ')',
+                           [tuple(value.item() if isinstance(value, np.generic) else value
+                                  for value in row) for row in rows])
+    for column in index_columns:
+        if column in summary.columns:
+            connection.execute('CREATE INDEX IF NOT EXISTS ' + quote('results ' + column) +
+                               ' ON results (' + quote(column) + ')')
+
+# Ingest every "<experiment> Experiment Summary.xlsx" of folder that is new or
+# changed since the last call (the Parquet copy written next to it by
+# Result_table.export_table is read instead when it is up to date).
+# Returns the experiments (re)ingested
+def ingest_summaries (connection, folder):
+    sources = {row[0]: (row[2], row[3]) for row in connection.execute('SELECT * FROM sources')}
+    ingested = []
+    for file_name in sorted(os.listdir(folder)):
+        if not file_name.endswith(summary_suffix):
+            continue
+        experiment = file_name[:-len(summary_suffix)]
+        path = os.path.join(folder, file_name)
+        status = os.stat(path)
+        if sources.get(experiment) == (status.st_mtime_ns, status.st_size):
+            continue
+        parquet_name = path[0:path.rfind('.')] + '.parquet'
+        summary = None
+        if os.path.exists(parquet_name) and os.stat(parquet_name).st_mtime_ns >= status.st_mtime_ns:
+            try:
+                summary = pd.read_parquet(parquet_name)
+            except ImportError:
+                pass
+        if summary is None:
+            summary = pd.read_excel(path, index_col=None)
+        with connection: # One transaction per experiment
+            store_summary(connection, experiment, summary)
+            connection.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)',
+                               (experiment, file_name, status.st_mtime_ns, status.st_size))
+        ingested.append(experiment)
+    return ingested
+
+# Rows of the given experiments (in that order) matching every condition
+# {column: value or list of values}, minus the rows matching any of exclude
+# (same form), e.g. query_results(store, ['PMA Kinetics'], {'Folder tag': 0},
+# exclude={'Cell type': 'Jurkat', '7AAD': '-'}). Only the columns of the
+# selected experiments are returned (blank ones included)
+def query_results (connection, experiments=None, conditions=None, exclude=None):
+    clauses = []
+    parameters = []
+    def values_of (value):
+        return list(value) if isinstance(value, (list, tuple, set)) else [value]
+    if experiments is not None:
+        experiments = values_of(experiments)
+        conditions = dict(conditions or {}, Experiment=experiments)
+    for column, value in (conditions or {}).items():
+        values = values_of(value)
+        clauses.append(quote(column) + ' IN (' + ', '.join('?'*len(values)) + ')')
+        parameters.extend(values)
+    for column, value in (exclude or {}).items():
+        values = values_of(value)
+        # NULL (missing) never equals an excluded value
+        clauses.append('(' + quote(column) + ' IS NULL OR ' + quote(column) + ' NOT IN (' +
+                       ', '.join('?'*len(values)) + '))')
+        parameters.extend(values)
+    query = 'SELECT * FROM results'
+    if clauses:
+        query = query + ' WHERE ' + ' AND '.join(clauses)
+    order = 'rowid'
+    if experiments is not None:
+        order = ('CASE "Experiment" ' + ' '.join('WHEN ? THEN ' + str(i) for i in range(len(experiments))) +
+                 ' END, rowid')
+        parameters.extend(experiments)
+    results = pd.read_sql_query(query + ' ORDER BY ' + order, connection, params=parameters)
+    query = 'SELECT DISTINCT name FROM result_columns'
+    if experiments is not None:
+        query = query + ' WHERE experiment IN (' + ', '.join('?'*len(experiments)) + ')'
+    names = {row[0] for row in connection.execute(query, experiments or [])}
+    return results.loc[:, [column for column in results.columns if column in names]]
@@ -0,0 +1,109 @@
+"""
+Hot-path instrumentation: wall time, CPU time and memory of each stage of the
+gating pipeline, per file. Stages are laps: lap(profile, name) closes the stage
+that ran since the previous lap, so instrumented code stays linear. Memory is
+read from the process RSS (cheap, unlike tracing every allocation). Records are
+appended as JSON lines to a log shared by all worker processes and aggregated
+into a summary table at the end of a batch
+"""
+import os
+import sys
+import json
+import time
+import pandas as pd
+
+# Resident memory of this process in bytes (None if it cannot be read)
+def current_rss ():
+    try:
+        with open('/proc/self/statm') as file_handle: # Linux
+            return int(file_handle.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+# Peak resident memory of this process in bytes (None if it cannot be read)
+def peak_rss ():
+    try:
+        import resource
+    except ImportError: # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset
+        except (ImportError, AttributeError):
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak*1024 # kB on Linux
+
+# Start profiling one file (or folder)
+def start_profile (file_name):
+    profile = {'file': str(file_name), 'records': []}
+    mark(profile)
+    return profile
+
+def mark (profile):
+    profile['wall'] = time.perf_counter()
+    profile['cpu'] = time.process_time()
+    profile['rss'] = current_rss()
+    profile['peak'] = peak_rss()
+
+# Close the current stage: allocated = change of the resident memory over the
+# stage, peak = how much it raised the peak resident memory of the process
+def lap (profile, stage):
+    if profile is None:
+        return
+    wall = time.perf_counter() - profile['wall']
+    cpu = time.process_time() - profile['cpu']
+    rss = current_rss()
+    peak = peak_rss()
+    profile['records'].append({'file': profile['file'], 'stage': stage, 'wall': wall, 'cpu': cpu,
+                               'allocated': None if rss is None else rss - profile['rss'],
+                               'peak': None if peak is None else peak - profile['peak'],
+                               'pid': os.getpid(), 'time': time.time()})
+    mark(profile) # The bookkeeping above is not charged to the next stage
+
+# Append the records of a profile to the log (one write per profile, so that
+# workers appending to the same log do not interleave lines)
+def write_profile (profile, log_file):
+    if profile is None:
+        return
+    lines = ''.join(json.dumps(record) + '\n' for record in profile['records'])
+    with open(log_file, 'a') as file_handle:
+        file_handle.write(lines)
+
+# Records of the log as a table, from byte offset on (e.g. the log size at the
+# start of a batch, to only keep that batch)
+def read_profile_log (log_file, offset=0):
+    records = []
+    try:
+        with open(log_file, 'rb') as file_handle:
+            file_handle.seek(offset)
+            for line in file_handle:
+                if line.strip():
+                    records.append(json.loads(line))
+    except FileNotFoundError:
+        pass
+    records = pd.DataFrame(records, columns=['file', 'stage', 'wall', 'cpu', 'allocated',
+                                             'peak', 'pid', 'time'])
+    measures = ['wall', 'cpu', 'allocated', 'peak']
+    records[measures] = records[measures].astype(float) # Unreadable memory -> nan
+    return records
+
+# Aggregate per stage (in order of first appearance): files, total/mean/max wall
+# time, share of the total wall time, total CPU time, mean allocated and max peak (MB)
+def profile_summary (records):
+    stages = list(pd.unique(records['stage']))
+    grouped = records.groupby('stage', sort=False)
+    summary = pd.DataFrame({'Files': grouped['file'].nunique(),
+                            'Wall total (s)': grouped['wall'].sum(),
+                            'Wall mean (s)': grouped['wall'].mean(),
+                            'Wall max (s)': grouped['wall'].max(),
+                            'CPU total (s)': grouped['cpu'].sum(),
+                            'Allocated mean (MB)': grouped['allocated'].mean()/2**20,
+                            'Peak max (MB)': grouped['peak'].max()/2**20}).loc[stages]
+    summary.insert(4, 'Wall share (%)', summary['Wall total (s)']/summary['Wall total (s)'].sum()*100)
+    summary.index.name = 'Stage'
+    return summary
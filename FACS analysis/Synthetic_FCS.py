@@ -0,0 +1,82 @@
+"""
+Synthetic J-LAT samples for benchmarks: event populations (singlets, doublets,
+debris, dead and GFP+ cells) are drawn on the hlog display scale around the
+gates of JLat_gating_strategy.json, mapped back to raw values with the exact
+inverse transform and written as FCS 3.0 files (float32 list mode)
+"""
+import numpy as np
+from Hlog_transform import hlog_inv, machine_max
+
+# Fractions of each population: doublets and debris fall outside the
+# singlet gates, dead cells above the 7AAD threshold, GFP+ above the GFP one
+default_mixture = {'doublets': 0.15, 'debris': 0.10, 'dead': 0.25, 'GFP+': 0.40}
+
+# Gated channels on the hlog scale (b = 500, r = 10**4, d = log10(2**18))
+def synthetic_events (n_events, mixture=default_mixture, seed=0):
+    rng = np.random.default_rng(seed)
+    kind = rng.random(n_events)
+    doublets = kind < mixture['doublets']
+    debris = (kind >= mixture['doublets']) & (kind < mixture['doublets'] + mixture['debris'])
+    # Singlets sit on the FSC-A/FSC-H diagonal band and the FSC-A/SSC-A ellipse
+    fsc_a = rng.normal(9200, 220, n_events)
+    fsc_h = 7950 + (fsc_a - 8190)*(1750/1800) + rng.normal(62, 25, n_events)
+    ssc_a = rng.normal(8050, 220, n_events)
+    # Doublets: more area for the same height; debris: small and dim
+    fsc_h[doublets] = fsc_h[doublets] - rng.normal(400, 80, doublets.sum())
+    fsc_a[debris] = rng.normal(7200, 500, debris.sum())
+    fsc_h[debris] = fsc_a[debris] - rng.normal(150, 200, debris.sum())
+    ssc_a[debris] = rng.normal(6800, 600, debris.sum())
+    dead = rng.random(n_events) < mixture['dead']
+    aad = np.where(dead, rng.normal(4200, 600, n_events), rng.normal(200, 450, n_events))
+    positive = rng.random(n_events) < mixture['GFP+']
+    gfp = np.where(positive, rng.normal(3200, 700, n_events), rng.normal(150, 350, n_events))
+    events = {'FSC-A': fsc_a, 'FSC-H': fsc_h, 'SSC-A': ssc_a, '7AAD-A': aad, 'GFP-A': gfp}
+    return {c: np.clip(values, -9999, 9999) for c, values in events.items()}
+
+# Same events on the raw (instrument) scale, plus the acquisition time
+# (seconds at 10000 events/s)
+def synthetic_sample (n_events, mixture=default_mixture, seed=0, b=500):
+    events = synthetic_events(n_events, mixture, seed)
+    raw = {c: hlog_inv(events[c], b) for c in events}
+    raw['Time'] = np.arange(n_events)/10000
+    return raw
+
+# FCS 3.0 writer: float32 list mode, big-endian, $PnR = range of every channel.
+# Offsets above 99999999 are only given in the TEXT segment (as FCS 3.0 allows)
+def write_fcs (file_name, data, value_range=machine_max, extra_keywords=None):
+    names = list(data)
+    n_events = len(data[names[0]])
+    raw = np.column_stack([data[name] for name in names]).astype('>f4').tobytes()
+    keywords = {'$BYTEORD': '4,3,2,1', '$DATATYPE': 'F', '$MODE': 'L', '$NEXTDATA': '0',
+                '$PAR': str(len(names)), '$TOT': str(n_events),
+                '$BEGINANALYSIS': '0', '$ENDANALYSIS': '0',
+                '$BEGINSTEXT': '0', '$ENDSTEXT': '0'}
+    for i, name in enumerate(names, 1):
+        keywords['$P' + str(i) + 'N'] = name
+        keywords['$P' + str(i) + 'B'] = '32'
+        keywords['$P' + str(i) + 'E'] = '0,0'
+        keywords['$P' + str(i) + 'R'] = str(value_range)
+    keywords.update(extra_keywords or {})
+    text_begin = 58
+    # The data offsets are part of the TEXT segment: iterate until they settle
+    data_begin = 0
+    while True:
+        keywords['$BEGINDATA'] = str(data_begin)
+        keywords['$ENDDATA'] = str(data_begin + len(raw) - 1)
+        text = ('/' + ''.join(key + '/' + value + '/' for key, value in keywords.items())).encode('ascii')
+        if text_begin + len(text) == data_begin:
+            break
+        data_begin = text_begin + len(text)
+    data_end = data_begin + len(raw) - 1
+    offsets = [text_begin, data_begin - 1, data_begin, data_end, 0, 0]
+    if data_end > 99999999:
+        offsets[2:4] = [0, 0]
+    header = 'FCS3.0    ' + ''.join('%8d' % offset for offset in offsets)
+    with open(file_name, 'wb') as file_handle:
+        file_handle.write(header.encode('ascii'))
+        file_handle.write(text)
+        file_handle.write(raw)
+
+# Write a synthetic sample of n_events to file_name
+def write_synthetic_fcs (file_name, n_events, mixture=default_mixture, seed=0):
+    write_fcs(file_name, synthetic_sample(n_events, mixture, seed))
@@ -1,19 +1,20 @@
 import os
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from statannotations.Annotator import Annotator 
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Shared modules
+from Result_table import result_table, table_append, table_frame
+from Pairwise_stats import annotate_pairs
 
 
 def input_xlsx_data (input_dir):
-    os.chdir(input_dir)   # Change the working directory
-    file_names = os.listdir() # Check the files in the directory
-    metadata = pd.DataFrame()
+    file_names = os.listdir(input_dir) # Check the files in the directory
+    metadata = result_table(keep_index=True)
     for filename in file_names:
-        excel_tabs = pd.ExcelFile(filename).sheet_names 
+        workbook = pd.ExcelFile(os.path.join(input_dir, filename))
+        excel_tabs = workbook.sheet_names 
         for tab in excel_tabs:
-           data = pd.read_excel(filename, sheet_name=tab, index_col=1, header = None)
+           data = pd.read_excel(workbook, sheet_name=tab, index_col=1, header = None)
            # Remove all nans
            data = data.iloc[:, 1:(data.shape[1]-1)] # data.shape[1] gives number of columns
            while data.iloc[0].isnull().values.any():
@@ -39,10 +40,12 @@ def input_xlsx_data (input_dir):
                if lipid in tab:
                    media = lipid
            data ['Media type'] = media
-           metadata = metadata.append(data)
-    return metadata 
+           table_append(metadata, data)
+    return table_frame(metadata) 
 
 def plot_oblatElipse_perP (metadata, hSVF, exceptions, output_dir, plot, verbose = True):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     metadata_toplot = metadata[metadata['Donor'] == hSVF]
     for exception in exceptions : 
         metadata_toplot = metadata_toplot[metadata_toplot['Day'] != exception]    
@@ -83,24 +86,21 @@ def plot_oblatElipse_perP (metadata, hSVF, exceptions, output_dir, plot, verbose
                   [('J30', 'LG'),('J30', 'HG')],
                   [('J44', 'LG'),('J44', 'HG')],
                   [('J4', 'EGM'),('J14', 'LG')]]
-    annotator = Annotator(ax, stat_pairs, data=metadata_toplot, x='Day', y='oblate ellipse', hue = 'Media type')
-    annotator.configure(test='Mann-Whitney', text_format='star', comparisons_correction="bonferroni")
-    annotator.apply_and_annotate()
+    annotate_pairs(ax, stat_pairs, metadata_toplot, x='Day', y='oblate ellipse', hue='Media type', test='Mann-Whitney')
     # Save the plots
-    os.chdir(output_dir)   # Change the working directory
     if plot == 0:
-        plt.savefig('Boxplot '+ hSVF +'.png', bbox_inches='tight')
+        plt.savefig(os.path.join(output_dir, 'Boxplot '+ hSVF +'.png'), bbox_inches='tight')
     elif plot == 1:
-        plt.savefig('Barplot '+ hSVF +'.png', bbox_inches='tight')
+        plt.savefig(os.path.join(output_dir, 'Barplot '+ hSVF +'.png'), bbox_inches='tight')
     # Optional visualisation 
     if verbose:
         plt.show()
     plt.close('all') # Close any open plots to avoid a mess
     return metadata_toplot
 
-if __name__ == "__main__":
-    input_dir = r'C:\Input folder directory'
-    output_dir = r'C:\Output folder directory'
+# Whole analysis: read the measurements of input_dir and draw the box and bar
+# plots of every donor into output_dir
+def main (input_dir, output_dir, verbose = True):
     metadata = input_xlsx_data (input_dir)
     # Convert um^3 to mm^3
     metadata ['oblate ellipse'] = (metadata ['oblate ellipse']*0.000000001).astype('float64')
@@ -110,4 +110,10 @@ if __name__ == "__main__":
     for k in range (4):
         for i in [0,1]:
             metadata_toplot = plot_oblatElipse_perP (metadata, hSVF[k], exceptions[k], 
-                                   output_dir, plot = i)
\ No newline at end of file
+                                   output_dir, plot = i, verbose = verbose)
+    return metadata
+
+if __name__ == "__main__":
+    input_dir = r'C:\Input folder directory'
+    output_dir = r'C:\Output folder directory'
+    main(input_dir, output_dir)
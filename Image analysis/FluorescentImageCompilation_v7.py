@@ -1,55 +1,79 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Shared modules
 import pandas as pd
 import numpy as np
 from PIL import Image
-import matplotlib.pyplot as plt
+from Result_table import result_table, table_append, table_frame
 
-def merge_three_channels (image_names, verbose = False):
-    plt.rcParams["figure.figsize"] = (20, 20)
+# Channel scaling: the mean non-zero intensity of each channel (MitoTracker,
+# Bodipy, Hoechst = R, G, B) is brought to intensity_scales/3, stretched further
+# if the brightest pixel would stay under max_pixel, and clipped at saturation
+intensity_scales = [200, 200, 100]
+max_pixel = [175, 175, 150]
+saturation = 225
+
+# Values of channel i of an image (file name or array already reduced to it)
+def channel_values (image, i):
+    if isinstance(image, np.ndarray):
+        return image
+    image = np.asarray(Image.open(image))
+    return image if image.ndim == 2 else image[:, :, i]
+
+# Sum and number of the non-zero pixels and maximum of a channel
+def channel_statistics (values):
+    return (float(values.sum(dtype=np.float64)), np.count_nonzero(values), float(values.max()))
+
+# Statistics of several images of a channel pooled (e.g. the replicates of a condition)
+def pool_statistics (statistics):
+    return (sum(s[0] for s in statistics), sum(s[1] for s in statistics),
+            max(s[2] for s in statistics))
+
+# Factors applied to the values/3 of channel i given its statistics: the
+# average scaling and the stretch (1 unless the maximum stays too low)
+def channel_scales (statistics, i):
+    total, count, maximum = statistics
+    if count == 0: # Black channel
+        return 0.0, 1.0
+    # Modify intensities based on average values
+    scale = intensity_scales[i]/(total/count)
+    # Stretch if max too low
+    peak = maximum/3*scale
+    return scale, max_pixel[i]/peak if peak < max_pixel[i] else 1.0
+
+# Composite (rows x columns x RGB, 8-bit) of the three channels of a field:
+# images are the MitoTracker, Bodipy and Hoechst file names (or channel arrays).
+# statistics: the per-channel statistics to scale with (e.g. pooled across the
+# replicates of a condition, see bulk_analysis), by default those of the images.
+# output_name: write the composite there (format from the extension, e.g. .png
+# or .tif)
+def merge_three_channels (images, verbose = False, statistics = None, output_name = None):
     merger = []
-    for i in range(len(image_names)):
-        input_image = Image.open(image_names[i])
-        input_pixels = input_image.load()
-        width = input_image.width
-        height = input_image.height
-        # Split the image into three channels
-        monocolor = np.empty((width, height))
-        summa = 0
-        counter = 0
-        for x in range(width):
-            for y in range(height):
-                pixel = input_pixels[x, y]
-                monocolor[x, y] = pixel[i] / 3
-                if pixel [i] > 0:
-                    summa = summa + pixel [i]
-                    counter = counter + 1
-        # Modify intensities based on average values
-        average = summa / counter 
-        intensity_scales = [200, 200, 100]
-        monocolor = monocolor*(intensity_scales[i]/average)
-        # Stretch if max too low
-        max_pixel = [175, 175, 150]
-        if np.max(monocolor) < max_pixel[i]:
-            print (np.max(monocolor))
-            monocolor = monocolor*(max_pixel[i]/np.max(monocolor))
+    for i in range(len(images)):
+        values = channel_values(images[i], i)
+        scale, stretch = channel_scales(statistics[i] if statistics is not None
+                                        else channel_statistics(values), i)
+        monocolor = values/3*scale
+        if stretch != 1.0:
+            monocolor *= stretch
         # Remove oversaturated values (max<255)
-        for x in range(width):
-            for y in range(height):
-                if monocolor[x, y] > 225:
-                    monocolor[x, y] = 225
-        # Optional visualisation                 
-        if verbose:
-            plt.imshow(monocolor, cmap='gray')
-            plt.title([i])
-            plt.show()
-        # Preserve the result
-        merger.append(monocolor)
+        merger.append(np.minimum(monocolor, saturation, out=monocolor))
     # Stack RGB and export
-    rgb = (np.dstack((merger[0],merger[1],merger[2]))).astype(np.uint8)
-    plt.imshow(rgb)
-    plt.axis('off')  
+    rgb = np.dstack(merger).astype(np.uint8)
+    if output_name is not None:
+        Image.fromarray(rgb).save(output_name)
+    # Optional visualisation
     if verbose:
+        import matplotlib.pyplot as plt
+        plt.rcParams["figure.figsize"] = (20, 20)
+        for i in range(len(images)):
+            plt.imshow(rgb[:, :, i], cmap='gray')
+            plt.title([i])
+            plt.show()
+        plt.imshow(rgb)
+        plt.axis('off')
         plt.show()
-    return
+    return rgb
 
 # Read return metadata from a file name (e.g. media type or microscope magnification)
 def metadata_read (file_name):
@@ -92,49 +116,72 @@ def metadata_read (file_name):
     return df
 
 
-def bulk_analysis (dir, folder_input, folder_output = r'\Output folder directory', test = False):
+# Merge the three channels of every field of the input folders (one folder per
+# donor, in donor order) into folder_output as output_format images.
+# group_normalization: scale every replicate of a condition (donor, media,
+# ascorbic acid, magnification) alike, so that they can be compared; otherwise
+# every field is scaled on its own. test: first folder only, shown instead
+def bulk_analysis (dir, folder_input, folder_output = r'\Output folder directory', test = False,
+                   group_normalization = False, output_format = 'png'):
     #♠ Gather and order metadata of files across all folders
-    metadata = pd.DataFrame()
+    metadata = result_table()
     for folder in folder_input:
-        os.chdir(dir + folder)   # Change the working directory
-        file_names = os.listdir()    # Check the files in the directory
+        file_names = os.listdir(dir + folder)    # Check the files in the directory
         for file in file_names:
-            metadata = metadata.append(metadata_read(file))
+            table_append(metadata, metadata_read(file))
+    metadata = table_frame(metadata)
     # Re-arrange the data to keep replicates near one another
-    metadata = metadata.sort_values(by=['Donor','Media type', 'Ascorbic acid','Magnificiation',
-                                        'Replicate','Channel'])
-    # Merge it all!
+    condition = ['Donor','Media type', 'Ascorbic acid','Magnificiation']
+    metadata = metadata.sort_values(by=condition + ['Replicate','Channel'])
+    # One field = the three channels of a replicate; fields of a condition are
+    # consecutive and normalised together with group_normalization
     n = 3
+    groups = []
     for i in range ( len (metadata)//n):
-        # Subset metadata
         k = i*n
         metadata_temp = (metadata [k:k+n])
-        # Move to the correct folder
-        if test :
-            os.chdir(dir + folder_input[0])
-            folder_output = folder_input[0]
+        key = tuple(metadata_temp.iloc[0][condition])
+        if group_normalization and groups and groups[-1][0] == key:
+            groups[-1][1].append(metadata_temp)
         else:
-            indexer = 1
-            os.chdir(dir + folder_input[int(metadata_temp.iloc[0]['Donor'])-indexer])      
-        # Subset file names
-        temp_1 = metadata_temp [metadata_temp['Channel'] == 'MitoTracker']
-        temp_2 = metadata_temp [metadata_temp['Channel'] == 'Bodipy']
-        temp_3 = metadata_temp [metadata_temp['Channel'] == 'Hoechst']
-        image_names = [temp_1.iloc[0]['File Name'],
-                       temp_2.iloc[0]['File Name'],
-                       temp_3.iloc[0]['File Name']]
-        plt.close('all') # Close any open plots to avoid a mess
-        merge_three_channels(image_names)
-        os.chdir(dir + folder_output) # Where to save the figure
-        fig_name = metadata_temp.iloc[0]['File Name'][0:10] + metadata_temp.iloc[0]['Ascorbic acid'] + ' ' + metadata_temp.iloc[0]['Media type'] + ' ' + metadata_temp.iloc[0]['Magnificiation'] + ' '  + metadata_temp.iloc[0]['Replicate']
-        if not test:
-            plt.savefig(fig_name, transparent=True, bbox_inches='tight')
-        else:
-            plt.show()
+            groups.append((key, [metadata_temp]))
+    # Merge it all!
+    for key, fields in groups:
+        channels = []
+        for metadata_temp in fields:
+            # Folder of the images
+            if test :
+                folder = folder_input[0]
+                folder_output = folder_input[0]
+            else:
+                indexer = 1
+                folder = folder_input[int(metadata_temp.iloc[0]['Donor'])-indexer]
+            # Subset file names
+            temp_1 = metadata_temp [metadata_temp['Channel'] == 'MitoTracker']
+            temp_2 = metadata_temp [metadata_temp['Channel'] == 'Bodipy']
+            temp_3 = metadata_temp [metadata_temp['Channel'] == 'Hoechst']
+            image_names = [os.path.join(dir + folder, temp_1.iloc[0]['File Name']),
+                           os.path.join(dir + folder, temp_2.iloc[0]['File Name']),
+                           os.path.join(dir + folder, temp_3.iloc[0]['File Name'])]
+            channels.append([channel_values(image_names[i], i) for i in range(3)])
+        # Channel statistics of the field, or pooled across the condition
+        statistics = [pool_statistics([channel_statistics(values[i]) for values in channels])
+                      for i in range(3)]
+        for metadata_temp, values in zip(fields, channels):
+            fig_name = metadata_temp.iloc[0]['File Name'][0:10] + metadata_temp.iloc[0]['Ascorbic acid'] + ' ' + metadata_temp.iloc[0]['Media type'] + ' ' + metadata_temp.iloc[0]['Magnificiation'] + ' '  + metadata_temp.iloc[0]['Replicate']
+            if not test:
+                merge_three_channels(values, statistics = statistics,
+                                     output_name = os.path.join(dir + folder_output, fig_name + '.' + output_format))
+            else:
+                import matplotlib.pyplot as plt
+                plt.close('all') # Close any open plots to avoid a mess
+                plt.rcParams["figure.figsize"] = (20, 20)
+                plt.imshow(merge_three_channels(values, statistics = statistics))
+                plt.axis('off')
+                plt.show()
             
 
 if __name__ == "__main__":
-    import os
     dir = r'C:\Input folder directory'
     folder_input = ['\Input folder directory #1',
                '\Input folder directory #2',
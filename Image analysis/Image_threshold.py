@@ -0,0 +1,49 @@
+"""
+Image thresholding engine shared by the Red Oil O and trichrome analyses: a
+recipe (grayscale or one colour channel, optionally inverted, and a threshold)
+is applied to the whole pixel array at once with numpy and the positive area
+and intensity statistics of a photograph are read from its intensity
+histogram (the binary mask is only built on request)
+"""
+import numpy as np
+from PIL import Image
+
+# Statistics returned besides the positive area (intensities on the 0-255 scale
+# of the recipe, i.e. after grayscale/channel selection and inversion)
+intensity_columns = ['Mean intensity', 'SD intensity', 'Mean positive intensity']
+
+# Intensities of an image (file name, PIL image or array): channel None =
+# grayscale (ITU-R 601-2 luma, as ImageOps.grayscale), an index = that colour
+# channel; invert = 255 - intensity (as ImageOps.invert, 8-bit images)
+def image_intensities (image, channel=None, invert=False):
+    if isinstance(image, np.ndarray):
+        if channel is None and image.ndim == 3:
+            image = Image.fromarray(image)
+    elif not isinstance(image, Image.Image):
+        image = Image.open(image)
+    if isinstance(image, Image.Image):
+        if channel is None and image.mode != 'L':
+            image = image.convert('L')
+        image = np.asarray(image)
+    values = image if channel is None else image[:, :, channel]
+    return 255 - values if invert else values
+
+# Positive area (% of the pixels at or above threshold) and intensity
+# statistics of an image after the recipe (see image_intensities), all from one
+# intensity histogram; mask: also return the binary mask of the positive pixels
+# (rows x columns)
+def quantify_image (image, channel=None, invert=False, threshold=128, mask=False):
+    values = image_intensities(image, channel, invert)
+    histogram = np.bincount(values.ravel(), minlength=256)
+    levels = np.arange(len(histogram))
+    first = max(int(np.ceil(threshold)), 0) # First positive intensity
+    n_positive = histogram[first:].sum()
+    mean = (histogram*levels).sum()/values.size
+    results = {'Positive area (%)': n_positive/values.size*100,
+               'Mean intensity': float(mean),
+               'SD intensity': float(np.sqrt((histogram*(levels - mean)**2).sum()/values.size)),
+               'Mean positive intensity': float((histogram[first:]*levels[first:]).sum()/n_positive)
+                                          if n_positive else np.nan}
+    if mask:
+        results['Mask'] = values >= threshold
+    return results
@@ -1,8 +1,13 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Shared modules
 import pandas as pd
-import numpy as np
-from PIL import Image, ImageOps
-import matplotlib.pyplot as plt
-import seaborn as sns
+from Result_table import result_table, table_append, table_frame, export_table
+from Image_threshold import quantify_image, intensity_columns
+
+# Collagen is stained blue: inverted blue channel, unstained from 15 (5 on the
+# former 0-85 scale of the inverted intensity / 3)
+recipe = {'channel': 2, 'invert': True, 'threshold': 15}
 
 # Read return metadata from a file name (e.g. media type or microscope magnification)
 def photo_metadata_read (file_name):
@@ -40,67 +45,67 @@ def photo_metadata_read (file_name):
 #♠ Collate data from multiple files across several input folders
 def photo_metadata_collate (dir, folder_input):
     #♠ Gather and order metadata of files across all folders
-    metadata = pd.DataFrame()
+    metadata = result_table()
     for folder in folder_input:
-        os.chdir(dir + folder)   # Change the working directory
-        file_names = os.listdir()    # Check the files in the directory
+        file_names = os.listdir(dir + folder)    # Check the files in the directory
         for file in file_names:
-            metadata = metadata.append(photo_metadata_read(file))
-    return metadata 
+            table_append(metadata, photo_metadata_read(file))
+    return table_frame(metadata)
 
-# Analyse collagen content in an image aka blue channel
-def photo_binary_analysis (image_name, verbose = False):
-    plt.rcParams["figure.figsize"] = (20, 20)
-    # Load image and prep a dataset
-    input_image = Image.open(image_name)
-    width = input_image.width
-    height = input_image.height
-    monocolor = np.empty((width, height))
-    # Invert the input
-    inverted = ImageOps.invert(input_image)
-    input_pixels = inverted.load()
-    # Extract one channel info
-    non_zero_counter = 0
-    for x in range(width):
-        for y in range(height):
-            pixel = input_pixels[x, y]
-            monocolor[x, y] = pixel[2] / 3
-            #•Threshold the values
-            if monocolor[x, y]  < 5:
-                monocolor[x, y]  = 0
-            else:
-                non_zero_counter = non_zero_counter + 1
-    # Optional visualisation                 
+# Analyse collagen content in an image aka blue channel: % of the surface
+# labelled (or, with statistics, a dict of it as 'Percentage' and of the
+# intensity statistics)
+def photo_binary_analysis (image_name, verbose = False, statistics = False):
+    # Invert and threshold the blue channel at once (see Image_threshold.py)
+    results = quantify_image(image_name, mask = verbose, **recipe)
+    percentage = 100 - results['Positive area (%)']
+    # Optional visualisation (the unstained surface)
     if verbose:
-        plt.imshow(monocolor, cmap='gray')
+        import matplotlib.pyplot as plt
+        plt.rcParams["figure.figsize"] = (20, 20)
+        plt.imshow(results['Mask'], cmap='gray')
         plt.show()
-    return (100-non_zero_counter/width/height*100)
+    if statistics:
+        return dict(results, Percentage = percentage)
+    return percentage
 
-# Analyse several photos in a batch using functions above
-def bulk_photo_analysis (dir, folder_input, verbose = True):
+# Analyse several photos in a batch using functions above. Photos are read from
+# their full path, so threads > 1 analyses them in a thread pool (not with
+# verbose, which shows every photo)
+def bulk_photo_analysis (dir, folder_input, verbose = True, threads = 1):
     metadata = photo_metadata_collate (dir, folder_input)
-    means = [] 
-    for index in range(len (metadata)):
-        os.chdir(dir + folder_input[int(metadata.iloc[index]['Donor'])-1])
-        means.append (photo_binary_analysis(metadata.iloc[index]['File Name'], verbose = verbose))
-    metadata ['Percentage'] = means
+    image_names = [os.path.join(dir + folder_input[int(metadata.iloc[index]['Donor'])-1],
+                                metadata.iloc[index]['File Name'])
+                   for index in range(len (metadata))]
+    if threads == 1 or verbose:
+        results = [photo_binary_analysis(image_name, verbose = verbose, statistics = True)
+                   for image_name in image_names]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(lambda image_name: photo_binary_analysis(image_name, statistics = True),
+                                    image_names))
+    # Percentage and intensity statistics of every photo
+    for column in ['Percentage'] + intensity_columns:
+        metadata [column] = [result[column] for result in results]
     return metadata
 
 # Export results as an Excel file for quicker access later
 def export_microscopy_data (metadata, dir, folder_output):
-    os.chdir(dir + folder_output)   # Change the working directory
-    metadata.loc[:, metadata.columns.isin(['File Name','Media type','Ascorbic acid','Magnificiation','Replicate','Donor','Percentage'])].to_excel("[Microscopy] Data Summary.xlsx")
+    metadata = metadata.loc[:, metadata.columns.isin(['File Name','Media type','Ascorbic acid','Magnificiation','Replicate','Donor','Percentage'] + intensity_columns)]
+    export_table(metadata, os.path.join(dir + folder_output, "[Microscopy] Data Summary.xlsx"))
     return
 
 # Import previously exported results
 def import_microscopy_data (dir, folder_output,filename = "[Microscopy] Data Summary.xlsx"):
-    os.chdir(dir + folder_output)   # Change the working directory
-    return pd.read_excel(filename, index_col=None)
+    return pd.read_excel(os.path.join(dir + folder_output, filename), index_col=None)
 
 # Plotting the results with pooled ASC+ and ASC-
 def barplot_it_condensed_ASC (metadata, plot, dir, folder_output, tag = "", verbose = True):
     # Annotations: https://pythonlang.dev/repo/trevismd-statannotations/
-    from statannotations.Annotator import Annotator 
+    from Pairwise_stats import annotate_pairs # Tests are cached across figures
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     metadata ['hSVF'] = 'hSVF#'+ metadata['Donor'].apply(str) 
     # Sort the datasets 
     metadata = metadata.sort_values(by=['hSVF','Media type'])
@@ -126,9 +131,7 @@ def barplot_it_condensed_ASC (metadata, plot, dir, folder_output, tag = "", verb
            [('hSVF#2', 'Obesogenic'),('hSVF#2', 'Normogenic')],
            [('hSVF#3', 'Obesogenic'),('hSVF#3', 'Normogenic')],
            [('hSVF#4', 'Obesogenic'),('hSVF#4', 'Normogenic')]]
-    annotator = Annotator(ax, pairs, data=metadata, x='hSVF', y='Percentage', hue = 'Media type')
-    annotator.configure(test='Mann-Whitney', text_format='star', comparisons_correction="bonferroni")
-    annotator.apply_and_annotate()
+    annotate_pairs(ax, pairs, metadata, x='hSVF', y='Percentage', hue='Media type', test='Mann-Whitney')
     # Tune some visual parameters
     ax.set(xlabel=None)
     ax.legend(fontsize = 30, bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0)
@@ -136,13 +139,12 @@ def barplot_it_condensed_ASC (metadata, plot, dir, folder_output, tag = "", verb
     ax.set(ylim=(0, 100))
     plt.grid(axis = 'y', color = 'gray', linestyle = '--', linewidth = 0.5)
     # Save the figure
-    os.chdir(dir + folder_output)   # Change the working directory
     if plot == 0:
-        plt.savefig(tag + 'Condensed boxplot (no ASC).png', bbox_inches='tight')
+        plt.savefig(os.path.join(dir + folder_output, tag + 'Condensed boxplot (no ASC).png'), bbox_inches='tight')
     elif plot == 1:
-        plt.savefig(tag + 'Condensed barplot (no ASC).png', bbox_inches='tight')
+        plt.savefig(os.path.join(dir + folder_output, tag + 'Condensed barplot (no ASC).png'), bbox_inches='tight')
     elif plot == 2:
-        plt.savefig(tag + 'Condensed violin plot (no ASC).png', bbox_inches='tight')
+        plt.savefig(os.path.join(dir + folder_output, tag + 'Condensed violin plot (no ASC).png'), bbox_inches='tight')
     if verbose:
         plt.show()
     plt.close('all') # Close any open plots to avoid a mess
@@ -151,7 +153,9 @@ def barplot_it_condensed_ASC (metadata, plot, dir, folder_output, tag = "", verb
 # Plotting the results with pooled HG and LG
 def barplot_it_condensed_lipids (metadata, plot, dir, folder_output, tag = "", verbose = True):
     # Annotations: https://pythonlang.dev/repo/trevismd-statannotations/
-    from statannotations.Annotator import Annotator 
+    from Pairwise_stats import annotate_pairs # Tests are cached across figures
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     metadata ['hSVF'] = 'hSVF#'+ metadata['Donor'].apply(str) 
     # Sort the datasets 
     metadata = metadata.sort_values(by=['hSVF','Media type'])
@@ -178,9 +182,7 @@ def barplot_it_condensed_lipids (metadata, plot, dir, folder_output, tag = "", v
            [('hSVF#2', '+'),('hSVF#2', '-')],
            [('hSVF#3', '+'),('hSVF#3', '-')],
            [('hSVF#4', '+'),('hSVF#4', '-')]]
-    annotator = Annotator(ax, pairs, data=metadata, x='hSVF', y='Percentage', hue = 'Ascorbic acid')
-    annotator.configure(test='Mann-Whitney', text_format='star', comparisons_correction="bonferroni")
-    annotator.apply_and_annotate()
+    annotate_pairs(ax, pairs, metadata, x='hSVF', y='Percentage', hue='Ascorbic acid', test='Mann-Whitney')
     # Tune some visual parameters
     ax.set(xlabel=None)
     ax.legend(fontsize = 30, bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0)
@@ -188,13 +190,12 @@ def barplot_it_condensed_lipids (metadata, plot, dir, folder_output, tag = "", v
     ax.set(ylim=(0, 100))
     plt.grid(axis = 'y', color = 'gray', linestyle = '--', linewidth = 0.5)
     # Save the figure
-    os.chdir(dir + folder_output)   # Change the working directory
     if plot == 0:
-        plt.savefig(tag + 'Condensed boxplot (no lipids).png', bbox_inches='tight')
+        plt.savefig(os.path.join(dir + folder_output, tag + 'Condensed boxplot (no lipids).png'), bbox_inches='tight')
     elif plot == 1:
-        plt.savefig(tag + 'Condensed barplot (no lipids).png', bbox_inches='tight')
+        plt.savefig(os.path.join(dir + folder_output, tag + 'Condensed barplot (no lipids).png'), bbox_inches='tight')
     elif plot == 2:
-        plt.savefig(tag + 'Condensed violin plot (no lipids).png', bbox_inches='tight')
+        plt.savefig(os.path.join(dir + folder_output, tag + 'Condensed violin plot (no lipids).png'), bbox_inches='tight')
     if verbose:
         plt.show()
     plt.close('all') # Close any open plots to avoid a mess
@@ -203,7 +204,9 @@ def barplot_it_condensed_lipids (metadata, plot, dir, folder_output, tag = "", v
 # Plotting the results with separated conditions
 def barplot_it_detailed (metadata, plot, dir, folder_output, tag = "", verbose = True):
     # Annotations: https://pythonlang.dev/repo/trevismd-statannotations/
-    from statannotations.Annotator import Annotator 
+    from Pairwise_stats import annotate_pairs # Tests are cached across figures
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     # Prepare additional functions to do statistics and plots
     metadata ['hSVF'] = "hSVF#"+ metadata['Donor'].apply(str) 
     metadata['Growth media'] = metadata['Media type'] + ' (ASC' + metadata['Ascorbic acid'] + ')'
@@ -234,9 +237,7 @@ def barplot_it_detailed (metadata, plot, dir, folder_output, tag = "", verbose =
            [('hSVF#3', 'Normogenic (ASC-)'),('hSVF#3', 'Normogenic (ASC+)')],
            [('hSVF#4', 'Obesogenic (ASC-)'),('hSVF#4', 'Obesogenic (ASC+)')],
            [('hSVF#4', 'Normogenic (ASC-)'),('hSVF#4', 'Normogenic (ASC+)')],]
-    annotator = Annotator(ax, pairs, data=metadata, x='hSVF', y='Percentage', hue = 'Growth media')
-    annotator.configure(test='Mann-Whitney', text_format='star', comparisons_correction="bonferroni")
-    annotator.apply_and_annotate()
+    annotate_pairs(ax, pairs, metadata, x='hSVF', y='Percentage', hue='Growth media', test='Mann-Whitney')
     # Tune some visualparameters
     ax.set(xlabel=None)
     ax.legend(fontsize = 30, bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0)
@@ -244,34 +245,39 @@ def barplot_it_detailed (metadata, plot, dir, folder_output, tag = "", verbose =
     plt.ylabel("Surface area labelled as collagen (%)", fontsize = 35)
     plt.grid(axis = 'y', color = 'gray', linestyle = '--', linewidth = 0.5)
     # Save the figure
-    os.chdir(dir + folder_output)   # Change the working directory
     if plot == 0:
-        plt.savefig(tag + 'Detailed boxplot.png', bbox_inches='tight')
+        plt.savefig(os.path.join(dir + folder_output, tag + 'Detailed boxplot.png'), bbox_inches='tight')
     elif plot == 1:
-        plt.savefig(tag + 'Detailed barplot.png', bbox_inches='tight')
+        plt.savefig(os.path.join(dir + folder_output, tag + 'Detailed barplot.png'), bbox_inches='tight')
     elif plot == 2:
-        plt.savefig(tag + 'Detailed violin plot.png', bbox_inches='tight')
+        plt.savefig(os.path.join(dir + folder_output, tag + 'Detailed violin plot.png'), bbox_inches='tight')
     if verbose:
         plt.show()
     plt.close('all') # Close any open plots to avoid a mess
     return 
 
     
+# Whole analysis: quantify the photographs of the input folders (one folder per
+# donor, in donor order), export the results to folder_output and, with plots, draw them;
+# threads: photos analysed concurrently (see bulk_photo_analysis)
+def main (dir, folder_input, folder_output, plots = True, verbose = True, threads = 1):
+    # Update (uncomment) the section below to use pre-exported data
+    tag = "[Microscopy] "
+    metadata_microscopy = bulk_photo_analysis (dir, folder_input, verbose = False, threads = threads)
+    export_microscopy_data(metadata_microscopy, dir, folder_output)
+    # metadata_microscopy = import_microscopy_data(dir, folder_output)
+    if plots:
+        for plot in range(0,3):
+            barplot_it_condensed_ASC(metadata_microscopy, plot, dir, folder_output, tag=tag, verbose=verbose)
+            barplot_it_condensed_lipids(metadata_microscopy, plot, dir, folder_output, tag=tag, verbose=verbose)
+            barplot_it_detailed(metadata_microscopy, plot, dir, folder_output, tag=tag, verbose=verbose)
+    return metadata_microscopy
+
 if __name__ == "__main__":
-    import os
     dir = r'C:\Input folder directory'
     folder_input = ['\Input folder directory #1',
                '\Input folder directory #2',
                '\Input folder directory #3',
                '\Input folder directory #4']
     folder_output = r'\Output folder directory'
-    # Update (uncomment) the section below to use pre-exported data
-    tag = "[Microscopy] "
-    metadata_microscopy = bulk_photo_analysis (dir, folder_input, verbose = False)
-    export_microscopy_data(metadata_microscopy, dir, folder_output)
-    # metadata_microscopy = import_microscopy_data(dir, folder_output)
-    for plot in range(0,3):
-        barplot_it_condensed_ASC(metadata_microscopy, plot, dir, folder_output, tag=tag)
-        barplot_it_condensed_lipids(metadata_microscopy, plot, dir, folder_output, tag=tag)
-        barplot_it_detailed(metadata_microscopy, plot, dir, folder_output, tag=tag)
-    
\ No newline at end of file
+    main(dir, folder_input, folder_output)
@@ -0,0 +1,118 @@
+"""
+Pairwise statistics engine shared by the FACS and image analysis figures: all
+the requested comparisons of a grouped dataset are tested at once (Welch
+t-tests from per-group moments, vectorised over the pairs; Mann-Whitney from
+per-group values), corrected for multiple comparisons (Bonferroni or Holm) and
+memoised by a fingerprint of the data, so box, bar and violin versions of a
+figure share the same results and only draw the precomputed annotations
+"""
+import hashlib
+import numpy as np
+import pandas as pd
+
+test_cache = {}
+cache_entries = 256
+
+# Group of a pair member: (x, hue) with a hue column, the x value otherwise
+def group_key (member, hue):
+    return tuple(member) if hue is not None else member
+
+# Values of every group (missing values dropped)
+def group_values (data, x, y, hue=None):
+    by = [x, hue] if hue is not None else x
+    values = data[y].to_numpy(dtype=float)
+    groups = {}
+    for key, index in data.groupby(by, sort=False).indices.items():
+        group = values[index]
+        groups[key] = group[~np.isnan(group)]
+    return groups
+
+# Multiple comparisons correction of p-values (same order out)
+def correct_pvalues (pvalues, correction='bonferroni'):
+    pvalues = np.asarray(pvalues, dtype=float)
+    m = len(pvalues)
+    if correction is None or m == 0:
+        return pvalues
+    if correction == 'bonferroni':
+        return np.minimum(pvalues*m, 1.0)
+    if correction == 'holm':
+        # Step-down: k-th smallest p-value times (m - k), kept monotonic
+        order = np.argsort(pvalues, kind='stable')
+        adjusted = np.maximum.accumulate(pvalues[order]*(m - np.arange(m)))
+        corrected = np.empty(m)
+        corrected[order] = np.minimum(adjusted, 1.0)
+        return corrected
+    raise ValueError('Unknown correction: ' + repr(correction))
+
+# Welch's t-tests (as scipy.stats.ttest_ind(equal_var=False)) of every pair of
+# groups from the moments of each group, in one vectorised computation
+def welch_tests (groups, firsts, seconds):
+    from scipy import stats
+    moments = {key: (len(values), np.mean(values) if len(values) else np.nan,
+                     np.var(values, ddof=1) if len(values) > 1 else np.nan)
+               for key, values in groups.items()}
+    n1, m1, v1 = np.array([moments[key] for key in firsts], dtype=float).T
+    n2, m2, v2 = np.array([moments[key] for key in seconds], dtype=float).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s1 = v1/n1
+        s2 = v2/n2
+        statistic = (m1 - m2)/np.sqrt(s1 + s2)
+        dof = (s1 + s2)**2/(s1**2/(n1 - 1) + s2**2/(n2 - 1))
+        pvalues = 2*stats.t.sf(np.abs(statistic), dof)
+    return statistic, pvalues
+
+# Mann-Whitney U tests, two-sided (as scipy.stats.mannwhitneyu), of every pair
+def mann_whitney_tests (groups, firsts, seconds):
+    from scipy import stats
+    statistic = np.full(len(firsts), np.nan)
+    pvalues = np.full(len(firsts), np.nan)
+    for i, (first, second) in enumerate(zip(firsts, seconds)):
+        if len(groups[first]) and len(groups[second]):
+            result = stats.mannwhitneyu(groups[first], groups[second], alternative='two-sided')
+            statistic[i] = result.statistic
+            pvalues[i] = result.pvalue
+    return statistic, pvalues
+
+tests = {'t-test_welch': welch_tests, 'Mann-Whitney': mann_whitney_tests}
+
+# Fingerprint of the tested data and of the request (cache key)
+def test_digest (data, pairs, x, y, hue, test, correction):
+    columns = [x, y] + ([hue] if hue is not None else [])
+    digest = hashlib.sha256(pd.util.hash_pandas_object(data[columns], index=False).to_numpy().tobytes())
+    digest.update(repr((columns, [list(pair) for pair in pairs], test, correction)).encode('utf-8'))
+    return digest.hexdigest()
+
+# Test every pair ([member 1, member 2], members as in statannotations: (x, hue)
+# with a hue column) of data[y]. Returns one row per pair: n, statistic,
+# p-value and corrected p-value (correction over all the pairs)
+def pairwise_tests (data, pairs, x, y, hue=None, test='t-test_welch', correction='bonferroni'):
+    key = test_digest(data, pairs, x, y, hue, test, correction)
+    if key in test_cache:
+        return test_cache[key]
+    if test not in tests:
+        raise ValueError('Unknown test: ' + repr(test) + ' (one of ' + ', '.join(tests) + ')')
+    groups = group_values(data, x, y, hue)
+    firsts = [group_key(pair[0], hue) for pair in pairs]
+    seconds = [group_key(pair[1], hue) for pair in pairs]
+    for group in firsts + seconds:
+        groups.setdefault(group, np.empty(0))
+    statistic, pvalues = tests[test](groups, firsts, seconds)
+    results = pd.DataFrame({'Group 1': firsts, 'Group 2': seconds,
+                            'n1': [len(groups[group]) for group in firsts],
+                            'n2': [len(groups[group]) for group in seconds],
+                            'Statistic': statistic, 'p-value': pvalues,
+                            'Corrected p-value': correct_pvalues(pvalues, correction)})
+    test_cache[key] = results
+    while len(test_cache) > cache_entries: # Oldest first
+        del test_cache[next(iter(test_cache))]
+    return results
+
+# Draw the significance stars of pairs on ax (a seaborn plot of data) from the
+# cached/precomputed tests: statannotations only positions the annotations
+def annotate_pairs (ax, pairs, data, x, y, hue=None, test='t-test_welch', correction='bonferroni'):
+    from statannotations.Annotator import Annotator
+    results = pairwise_tests(data, pairs, x, y, hue, test, correction)
+    annotator = Annotator(ax, pairs, data=data, x=x, y=y, hue=hue)
+    annotator.configure(text_format='star')
+    annotator.set_pvalues_and_annotate(list(results['Corrected p-value']))
+    return results
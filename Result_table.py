@@ -0,0 +1,74 @@
+"""
+Columnar result accumulator shared by the FACS and image analysis scripts.
+Rows/frames are collected as per-column chunks and turned into a DataFrame
+once, instead of growing a DataFrame with repeated appends
+"""
+import os
+import warnings
+import numpy as np
+import pandas as pd
+
+# An empty table: column chunks in first-seen column order, plus index chunks
+def result_table (keep_index=False):
+    return {'columns': {}, 'index': [], 'rows': 0, 'keep_index': keep_index}
+
+# Add a DataFrame (any number of rows) or a {column: value} dictionary (one row)
+def table_append (table, data):
+    if isinstance(data, dict):
+        data = {column: [data[column]] for column in data}
+        n_rows = 1
+        index = np.array([table['rows']])
+    else:
+        n_rows = len(data)
+        index = data.index.to_numpy()
+    if n_rows == 0:
+        return table
+    columns = table['columns']
+    for column in data:
+        if column not in columns:
+            # New column: earlier rows get missing values (like pd.concat)
+            columns[column] = [np.full(table['rows'], None, dtype=object)]
+        values = np.asarray(data[column])
+        if values.dtype.kind in 'US': # Keep strings as objects, never cast numbers to str
+            values = values.astype(object)
+        columns[column].append(values)
+    for column in columns:
+        if column not in data:
+            columns[column].append(np.full(n_rows, None, dtype=object))
+    table['index'].append(index)
+    table['rows'] = table['rows'] + n_rows
+    return table
+
+# Materialise the table into a DataFrame (a single concatenation per column)
+def table_frame (table):
+    frame = {}
+    for column, chunks in table['columns'].items():
+        chunks = [chunk for chunk in chunks if len(chunk)]
+        values = np.concatenate(chunks) if chunks else np.empty(0)
+        frame[column] = pd.Series(values).infer_objects()
+    df = pd.DataFrame(frame)
+    if table['keep_index'] and table['index']:
+        df.index = np.concatenate(table['index'])
+    return df
+
+# Stack several DataFrames through a result table
+def concat_frames (frames, keep_index=False):
+    table = result_table(keep_index)
+    for frame in frames:
+        table_append(table, frame)
+    return table_frame(table)
+
+# Export a result DataFrame as Excel and, next to it, as Parquet for fast reloads
+def export_table (df, excel_name, parquet=True):
+    df.to_excel(excel_name)
+    if parquet:
+        parquet_name = excel_name[0:excel_name.rfind('.')] + '.parquet'
+        try:
+            df.to_parquet(parquet_name)
+        except ImportError: # Optional dependency (pyarrow or fastparquet)
+            warnings.warn('Parquet export skipped: install pyarrow to enable it')
+        except (ValueError, TypeError): # e.g. mixed-type columns (Arrow errors subclass these)
+            warnings.warn('Parquet export skipped for a table Arrow cannot convert (the Excel file is written)')
+            # No stale copy left to be read instead of the Excel file
+            if os.path.exists(parquet_name):
+                os.remove(parquet_name)